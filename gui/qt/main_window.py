@@ -209,8 +209,8 @@ class ElectrumWindow(QMainWindow):
         self.load_base_units()
         # address used to create a dummy transaction and estimate transaction fee
         self.dummy_address = self.wallet.addresses(False)[0]
-        self.invoices = self.wallet.storage.get('invoices', {})
-        self.accounts_expanded = self.wallet.storage.get('accounts_expanded',{})
+        self.invoices = dict(self.wallet.storage.get('invoices', {}))
+        self.accounts_expanded = dict(self.wallet.storage.get('accounts_expanded',{}))
         self.current_account = self.wallet.storage.get("current_account", None)
         title = 'Encompass ' + self.wallet.electrum_version + '  -  ' + self.wallet.storage.path
         if self.wallet.is_watching_only(): title += ' [%s]' % (_('watching only'))
@@ -282,6 +282,8 @@ class ElectrumWindow(QMainWindow):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                # fold the journal in so that the copy is complete
+                self.wallet.storage.write()
                 shutil.copy2(path, new_path)
                 QMessageBox.information(None,"Wallet backup created", _("A copy of your wallet file was created in")+" '%s'" % str(new_path))
             except (IOError, os.error), reason:
@@ -764,6 +766,7 @@ class ElectrumWindow(QMainWindow):
 
     def receive_list_delete(self, item):
         addr = str(item.text(0))
+        self.receive_requests = dict(self.receive_requests)
         self.receive_requests.pop(addr)
         self.wallet.storage.put('receive_requests', self.receive_requests)
         self.update_receive_tab()
@@ -783,7 +786,7 @@ class ElectrumWindow(QMainWindow):
         if not message and not amount:
             QMessageBox.warning(self, _('Error'), _('No message or amount'), _('OK'))
             return
-        self.receive_requests = self.wallet.storage.get('receive_requests',{})
+        self.receive_requests = dict(self.wallet.storage.get('receive_requests',{}))
         self.receive_requests[addr] = (amount, message)
         self.wallet.storage.put('receive_requests', self.receive_requests)
         self.update_receive_tab()
@@ -1494,10 +1497,8 @@ class ElectrumWindow(QMainWindow):
         if self.pay_from:
             return self.pay_from
         else:
-            domain = self.wallet.get_account_addresses(self.current_account)
-            for i in self.wallet.frozen_addresses:
-                if i in domain: domain.remove(i)
-            return self.wallet.get_unspent_coins(domain)
+            coins = self.wallet.get_account_coins(self.current_account)
+            return [c for c in coins if c['address'] not in self.wallet.frozen_addresses]
 
 
     def send_from_addresses(self, addrs):
@@ -2592,7 +2593,7 @@ class ElectrumWindow(QMainWindow):
             return
 
         fee = self.wallet.fee_per_kb
-        tx = Transaction.sweep(get_pk(), self.network, get_address(), fee)
+        tx = Transaction.sweep(get_pk(), self.network, get_address(), fee, self.config.get('sign_workers') or 1)
         self.show_transaction(tx)
 
 
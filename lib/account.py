@@ -16,12 +16,42 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
+
 import bitcoin
 from bitcoin import *
 from i18n import _
 from transaction import Transaction, is_extended_pubkey
 from util import print_msg
 import chainparams
+import ecc
+
+
+# fewer addresses than this are not worth starting worker processes for
+DERIVE_POOL_MIN = 200
+
+def _derive_children(args):
+    return CKD_pub_range(*args)
+
+
+def derive_children(cK, c, start, count, workers=1):
+    '''Compressed public keys of the children start .. start + count - 1
+    of the public key cK with chain code c.
+
+    With more than one worker and enough children, the range is split in
+    chunks that are derived in a pool of worker processes.
+    '''
+    if workers > 1 and count >= DERIVE_POOL_MIN:
+        chunksize = -(-count / (workers * 4))
+        jobs = [(cK, c, n, min(chunksize, start + count - n)) for n in range(start, start + count, chunksize)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            return sum(pool.map(_derive_children, jobs), [])
+        finally:
+            pool.terminate()
+            pool.join()
+    return CKD_pub_range(cK, c, start, count)
+
 
 class Account(object):
     def __init__(self, v):
@@ -50,19 +80,32 @@ class Account(object):
         addr_list = self.change_addresses if for_change else self.receiving_addresses
         return addr_list[:]
 
+    def get_last_address(self, for_change):
+        """(n, address) of the newest address of a sequence, or None."""
+        addr_list = self.change_addresses if for_change else self.receiving_addresses
+        return (len(addr_list) - 1, addr_list[-1]) if addr_list else None
+
     def derive_pubkeys(self, for_change, n):
         pass
 
+    def derive_range(self, for_change, start, count, workers=1):
+        """derive_pubkeys of the addresses start .. start + count - 1."""
+        return [self.derive_pubkeys(for_change, n) for n in range(start, start + count)]
+
     def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count, workers=1):
         pubkeys_list = self.change_pubkeys if for_change else self.receiving_pubkeys
         addr_list = self.change_addresses if for_change else self.receiving_addresses
         n = len(pubkeys_list)
-        pubkeys = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(pubkeys)
-        pubkeys_list.append(pubkeys)
-        addr_list.append(address)
-        print_msg(address)
-        return address
+        new_pubkeys = self.derive_range(for_change, n, count, workers)
+        addresses = map(self.pubkeys_to_address, new_pubkeys)
+        pubkeys_list.extend(new_pubkeys)
+        addr_list.extend(addresses)
+        for address in addresses:
+            print_msg(address)
+        return addresses
 
     def pubkeys_to_address(self, pubkey):
         return public_key_to_bc_address(pubkey.decode('hex'), self.active_chain.p2pkh_version)
@@ -78,17 +121,15 @@ class Account(object):
 
     def synchronize_sequence(self, wallet, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
-            addresses = self.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
-                break
-            else:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
+        addresses = self.get_addresses(for_change)
+        # the last limit addresses must be unused: derive the missing ones
+        # in one batch, new addresses are never old
+        n = len(addresses)
+        old = [i for i in range(max(0, n - limit), n) if wallet.address_is_old(addresses[i])]
+        count = (old[-1] + 1 if old else 0) + limit - n
+        if count > 0:
+            workers = wallet.storage.config.get('derive_workers') or 1
+            wallet.add_addresses(self.create_new_addresses(for_change, count, workers))
 
     def synchronize(self, wallet):
         self.synchronize_sequence(wallet, False)
@@ -105,6 +146,9 @@ class PendingAccount(Account):
     def get_addresses(self, is_change):
         return [] if is_change else [self.pending_address]
 
+    def get_last_address(self, for_change):
+        return None
+
     def has_change(self):
         return False
 
@@ -130,6 +174,9 @@ class ImportedAccount(Account):
     def get_addresses(self, for_change):
         return [] if for_change else sorted(self.keypairs.keys())
 
+    def get_last_address(self, for_change):
+        return None
+
     def get_pubkey(self, *sequence):
         for_change, i = sequence
         assert for_change == 0
@@ -187,11 +234,14 @@ class OldAccount(Account):
 
     @classmethod
     def mpk_from_seed(klass, seed):
-        curve = SECP256k1
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string().encode('hex')
-        return master_public_key
+        return klass.mpk_from_secexp(secexp).encode('hex')
+
+    @classmethod
+    def mpk_from_secexp(klass, secexp):
+        order = generator_secp256k1.order()
+        # without the 04 prefix
+        return ecc.backend.pubkey_from_secret(number_to_string(secexp, order))[1:]
 
     @classmethod
     def stretch_key(self,seed):
@@ -209,18 +259,23 @@ class OldAccount(Account):
         address = public_key_to_bc_address( pubkey.decode('hex'), self.active_chain.p2pkh_version )
         return address
 
+    @classmethod
+    def get_sequence_tweak(self, mpk, for_change, n):
+        order = generator_secp256k1.order()
+        return number_to_string(self.get_sequence(mpk, for_change, n) % order, order)
+
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
-        curve = SECP256k1
-        z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string( mpk, curve = SECP256k1 )
-        pubkey_point = master_public_key.pubkey.point + z*curve.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
-        return '04' + public_key2.to_string().encode('hex')
+        tweak = self.get_sequence_tweak(mpk, for_change, n)
+        return ecc.backend.pubkey_tweak_add('\x04' + mpk, tweak).encode('hex')
 
     def derive_pubkeys(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_range(self, for_change, start, count, workers=1):
+        tweaks = [self.get_sequence_tweak(self.mpk, for_change, n) for n in range(start, start + count)]
+        return [K.encode('hex') for K in ecc.backend.pubkey_tweak_add_many('\x04' + self.mpk, tweaks)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = ( secexp + self.get_sequence(self.mpk, for_change, n) ) % order
@@ -239,10 +294,8 @@ class OldAccount(Account):
 
 
     def check_seed(self, seed):
-        curve = SECP256k1
         secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = self.mpk_from_secexp(secexp)
         if master_public_key != self.mpk:
             print_error('invalid password (mpk)', self.mpk.encode('hex'), master_public_key.encode('hex'))
             raise Exception('Invalid password')
@@ -311,7 +364,7 @@ class BIP32_Account(Account):
         pubkeys = self.get_pubkeys(sequence, n)
         return pubkeys[i]
 
-    def derive_pubkeys(self, for_change, n):
+    def get_branch_xpub(self, for_change):
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
@@ -319,11 +372,18 @@ class BIP32_Account(Account):
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
-        _, _, _, c, cK = deserialize_xkey(xpub)
+        return xpub
+
+    def derive_pubkeys(self, for_change, n):
+        _, _, _, c, cK = deserialize_xkey(self.get_branch_xpub(for_change))
         cK, c = CKD_pub(cK, c, n)
         result = cK.encode('hex')
         return result
 
+    def derive_range(self, for_change, start, count, workers=1):
+        _, _, _, c, cK = deserialize_xkey(self.get_branch_xpub(for_change))
+        return [cK_n.encode('hex') for cK_n in derive_children(cK, c, start, count, workers)]
+
 
     def get_private_key(self, sequence, wallet, password):
         out = []
@@ -388,6 +448,14 @@ class BIP32_Account_2of2(BIP32_Account):
     def derive_pubkeys(self, for_change, n):
         return map(lambda x: self.derive_pubkey_from_xpub(x, for_change, n), self.get_master_pubkeys())
 
+    def derive_range(self, for_change, start, count, workers=1):
+        columns = []
+        for xpub in self.get_master_pubkeys():
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            cK, c = CKD_pub(cK, c, for_change)
+            columns.append([cK_n.encode('hex') for cK_n in derive_children(cK, c, start, count, workers)])
+        return map(list, zip(*columns))
+
     def redeem_script(self, for_change, n):
         pubkeys = self.get_pubkeys(for_change, n)
         return Transaction.multisig_script(sorted(pubkeys), 2)
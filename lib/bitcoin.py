@@ -411,6 +411,8 @@ from ecdsa.curves import SECP256k1
 from ecdsa.ellipticcurve import Point
 from ecdsa.util import string_to_number, number_to_string
 
+import ecc
+
 def msg_magic(message):
     varint = var_int(len(message))
     encoded_varint = "".join([chr(int(varint[i:i+2], 16)) for i in xrange(0, len(varint), 2)])
@@ -503,7 +505,8 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
 class EC_KEY(object):
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        point = ecc.point_from_pubkey(ecc.backend.pubkey_from_secret(number_to_string(secret, generator_secp256k1.order())))
+        self.pubkey = ecc.public_key(point)
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -511,10 +514,10 @@ class EC_KEY(object):
         return point_to_ser(self.pubkey.point, compressed).encode('hex')
 
     def sign_message(self, message, compressed, address):
-        private_key = ecdsa.SigningKey.from_secret_exponent( self.secret, curve = SECP256k1 )
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic( Hash( msg_magic(message) ), hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string )
-        assert public_key.verify_digest( signature, Hash( msg_magic(message) ), sigdecode = ecdsa.util.sigdecode_string)
+        order = generator_secp256k1.order()
+        key = ecc.backend.signing_key(number_to_string(self.secret, order))
+        r, s = ecdsa.util.sigdecode_der(ecc.backend.sign(key, Hash( msg_magic(message) )), order)
+        signature = ecdsa.util.sigencode_string(r, s, order)
         for i in range(4):
             sig = base64.b64encode( chr(27 + i + (4 if compressed else 0)) + signature )
             try:
@@ -542,13 +545,16 @@ class EC_KEY(object):
 
         recid = nV - 27
         h = Hash( msg_magic(message) )
-        public_key = MyVerifyingKey.from_signature( sig[1:], recid, h, curve = SECP256k1 )
+        public_key = ecc.backend.recover( sig[1:], recid, h )
 
         # check public key
-        public_key.verify_digest( sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        order = generator_secp256k1.order()
+        r, s = ecdsa.util.sigdecode_string( sig[1:], order )
+        if not ecc.backend.verify( public_key, ecdsa.util.sigencode_der(r, s, order), h ):
+            raise Exception("Bad signature")
 
         # check that we get the original signing address
-        addr = public_key_to_bc_address( point_to_ser(public_key.pubkey.point, compressed) )
+        addr = public_key_to_bc_address( ecc.compress(public_key) if compressed else public_key )
         if address != addr:
             raise Exception("Bad signature")
 
@@ -615,10 +621,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    public_key = ecc.backend.pubkey_from_secret(secret)
+    K = public_key[1:]
+    K_compressed = ecc.compress(public_key)
     return K, K_compressed
 
 
@@ -662,14 +667,22 @@ def _CKD_pub(cK, c, s):
     from ecdsa.util import string_to_number, number_to_string
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = ecc.compress(ecc.backend.pubkey_tweak_add(cK, I[0:32]))
     return cK_n, c_n
 
 
+def CKD_pub_range(cK, c, start, count):
+    '''Compressed public keys of the children start .. start + count - 1.'''
+    import hmac
+    tweaks = []
+    for n in range(start, start + count):
+        if n & BIP32_PRIME: raise
+        s = rev_hex(int_to_hex(n,4)).decode('hex')
+        tweaks.append(hmac.new(c, cK + s, hashlib.sha512).digest()[0:32])
+    return map(ecc.compress, ecc.backend.pubkey_tweak_add_many(cK, tweaks))
+
+
 BITCOIN_HEADER_PRIV = "0488ade4"
 BITCOIN_HEADER_PUB = "0488b21e"
 
@@ -21,6 +21,20 @@ import threading, time, Queue, os, sys, shutil
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
 import chainparams
+from chains.headertree import HeaderTree
+
+# Number of chunk requests kept in flight while syncing
+CHUNK_WINDOW = 8
+# Seconds to wait for a chunk before asking another server
+CHUNK_TIMEOUT = 30
+# Number of headers below the tip in which forks are followed
+TREE_DEPTH = 100
+
+def headers_path(config, code):
+    '''Path of the blockchain_headers file for a chain.'''
+    headers_file_name = '_'.join(['blockchain_headers', code.lower()])
+    return os.path.join(config.path, headers_file_name)
+
 
 class Blockchain(threading.Thread):
 
@@ -31,6 +45,8 @@ class Blockchain(threading.Thread):
 
         self.active_chain = chainparams.get_active_chain()
         self.chunk_size = self.active_chain.chunk_size
+        self.active_chain.set_pow_workers(self.config.get('pow_workers') or 1)
+        self.active_chain.use_checkpoints = not self.config.get('full_verification')
 
         self.network = network
         self.lock = threading.Lock()
@@ -40,6 +56,7 @@ class Blockchain(threading.Thread):
         self.headers_url = ''#'http://headers.electrum.org/blockchain_headers'
         self.set_local_height()
         self.queue = Queue.Queue()
+        self.tree = HeaderTree(self.active_chain, TREE_DEPTH)
 
 
     def height(self):
@@ -48,6 +65,8 @@ class Blockchain(threading.Thread):
 
     def stop(self):
         with self.lock: self.running = False
+        if self.active_chain.header_store is not None:
+            self.active_chain.header_store.flush(sync=True)
 
 
     def is_running(self):
@@ -57,6 +76,7 @@ class Blockchain(threading.Thread):
     def run(self):
         self.init_headers_file()
         self.set_local_height()
+        self.tree.load(self.local_height)
         print_error( "blocks:", self.local_height )
 
         with self.lock:
@@ -76,27 +96,31 @@ class Blockchain(threading.Thread):
 
             height = header.get('block_height')
 
-            if height <= self.local_height:
-                continue
-
             if height > self.local_height + 50:
                 if not self.get_and_verify_chunks(i, header, height):
                     continue
+                self.tree.load(self.local_height)
 
-            if height > self.local_height:
-                # get missing parts from interface (until it connects to my chain)
-                chain = self.get_chain( i, header )
+            if self.hash_header(header) not in self.tree:
+                # below the tree a header cannot be connected to it
+                if height < self.tree.base_height():
+                    print_error("header below the tree:", height, i.server)
+                    continue
+
+                # get missing parts from interface (until it connects to the tree)
+                chain = self.get_branch(i, header)
 
                 # skip that server if the result is not consistent
                 if not chain:
-                    print_error('e')
+                    print_error("cannot get the branch of", height, "from", i.server)
                     continue
 
                 # verify the chain
                 if self.verify_chain( chain ):
                     print_error("height:", height, i.server)
-                    for header in chain:
-                        self.save_header(header)
+                    for h in chain:
+                        self.tree.add(h)
+                    self.switch_to_best()
                 else:
                     print_error("error", i.server)
                     # todo: dismiss that server
@@ -106,6 +130,27 @@ class Blockchain(threading.Thread):
             self.network.new_blockchain_height(height, i)
 
 
+    def switch_to_best(self):
+        """Save the branch with the most work, if it is not saved already.
+
+        Only the headers above the fork point are written. If saved headers
+        were replaced, the network is told the height they were replaced
+        from, so that verified transactions above it are checked again.
+        """
+        best = self.tree.best()
+        branch = self.tree.branch(best.hash)
+        if not branch:
+            return
+        fork_height = self.tree.set_main(best.hash)
+        old_height = self.local_height
+        if best.height < old_height:
+            self.active_chain.header_store.truncate(best.height + 1)
+        self.save_headers(branch)
+        if fork_height <= old_height:
+            print_error("reorg from height", fork_height)
+            self.active_chain.invalidate_targets(fork_height)
+            self.network.blockchain_reorg(fork_height)
+
 
 
     def verify_chain(self, chain):
@@ -135,7 +180,10 @@ class Blockchain(threading.Thread):
 
 
     def verify_chunk(self, index, hexdata):
-        self.active_chain.verify_chunk(index, hexdata)
+        if self.active_chain.is_checkpointed(index):
+            self.active_chain.verify_checkpointed_chunk(index, hexdata)
+        else:
+            self.active_chain.verify_chunk(index, hexdata)
         self.set_local_height()
 #        data = hexdata.decode('hex')
 #        height = index*2016
@@ -195,8 +243,7 @@ class Blockchain(threading.Thread):
 #        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
 
     def path(self):
-        headers_file_name = '_'.join(['blockchain_headers', self.active_chain.code.lower()])
-        return os.path.join( self.config.path, headers_file_name)
+        return headers_path(self.config, self.active_chain.code)
 
     def init_headers_file(self):
         filename = self.path()
@@ -236,8 +283,16 @@ class Blockchain(threading.Thread):
 #        f.close()
         self.set_local_height()
 
+    def save_headers(self, headers):
+        self.active_chain.save_headers(headers)
+        self.set_local_height()
+
 
     def set_local_height(self):
+        store = self.active_chain.header_store
+        if store is not None:
+            self.local_height = store.size() - 1
+            return
         name = self.path()
         if os.path.exists(name):
             h = os.path.getsize(name)/80 - 1
@@ -277,64 +332,144 @@ class Blockchain(threading.Thread):
             result = r['result']
             return result
 
-    def get_chain(self, interface, final_header):
+    def get_branch(self, interface, final_header):
+        """Return the headers from the main branch up to final_header.
 
-        header = final_header
+        Missing ancestors are requested from interface in batches that
+        double in size, until one of them connects to the header tree.
+        """
         chain = [ final_header ]
-        requested_header = False
         queue = Queue.Queue()
+        batch = 1
 
         while self.is_running():
-
-            if requested_header:
+            first = chain[0]
+            parent = self.tree.get(first.get('prev_block_hash'))
+            if parent is not None:
+                # the chain is complete
+                return self.tree.branch(parent.hash) + chain
+
+            height = first.get('block_height')
+            start = max(self.tree.base_height(), height - batch)
+            if start >= height:
+                print_error("fork below", self.tree.base_height())
+                return None
+            for h in range(start, height):
+                self.request_header(interface, h, queue)
+            headers = {}
+            for h in range(start, height):
                 header = self.retrieve_request(queue)
-                if not header: return
-                chain = [ header ] + chain
-                requested_header = False
+                if not header: return None
+                headers[header.get('block_height')] = header
+            try:
+                chain = [ headers[h] for h in range(start, height) ] + chain
+            except KeyError:
+                return None
+            batch *= 2
 
-            height = header.get('block_height')
-            previous_header = self.read_header(height -1)
-            if not previous_header:
-                self.request_header(interface, height - 1, queue)
-                requested_header = True
-                continue
 
-            # verify that it connects to my chain
-            prev_hash = self.hash_header(previous_header)
-            if prev_hash != header.get('prev_block_hash'):
-                print_error("reorg")
-                # Call reorg_handler if it exists
-                try:
-                    self.active_chain.reorg_handler(self.local_height)
-                    self.set_local_height()
-                    return None
-                except AttributeError:
-                    self.request_header(interface, height - 1, queue)
-                    requested_header = True
-                    continue
-
-            else:
-                # the chain is complete
-                return chain
+    def request_chunk(self, interface, index, queue):
+        print_error("requesting chunk %d from %s"%(index, interface.server))
+        interface.send_request({'method':'blockchain.block.get_chunk', 'params':[index]}, queue)
 
+    def chunk_interfaces(self, i, index):
+        """Connected interfaces that can serve chunk index, starting with i."""
+        out = [i]
+        for interface in self.network.interfaces.values():
+            if interface == i or not interface.is_connected:
+                continue
+            if self.network.heights.get(interface.server, 0) < index*self.chunk_size:
+                continue
+            out.append(interface)
+        return out
 
     def get_and_verify_chunks(self, i, header, height):
+        """Download and verify the chunks up to height.
 
+        Up to chunk_window requests are kept in flight, spread across all
+        connected interfaces. Chunks are verified in order as they arrive;
+        a chunk that fails verification is requested again from a server
+        that has not sent a bad copy of it yet.
+        """
         queue = Queue.Queue()
+        window = max(1, int(self.config.get('chunk_window') or CHUNK_WINDOW))
         min_index = (self.local_height + 1)/self.chunk_size
         max_index = (height + 1)/self.chunk_size
-        n = min_index
+
+        n = min_index           # next chunk to verify
+        next_index = min_index  # next chunk to request
+        requested = {}          # index -> (interface, time requested)
+        received = {}           # index -> (interface, hexdata)
+        rejected = {}           # index -> servers that sent a bad chunk
+        stepped_back = set()    # chunks whose predecessor was fetched again
+        turn = 0
+
+        def send(index):
+            candidates = self.chunk_interfaces(i, index)
+            bad = rejected.get(index, set())
+            candidates = [x for x in candidates if x.server not in bad]
+            if not candidates:
+                return False
+            interface = candidates[(index + turn) % len(candidates)]
+            self.request_chunk(interface, index, queue)
+            requested[index] = interface, time.time()
+            return True
+
         while n < max_index + 1:
-            print_error( "Requesting chunk:", n )
-            i.send_request({'method':'blockchain.block.get_chunk', 'params':[n]}, queue)
-            r = self.retrieve_request(queue)
+            if not self.is_running():
+                return False
+
+            # keep the window full
+            while next_index <= max_index and next_index < n + window:
+                if not send(next_index):
+                    break
+                next_index += 1
+
             try:
-                self.verify_chunk(n, r)
-                n = n + 1
-            except Exception:
-                print_error('Verify chunk failed!')
-                n = n - 1
-                if n < 0:
+                interface, r = queue.get(timeout=1)
+            except Queue.Empty:
+                # re-request chunks from servers that did not answer
+                for index, (interface, t) in requested.items():
+                    if time.time() - t > CHUNK_TIMEOUT:
+                        print_error('chunk request timeout', index, interface.server)
+                        turn += 1
+                        if not send(index):
+                            return False
+                continue
+
+            index = r['params'][0]
+            if index not in requested or index in received:
+                continue
+            requested.pop(index)
+            if r.get('error'):
+                print_error('chunk request error', index, interface.server, r.get('error'))
+                rejected.setdefault(index, set()).add(interface.server)
+                if not send(index):
                     return False
+                continue
+            received[index] = interface, r['result']
+
+            # verify whatever is now contiguous
+            while n in received:
+                interface, data = received.pop(n)
+                try:
+                    self.verify_chunk(n, data)
+                except Exception:
+                    print_error('Verify chunk failed!', n, interface.server)
+                    rejected.setdefault(n, set()).add(interface.server)
+                    if send(n):
+                        break
+                    # every server sent a bad copy: our previous chunk is
+                    # likely stale, so fetch it again, but only once
+                    if n in stepped_back or n == 0:
+                        return False
+                    stepped_back.add(n)
+                    n = n - 1
+                    requested.clear()
+                    received.clear()
+                    rejected.clear()
+                    next_index = n
+                    break
+                n = n + 1
 
         return True
@@ -33,6 +33,22 @@ class Bitcoin(CryptoCur):
 
     chunk_size = 2016
 
+    checkpoints = {
+        11111: '0000000069e244f73d78e8fd29ba2fd2ed618bd6fa2ee92559f542fdb26e7c1d',
+        33333: '000000002dd5588a74784eaa7ab0507a18ad16a236e7b1ce69f00d7ddfb5d0a6',
+        74000: '0000000000573993a3c9e41ce34471c079dcf5f52a0e824a81e7f953b8661a20',
+        105000: '00000000000291ce28027faea320c8d2b054b2e0fe44a773f3eefb151d6bdc97',
+        134444: '00000000000005b12ffd4cd315cd34ffd4a594f430ac814c91184a0d42d2b0fe',
+        168000: '000000000000099e61ea72015e79632f216fe6cb33d7899acb35b75c8303b763',
+        193000: '000000000000059f452a5f7340de6682a977387c17010ff6e6c3bd83ca8b1317',
+        210000: '000000000000048b95347e83192f69cf0366076336c639f9b7228e9ba171342e',
+        216116: '00000000000001b4f4b433e81ee46494af945cf96014816a4e2370f11b23df4e',
+        225430: '00000000000001c108384350f74090433e7fcf79a606b8e797f065b130575932',
+        250000: '000000000000003887df1f29024b06fc2200b55f8af8f35453d7be294df2d214',
+        279000: '0000000000000001ae8c72a0b0c301f67e3afca10e819efa9041e458e9bd7e40',
+        295000: '00000000000000004d9b4ef50f0f9d686fd69db2e03af35a100370c64632a983',
+    }
+
     # Network
     DEFAULT_PORTS = {'t':'50001', 's':'50002', 'h':'8081', 'g':'8082'}
 
@@ -81,6 +97,7 @@ class Bitcoin(CryptoCur):
         data = hexdata.decode('hex')
         height = index*2016
         num = len(data)/80
+        self.verify_checkpoints(index, data)
 
         if index == 0:
             previous_hash = ("0"*64)
@@ -94,10 +111,10 @@ class Bitcoin(CryptoCur):
         for i in range(num):
             height = index*2016 + i
             raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
+            header = self.header_from_string(raw_header, height)
             _hash = self.hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
+            assert previous_hash == header.prev_block_hash
+            assert bits == header.bits
             assert int('0x'+_hash,16) < target
 
             previous_header = header
@@ -107,59 +124,6 @@ class Bitcoin(CryptoCur):
 #        print_error("validated chunk %d"%height)
 
 
-    def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
-
-    def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
-
-    def hash_header(self, header):
-        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
-
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
-
-
-    def save_header(self, header):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
-
-
-    def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
-
     def get_target(self, index, chain=None):
         if chain is None:
             chain = []  # Do not use mutables as default values!
@@ -167,12 +131,8 @@ class Bitcoin(CryptoCur):
         max_target = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
         if index == 0: return 0x1d00ffff, max_target
 
-        first = self.read_header((index-1)*2016)
-        last = self.read_header(index*2016-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == index*2016-1:
-                    last = h
+        first = self.branch_header((index-1)*2016, chain)
+        last = self.branch_header(index*2016-1, chain)
 
         nActualTimespan = last.get('timestamp') - first.get('timestamp')
         nTargetTimespan = 14*24*60*60
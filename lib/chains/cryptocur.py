@@ -1,6 +1,8 @@
 '''The abstract class for a cryptocurrency.'''
 
-import os, hashlib
+import os, hashlib, struct
+from headerstore import HeaderStore
+from powpool import PoWPool
 
 hash_encode = lambda x: x[::-1].encode('hex')
 hash_decode = lambda x: x.decode('hex')[::-1]
@@ -19,7 +21,73 @@ def sha256(x):
 def Hash(x):
     if type(x) is unicode: x=x.encode('utf-8')
     return sha256(sha256(x))
-    
+
+
+class Header(object):
+    '''A block header backed by its raw 80 bytes.
+
+    Fields are decoded from the raw bytes when they are accessed, and the
+    header hash is computed from the raw bytes directly. get() is provided
+    so a Header can be used wherever a header dict is expected.
+    '''
+    __slots__ = ('raw', 'block_height')
+
+    fields = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce')
+
+    def __init__(self, raw, block_height=None):
+        assert len(raw) == 80
+        self.raw = raw
+        self.block_height = block_height
+
+    @classmethod
+    def from_dict(klass, d):
+        raw = struct.pack('<I', d.get('version')) \
+            + hash_decode(d.get('prev_block_hash')) \
+            + hash_decode(d.get('merkle_root')) \
+            + struct.pack('<III', int(d.get('timestamp')), int(d.get('bits')), int(d.get('nonce')))
+        return klass(raw, d.get('block_height'))
+
+    @property
+    def version(self):
+        return struct.unpack_from('<I', self.raw, 0)[0]
+
+    @property
+    def prev_block_hash(self):
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self):
+        return hash_encode(self.raw[36:68])
+
+    @property
+    def timestamp(self):
+        return struct.unpack_from('<I', self.raw, 68)[0]
+
+    @property
+    def bits(self):
+        return struct.unpack_from('<I', self.raw, 72)[0]
+
+    @property
+    def nonce(self):
+        return struct.unpack_from('<I', self.raw, 76)[0]
+
+    def get(self, key, default=None):
+        if key in self.fields:
+            return getattr(self, key)
+        if key == 'block_height' and self.block_height is not None:
+            return self.block_height
+        return default
+
+    def hash(self):
+        '''Double-SHA256 of the raw header, in internal byte order.'''
+        return Hash(self.raw)
+
+    def as_dict(self):
+        d = dict((k, getattr(self, k)) for k in self.fields)
+        if self.block_height is not None:
+            d['block_height'] = self.block_height
+        return d
+
 
 
 class CryptoCur(object):
@@ -73,12 +141,36 @@ class CryptoCur(object):
     # Number of headers in one chunk
     chunk_size = 2016
 
+    # Function computing the Proof-of-Work hash of a raw header. It must be
+    # a module-level function so that it can be sent to worker processes.
+    pow_hash_function = staticmethod(Hash)
+    # Optional function computing the PoW hashes of a list of raw headers
+    # at once. When set, pow_hashes() uses it instead of pow_hash_function.
+    pow_batch_function = None
+
+    # Number of processes used to compute the PoW hashes of a chunk
+    pow_workers = 1
+    pow_pool = None
+
+    # Known block hashes {height : hash}. Chunks up to the last checkpoint
+    # are only checked to link together and to match these hashes; Proof-of-
+    # Work and targets are checked from the next chunk on.
+    checkpoints = {}
+    # Set to False to verify every chunk in full
+    use_checkpoints = True
+
     ### Methods ###
 
 
+    # Memory-mapped blockchain_headers file, set by set_headers_path()
+    header_store = None
+
     # Tell us where our blockchain_headers file is
     def set_headers_path(self, path):
         self.headers_path = path
+        if self.header_store is not None:
+            self.header_store.close()
+        self.header_store = HeaderStore(path)
 
     def path(self):
         return self.headers_path
@@ -89,23 +181,143 @@ class CryptoCur(object):
     def verify_chunk(self, index, hexdata):
         pass
 
+    def is_checkpointed(self, index):
+        '''Whether chunk index ends at or below the last checkpoint.'''
+        if not self.use_checkpoints or not self.checkpoints:
+            return False
+        return (index + 1) * self.chunk_size - 1 <= max(self.checkpoints)
+
+    def verify_checkpoints(self, index, data):
+        '''Check the raw headers of chunk index against the checkpoints
+        among them. verify_chunk must call this: the chunks before it are
+        trusted on their links alone, up to the last checkpoint.'''
+        first = index*self.chunk_size
+        for height, checkpoint in self.checkpoints.items():
+            i = height - first
+            if 0 <= i < len(data)/80:
+                assert self.hash_header(self.header_from_string(data[i*80:(i+1)*80], height)) == checkpoint
+
+    def verify_checkpointed_chunk(self, index, hexdata):
+        '''Verify a chunk below the last checkpoint and save it.
+
+        The headers must link to the previous chunk and to each other, and
+        match any checkpoints among them. Nothing else is checked.
+        '''
+        data = hexdata.decode('hex')
+        num = len(data)/80
+        self.verify_checkpoints(index, data)
+
+        if index == 0:
+            previous_hash = ("0"*64)
+        else:
+            prev_header = self.read_header(index*self.chunk_size-1)
+            if prev_header is None: raise
+            previous_hash = self.hash_header(prev_header)
+
+        for i in range(num):
+            height = index*self.chunk_size + i
+            header = self.header_from_string(data[i*80:(i+1)*80], height)
+            assert previous_hash == header.prev_block_hash
+            previous_hash = self.hash_header(header)
+
+        self.save_chunk(index, data)
+
     def header_to_string(self, res):
-        pass
+        return self.raw_header(res).encode('hex')
 
-    def header_from_string(self, s):
-        pass
+    def header_from_string(self, s, block_height=None):
+        return Header(s, block_height)
+
+    def raw_header(self, header):
+        '''Return the raw 80 bytes of a Header or a header dict.'''
+        if isinstance(header, Header):
+            return header.raw
+        return Header.from_dict(header).raw
 
     def hash_header(self, header):
+        return hash_encode(Hash(self.raw_header(header)))
+
+    def bits_to_target(self, bits):
+        MM = 256*256*256
+        a = bits%MM
+        if a < 0x8000:
+            a *= 256
+        target = (a) * pow(2, 8 * (bits/MM - 3))
+        return target
+
+    def header_work(self, header):
+        '''Expected number of hashes needed to find header.'''
+        return (1 << 256) / (self.bits_to_target(header.get('bits')) + 1)
+
+    def invalidate_targets(self, height):
+        '''Called when the saved headers from height up are replaced.'''
         pass
 
-    def save_chunk(self, index, chunk):
-        pass
+    def pow_hash_header(self, header):
+        return hash_encode(self.pow_hash_function(self.raw_header(header)))
+
+    def set_pow_workers(self, workers):
+        workers = max(1, int(workers))
+        if workers != self.pow_workers and self.pow_pool is not None:
+            self.pow_pool.close()
+            self.pow_pool = None
+        self.pow_workers = workers
+
+    def pow_hashes(self, raw_headers):
+        '''PoW hashes of a list of raw headers, as hex strings.
+
+        With more than one PoW worker, the hashes are computed in a process
+        pool; otherwise they are computed here, one after the other, or all
+        together if the chain has a pow_batch_function.
+        '''
+        if self.pow_workers > 1 and len(raw_headers) > 1:
+            if self.pow_pool is None:
+                self.pow_pool = PoWPool(self.pow_workers)
+            if self.pow_batch_function is not None:
+                hashes = self.pow_pool.map_batches(self.pow_batch_function, raw_headers)
+            else:
+                hashes = self.pow_pool.map(self.pow_hash_function, raw_headers)
+        elif self.pow_batch_function is not None:
+            hashes = self.pow_batch_function(raw_headers)
+        else:
+            hashes = map(self.pow_hash_function, raw_headers)
+        return map(hash_encode, hashes)
 
-    def save_header(self, header):
-        pass
+    def save_chunk(self, index, chunk):
+        self.header_store.write(index*self.chunk_size, chunk)
+        self.header_store.flush(sync=True)
+
+    def save_header(self, header, height=None):
+        data = self.header_to_string(header).decode('hex')
+        assert len(data) == 80
+        if height is None: height = header.get('block_height')
+        self.header_store.write(height, data)
+
+    def save_headers(self, headers):
+        '''Save a list of contiguous headers in one write.'''
+        if not headers:
+            return
+        data = ''.join(self.raw_header(h) for h in headers)
+        self.header_store.write(headers[0].get('block_height'), data)
+        self.header_store.flush(sync=True)
 
     def read_header(self, block_height):
-        pass
+        if self.header_store is None:
+            return None
+        h = self.header_store.read(block_height)
+        if h is not None:
+            return self.header_from_string(h, block_height)
+
+    def branch_header(self, height, chain):
+        '''The header at height on the branch ending with chain.
+
+        chain holds the headers of the branch above its fork point, which
+        take precedence over the saved main branch at the same heights.
+        '''
+        for header in chain:
+            if header.get('block_height') == height:
+                return header
+        return self.read_header(height)
 
     # Calculate the difficulty target
     def get_target(self, index, chain=None):
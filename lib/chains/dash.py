@@ -72,6 +72,7 @@ class Dash(CryptoCur):
         data = hexdata.decode('hex')
         height = index*2016
         num = len(data)/80
+        self.verify_checkpoints(index, data)
 
         if index == 0:
             previous_hash = ("0"*64)
@@ -85,10 +86,10 @@ class Dash(CryptoCur):
         for i in range(num):
             height = index*2016 + i
             raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
+            header = self.header_from_string(raw_header, height)
             _hash = self.hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-#            assert bits == header.get('bits')
+            assert previous_hash == header.prev_block_hash
+#            assert bits == header.bits
 #            assert int('0x'+_hash,16) < target
 
             previous_header = header
@@ -98,60 +99,9 @@ class Dash(CryptoCur):
 #        print_error("validated chunk %d"%height)
 
 
-    def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
-
-    def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
-
-
     def hash_header(self, header):
-        return rev_hex(HashX11(self.header_to_string(header).decode('hex')).encode('hex'))
-
-
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
-
-
-    def save_header(self, header):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
-
-
-    def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
+        return hash_encode(HashX11(self.raw_header(header)))
+
 
     def get_target(self, index, chain=None):
         if chain is None:
@@ -160,12 +110,8 @@ class Dash(CryptoCur):
         max_target = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
         if index == 0: return 0x1d00ffff, max_target
 
-        first = self.read_header((index-1)*2016)
-        last = self.read_header(index*2016-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == index*2016-1:
-                    last = h
+        first = self.branch_header((index-1)*2016, chain)
+        last = self.branch_header(index*2016-1, chain)
 
         nActualTimespan = last.get('timestamp') - first.get('timestamp')
         nTargetTimespan = 24*60*60
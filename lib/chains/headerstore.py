@@ -0,0 +1,130 @@
+'''Memory-mapped storage for a blockchain_headers file.'''
+
+import os, mmap, threading
+
+HEADER_SIZE = 80
+
+
+class HeaderStore(object):
+    '''Serves 80-byte headers by height from a memory-mapped headers file.
+
+    The file stays mapped between reads, so looking up a header is a slice
+    of the map rather than an open/seek/read/close on every call. Writes go
+    through a file handle that stays open until close(). They are flushed
+    before the next read and synced to disk at flush(sync=True); callers
+    pick those points, e.g. once per verified chunk. The number of headers
+    is tracked as they are written, so size() does not stat the file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._map = None
+        self._mapped = 0    # bytes covered by the map
+        self._size = 0      # bytes in the file
+        self._file = None
+        self._dirty = False
+        if os.path.exists(path):
+            self._size = os.path.getsize(path)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._mapped = 0
+
+    def _remap(self):
+        self._unmap()
+        self._flush()
+        # mmap refuses to map an empty file
+        if self._size == 0:
+            return
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = len(self._map)
+
+    def _handle(self):
+        if self._file is None:
+            self._file = open(self.path, 'rb+')
+        return self._file
+
+    def _flush(self):
+        if self._dirty:
+            self._file.flush()
+            self._dirty = False
+
+    def size(self):
+        '''Number of complete headers in the file.'''
+        with self.lock:
+            return self._size / HEADER_SIZE
+
+    def read(self, height):
+        '''Return the raw 80-byte header at height, or None.'''
+        if height < 0:
+            return None
+        offset = height * HEADER_SIZE
+        with self.lock:
+            if offset + HEADER_SIZE > self._size:
+                # the file may have been extended by another writer
+                if not os.path.exists(self.path) or os.path.getsize(self.path) == self._size:
+                    return None
+                self._size = os.path.getsize(self.path)
+                if offset + HEADER_SIZE > self._size:
+                    return None
+            if offset + HEADER_SIZE > self._mapped:
+                self._remap()
+            else:
+                self._flush()
+            return self._map[offset:offset + HEADER_SIZE]
+
+    def read_range(self, height, count):
+        '''Return the raw headers from height, up to count of them.'''
+        with self.lock:
+            end = min(self.size(), height + count)
+            if height < 0 or height >= end:
+                return ''
+            self.read(end - 1)
+            return self._map[height * HEADER_SIZE:end * HEADER_SIZE]
+
+    def write(self, height, data):
+        '''Write one or more contiguous raw headers starting at height.'''
+        assert len(data) % HEADER_SIZE == 0
+        with self.lock:
+            f = self._handle()
+            f.seek(height * HEADER_SIZE)
+            f.write(data)
+            self._dirty = True
+            self._size = max(self._size, height * HEADER_SIZE + len(data))
+
+    def append(self, data):
+        '''Write contiguous raw headers after the last one in the file.'''
+        with self.lock:
+            self.write(self.size(), data)
+
+    def flush(self, sync=False):
+        '''Push pending writes to the OS, and to disk if sync is set.'''
+        with self.lock:
+            if self._file is None:
+                return
+            self._flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def truncate(self, height):
+        '''Discard every header at or above height.'''
+        with self.lock:
+            # some platforms refuse to resize a file while it is mapped
+            self._unmap()
+            f = self._handle()
+            self._flush()
+            f.seek(max(0, height) * HEADER_SIZE)
+            f.truncate()
+            self._size = min(self._size, max(0, height) * HEADER_SIZE)
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+            if self._file is not None:
+                self.flush(sync=True)
+                self._file.close()
+                self._file = None
@@ -0,0 +1,133 @@
+'''In-memory tree of the most recent headers and their competing branches.'''
+
+
+class HeaderNode(object):
+    __slots__ = ('header', 'hash', 'height', 'prev_hash', 'chainwork')
+
+    def __init__(self, header, hash, height, prev_hash, chainwork):
+        self.header = header
+        self.hash = hash
+        self.height = height
+        self.prev_hash = prev_hash
+        self.chainwork = chainwork
+
+
+class HeaderTree(object):
+    '''Recent headers keyed by block hash, with the work of each branch.
+
+    The main branch is the one saved in the headers file. The tree is
+    anchored at the header depth blocks below the main tip; chainwork is
+    counted from there, which is enough to compare branches that fork
+    above it. Forks below the anchor are not followed.
+    '''
+
+    def __init__(self, chain, depth):
+        self.chain = chain
+        self.depth = depth
+        self.clear()
+
+    def clear(self):
+        self.nodes = {}         # hash -> HeaderNode
+        self.main = {}          # height -> hash, for the main branch
+        self.anchor = None
+        self.tip = None
+
+    def load(self, height):
+        '''Rebuild the tree from the saved headers up to height.'''
+        self.clear()
+        start = max(0, height - self.depth)
+        for h in range(start, height + 1):
+            header = self.chain.read_header(h)
+            if header is None:
+                break
+            node = self._make_node(header, h, self.nodes.get(header.get('prev_block_hash')))
+            self.nodes[node.hash] = node
+            self.main[h] = node.hash
+            if self.anchor is None:
+                self.anchor = node
+            self.tip = node
+
+    def _make_node(self, header, height, parent):
+        work = self.chain.header_work(header)
+        chainwork = parent.chainwork + work if parent is not None else work
+        return HeaderNode(header, self.chain.hash_header(header), height,
+                          header.get('prev_block_hash'), chainwork)
+
+    def __contains__(self, hash):
+        return hash in self.nodes
+
+    def get(self, hash):
+        return self.nodes.get(hash)
+
+    def base_height(self):
+        '''Lowest height a header may have to be added.'''
+        return self.anchor.height + 1 if self.anchor is not None else 0
+
+    def add(self, header):
+        '''Add a header whose parent is in the tree. Return its node.'''
+        parent = self.nodes.get(header.get('prev_block_hash'))
+        assert parent is not None
+        node = self.nodes.get(self.chain.hash_header(header))
+        if node is None:
+            node = self._make_node(header, parent.height + 1, parent)
+            self.nodes[node.hash] = node
+        return node
+
+    def best(self):
+        '''The node with the most chainwork; the main tip wins ties.'''
+        best = self.tip
+        for node in self.nodes.itervalues():
+            if best is None or node.chainwork > best.chainwork:
+                best = node
+        return best
+
+    def branch(self, hash):
+        '''Headers from just above the main branch up to hash, in order.'''
+        out = []
+        node = self.nodes.get(hash)
+        while node is not None and self.main.get(node.height) != node.hash:
+            out.append(node.header)
+            node = self.nodes.get(node.prev_hash)
+        out.reverse()
+        return out
+
+    def set_main(self, hash):
+        '''Make the branch ending at hash the main one.
+
+        Return the height of the first header that changed, or None if the
+        branch was already the main one.
+        '''
+        node = self.nodes[hash]
+        fork_height = None
+        for h in [h for h in self.main if h > node.height]:
+            del self.main[h]
+            fork_height = h if fork_height is None else min(fork_height, h)
+        while self.main.get(node.height) != node.hash:
+            self.main[node.height] = node.hash
+            fork_height = node.height
+            node = self.nodes[node.prev_hash]
+        self.tip = self.nodes[hash]
+        self.prune()
+        return fork_height
+
+    def prune(self):
+        '''Drop the headers that are now too deep below the main tip.'''
+        if self.tip is None or self.tip.height - self.anchor.height <= self.depth:
+            return
+        base = self.tip.height - self.depth
+        for h in [h for h in self.main if h < base]:
+            del self.main[h]
+        for hash, node in self.nodes.items():
+            if node.height < base:
+                del self.nodes[hash]
+        self.anchor = self.nodes[self.main[base]]
+        # branches forking below the anchor can never be followed
+        for hash, node in self.nodes.items():
+            if node.height == base and node is not self.anchor:
+                del self.nodes[hash]
+        orphans = True
+        while orphans:
+            orphans = [hash for hash, node in self.nodes.items()
+                       if node is not self.anchor and node.prev_hash not in self.nodes]
+            for hash in orphans:
+                del self.nodes[hash]
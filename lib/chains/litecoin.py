@@ -3,9 +3,13 @@ from cryptocur import CryptoCur, hash_encode, hash_decode, rev_hex, int_to_hex,
 import os
 try:
     from ltc_scrypt import getPoWHash
+    getPoWHashes = None
 except ImportError:
     print("cannot import ltc_scrypt, using fallback")
     from scrypt import scrypt_1024_1_1_80 as getPoWHash
+    from scrypt import scrypt_1024_1_1_80_batch, numpy
+    # hash whole chunks at once if numpy is available
+    getPoWHashes = scrypt_1024_1_1_80_batch if numpy is not None else None
 
 class Litecoin(CryptoCur):
     PoW = True
@@ -28,6 +32,23 @@ class Litecoin(CryptoCur):
     }
 
 
+    checkpoints = {
+        1500: '841a2965955dd288cfa707a755d05a54e45f8bd476835ec9af4402a2b59a2967',
+        4032: '9ce90e427198fc0ef05e5905ce3503725b80e26afd35a987965fd7e3d9cf0846',
+        8064: 'eb984353fc5190f210651f150c40b8a4bab9eeeff0b729fcb3987da694430d70',
+        16128: '602edf1859b7f9a6af809f1d9b0e6cb66fdc1d4d9dcd7a4bec03e12a1ccd153d',
+        23420: 'd80fdf9ca81afd0bd2b2a90ac3a9fe547da58f2530ec874e978fce0b5101b507',
+        50000: '69dc37eb029b68f075a5012dcc0419c127672adb4f3a32882b2b3e71d07a20a6',
+        80000: '4fcb7c02f676a300503f49c764a89955a8f920b46a8cbecb4867182ecdb2e90a',
+        120000: 'bd9d26924f05f6daa7f0155f32828ec89e8e29cee9e7121b026a7a3552ac6131',
+        161500: 'dbe89880474f4bb4f75c227c77ba1cdc024991123b28b8418dbbf7798471ff43',
+        179620: '2ad9c65c990ac00426d18e446e0fd7be2ffa69e9a7dcb28358a50b2b78b9f709',
+        240000: '7140d1c4b4c2157ca217ee7636f24c9c73db39c4590c4e6eab2e3ea1555088aa',
+    }
+
+    pow_hash_function = staticmethod(getPoWHash)
+    pow_batch_function = staticmethod(getPoWHashes) if getPoWHashes else None
+
     DEFAULT_PORTS = {'t':'50001', 's':'50002', 'h':'8081', 'g':'8082'}
 
     DEFAULT_SERVERS = {
@@ -76,6 +97,7 @@ class Litecoin(CryptoCur):
         data = hexdata.decode('hex')
         height = index*2016
         num = len(data)/80
+        self.verify_checkpoints(index, data)
 
         if index == 0:  
             previous_hash = ("0"*64)
@@ -86,13 +108,15 @@ class Litecoin(CryptoCur):
 
         bits, target = self.get_target(index)
 
+        raw_headers = [data[i*80:(i+1)*80] for i in range(num)]
+        pow_hashes = self.pow_hashes(raw_headers)
+
         for i in range(num):
             height = index*2016 + i
-            raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
-            _hash = self.pow_hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
+            header = self.header_from_string(raw_headers[i], height)
+            _hash = pow_hashes[i]
+            assert previous_hash == header.prev_block_hash
+            assert bits == header.bits
             assert int('0x'+_hash,16) < target
 
             previous_header = header
@@ -100,62 +124,6 @@ class Litecoin(CryptoCur):
 
         self.save_chunk(index, data)
 
-    def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
-
-
-    def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
-
-    def hash_header(self, header):
-        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
-
-    def pow_hash_header(self, header):
-        return rev_hex(getPoWHash(self.header_to_string(header).decode('hex')).encode('hex'))
-
-
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
-
-    def save_header(self, header):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
-
-    def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
-
     def get_target(self, index, chain=[]):
 
         max_target = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
@@ -163,14 +131,10 @@ class Litecoin(CryptoCur):
 
         # Litecoin: go back the full period unless it's the first retarget
         if index == 1:
-            first = self.read_header(0)
+            first = self.branch_header(0, chain)
         else:
-            first = self.read_header((index-1)*2016-1)
-        last = self.read_header(index*2016-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == index*2016-1:
-                    last = h
+            first = self.branch_header((index-1)*2016-1, chain)
+        last = self.branch_header(index*2016-1, chain)
 
         nActualTimespan = last.get('timestamp') - first.get('timestamp')
         nTargetTimespan = 84*60*60
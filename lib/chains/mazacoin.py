@@ -1,6 +1,7 @@
 '''Chain-specific Mazacoin code'''
 from cryptocur import CryptoCur, hash_encode, hash_decode, rev_hex, int_to_hex, sha256, Hash
 import os
+import collections
 
 class Mazacoin(CryptoCur):
     PoW = True
@@ -37,35 +38,98 @@ class Mazacoin(CryptoCur):
         'tate.cryptoadhd.com':DEFAULT_PORTS,
     }
 
-    # Used on chain reorg
-    def reorg_handler(self, local_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb+')
-            f.seek((local_height*80) - (self.COINBASE_MATURITY * 80))
-            f.truncate()
-            f.close()
+    # Height at which Dark Gravity Wave 3 retargeting starts
+    DGW3_HEIGHT = 100000
+    # v1 parameters
+    nTargetSpacing = 120
+    interval = 8 * 60 / nTargetSpacing          # 4
+    nAveragingInterval = interval * 20          # 80
+    # DGW3 parameters
+    PastBlocksMin = 24
+    PastBlocksMax = 24
+    # Number of headers kept in the target window; v1 looks back
+    # nAveragingInterval headers from the last interval boundary
+    WINDOW = nAveragingInterval + interval
+
+    def __init__(self):
+        # {height : (bits, target)}
+        self.targets = {}
+        # (timestamp, bits, target) of the headers below window_height
+        self.window = collections.deque(maxlen=self.WINDOW)
+        self.window_height = None
+
+    def invalidate_targets(self, height):
+        '''Forget the targets and window computed from headers at or above height.'''
+        for h in [h for h in self.targets if h >= height]:
+            del self.targets[h]
+        self.window.clear()
+        self.window_height = None
+
+    def push_header(self, header, height):
+        '''Slide the target window past a verified header.'''
+        if self.window_height != height:
+            return
+        bits = header.get('bits')
+        self.window.append((header.get('timestamp'), bits, self.bits_to_target(bits)))
+        self.window_height = height + 1
+
+    def load_window(self, block_height, chain):
+        '''Fill the target window with the headers below block_height, on
+        the branch ending with chain.'''
+        by_height = dict((h.get('block_height'), h) for h in chain)
+        self.window.clear()
+        self.window_height = max(0, block_height - self.WINDOW)
+        for height in range(self.window_height, block_height):
+            header = by_height.get(height)
+            if header is None:
+                header = self.read_header(height)
+            if header is None:
+                # leave the window empty, to be loaded again
+                self.window.clear()
+                self.window_height = None
+                return
+            self.push_header(header, height)
+
+    def window_entry(self, height):
+        '''(timestamp, bits, target) of the header at height, from the window.'''
+        if self.window_height is None:
+            return None
+        first = self.window_height - len(self.window)
+        if height < first or height >= self.window_height:
+            return None
+        return self.window[height - first]
 
     def verify_chain(self, chain):
 
         first_header = chain[0]
         prev_header = self.read_header(first_header.get('block_height') -1)
 
-        for header in chain:
-
-            height = header.get('block_height')
-
-            prev_hash = self.hash_header(prev_header)
-            bits, target = self.get_target(height, chain)
-            _hash = self.hash_header(header)
-            try:
-                assert prev_hash == header.get('prev_block_hash')
-                assert bits == header.get('bits')
-                assert int('0x'+_hash,16) < target
-            except Exception:
-                return False
-
-            prev_header = header
+        # the branch may fork from the saved headers and may never be
+        # selected: compute its targets in a window of its own, and keep
+        # the ones of the saved branch for verify_chunk
+        saved = self.targets, self.window, self.window_height
+        self.targets = {}
+        self.window = collections.deque(maxlen=self.WINDOW)
+        self.window_height = None
+        try:
+            for header in chain:
+
+                height = header.get('block_height')
+
+                prev_hash = self.hash_header(prev_header)
+                bits, target = self.get_target(height, chain)
+                _hash = self.hash_header(header)
+                try:
+                    assert prev_hash == header.get('prev_block_hash')
+                    assert bits == header.get('bits')
+                    assert int('0x'+_hash,16) < target
+                except Exception:
+                    return False
+
+                self.push_header(header, height)
+                prev_header = header
+        finally:
+            self.targets, self.window, self.window_height = saved
 
         return True
 
@@ -73,6 +137,7 @@ class Mazacoin(CryptoCur):
         data = hexdata.decode('hex')
         height = index*self.chunk_size
         num = len(data)/80
+        self.verify_checkpoints(index, data)
 
         if index == 0:
             previous_hash = ("0"*64)
@@ -81,88 +146,27 @@ class Mazacoin(CryptoCur):
             if prev_header is None: raise
             previous_hash = self.hash_header(prev_header)
 
-#        bits, target = self.get_target(index)
+        if self.window_height is not None and height < self.window_height:
+            # this chunk is being verified again
+            self.invalidate_targets(height)
 
         for i in range(num):
             height = index*self.chunk_size + i
             bits, target = self.get_target(height)
             raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
+            header = self.header_from_string(raw_header, height)
             _hash = self.hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
+            assert previous_hash == header.prev_block_hash
+            assert bits == header.bits
             assert int('0x'+_hash,16) < target
 
-            self.save_header(header, height)
+            self.push_header(header, height)
             previous_header = header
             previous_hash = _hash
 
-#        self.save_chunk(index, data)
+        self.save_chunk(index, data)
 #        print_error("validated chunk %d"%height)
 
-    def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
-
-
-    def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
-
-    def hash_header(self, header):
-        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
-
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*self.chunk_size*80)
-        h = f.write(chunk)
-        f.close()
-#        self.set_local_height()
-
-    def save_header(self, header, height=None):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        if height is None: height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
-#        self.set_local_height()
-
-
-    def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
-
-    def bits_to_target(self, bits):
-        MM = 256*256*256
-        a = bits%MM
-        if a < 0x8000:
-            a *= 256
-        target = (a) * pow(2, 8 * (bits/MM - 3))
-        return target
-
     def target_to_bits(self, target):
         MM = 256*256*256
         c = ("%064X"%target)[2:]
@@ -181,132 +185,73 @@ class Mazacoin(CryptoCur):
 
 
 
-    def get_target_v1(self, block_height, chain=None):
+    def get_target_v1(self, block_height):
         # params
-        nTargetTimespan = 8 * 60
-        nTargetSpacing = 120
-        interval = nTargetTimespan / nTargetSpacing # 4
-        nAveragingInterval = interval * 20 # 80
-        nAveragingTargetTimespan = nAveragingInterval * nTargetSpacing # 9600
+        nAveragingTargetTimespan = self.nAveragingInterval * self.nTargetSpacing # 9600
         nMaxAdjustDown = 20
         nMaxAdjustUp = 15
         nMinActualTimespan = nAveragingTargetTimespan * (100 - nMaxAdjustUp) / 100
         nMaxActualTimespan = nAveragingTargetTimespan * (100 + nMaxAdjustDown) / 100
 
-
-        if chain is None:
-            chain = []  # Do not use mutables as default values!
-
 # btc        max_target = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
         max_target = 0x00000FFFF0000000000000000000000000000000000000000000000000000000
         if block_height == 0: return 0x1e0ffff0, max_target
 
         # Start diff
         start_target = 0x00000003FFFF0000000000000000000000000000000000000000000000000000
-        if block_height < nAveragingInterval: return 0x1d03ffff, start_target
-
-        last = self.read_header(block_height-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == block_height-1:
-                    last = h
-
+        if block_height < self.nAveragingInterval: return 0x1d03ffff, start_target
 
         # Only change on each interval
-        if not block_height % interval == 0:
-            return self.get_target_v1(block_height-1, chain)
-
+        block_height -= block_height % self.interval
+        if block_height < self.nAveragingInterval: return 0x1d03ffff, start_target
 
+        last = self.window_entry(block_height-1)
         # first = go back by averagingInterval
-        first = self.read_header((block_height-1)-(nAveragingInterval-1))
-        if first is None:
-            for fh in chain:
-                if fh.get('block_height') == (block_height-1)-(nAveragingInterval-1):
-                    first = fh
-
+        first = self.window_entry((block_height-1)-(self.nAveragingInterval-1))
 
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
+        nActualTimespan = last[0] - first[0]
         nActualTimespan = max(nActualTimespan, nMinActualTimespan)
         nActualTimespan = min(nActualTimespan, nMaxActualTimespan)
 
-        bits = last.get('bits')
-        # convert to bignum
-        MM = 256*256*256
-        a = bits%MM
-        if a < 0x8000:
-            a *= 256
-        target = (a) * pow(2, 8 * (bits/MM - 3))
+        target = last[2]
 
         # new target
         new_target = min( max_target, (target * nActualTimespan)/nAveragingTargetTimespan )
 
-        # convert it to bits
-        c = ("%064X"%new_target)[2:]
-        i = 31
-        while c[0:2]=="00":
-            c = c[2:]
-            i -= 1
-
-        c = int('0x'+c[0:6],16)
-        if c >= 0x800000:
-            c /= 256
-            i += 1
-
-        new_bits = c + MM * i
+        new_bits = self.target_to_bits(new_target)
         return new_bits, new_target
 
 
-    def get_target_dgw3(self, block_height, chain=None):
-        if chain is None:
-            chain = []
-
-        last = self.read_header(block_height-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == block_height-1:
-                    last = h
-
+    def get_target_dgw3(self, block_height):
         # params
-        BlockLastSolved = last
-        BlockReading = last
-        BlockCreating = block_height
         nActualTimespan = 0
         LastBlockTime = 0
-        PastBlocksMin = 24
-        PastBlocksMax = 24
         CountBlocks = 0
         PastDifficultyAverage = 0
         PastDifficultyAveragePrev = 0
-        bnNum = 0
 
         max_target = 0x00000FFFF0000000000000000000000000000000000000000000000000000000
 
-        if BlockLastSolved is None or block_height-1 < PastBlocksMin:
+        if block_height-1 < self.PastBlocksMin or self.window_entry(block_height-1) is None:
             return 0x1e0ffff0, max_target
-        for i in range(1, PastBlocksMax + 1):
+        for i in range(1, self.PastBlocksMax + 1):
+            timestamp, bits, bnNum = self.window_entry(block_height - i)
             CountBlocks += 1
 
-            if CountBlocks <= PastBlocksMin:
+            if CountBlocks <= self.PastBlocksMin:
                 if CountBlocks == 1:
-                    PastDifficultyAverage = self.bits_to_target(BlockReading.get('bits'))
+                    PastDifficultyAverage = bnNum
                 else:
-                    bnNum = self.bits_to_target(BlockReading.get('bits'))
                     PastDifficultyAverage = ((PastDifficultyAveragePrev * CountBlocks)+(bnNum)) / (CountBlocks + 1)
                 PastDifficultyAveragePrev = PastDifficultyAverage
 
             if LastBlockTime > 0:
-                Diff = (LastBlockTime - BlockReading.get('timestamp'))
+                Diff = (LastBlockTime - timestamp)
                 nActualTimespan += Diff
-            LastBlockTime = BlockReading.get('timestamp')
-
-            BlockReading = self.read_header((block_height-1) - CountBlocks)
-            if BlockReading is None:
-                for br in chain:
-                    if br.get('block_height') == (block_height-1) - CountBlocks:
-                        BlockReading = br
+            LastBlockTime = timestamp
 
         bnNew = PastDifficultyAverage
-        nTargetTimespan = CountBlocks * 120
+        nTargetTimespan = CountBlocks * self.nTargetSpacing
 
         nActualTimespan = max(nActualTimespan, nTargetTimespan/3)
         nActualTimespan = min(nActualTimespan, nTargetTimespan*3)
@@ -321,15 +266,30 @@ class Mazacoin(CryptoCur):
         return new_bits, bnNew
 
     def get_target(self, block_height, chain=None):
+        '''Return (bits, target) for the header at block_height.
+
+        Targets are cached by height. They are computed from a window of the
+        headers below block_height, which verify_chunk() and verify_chain()
+        slide forward one header at a time, so only the first header of a
+        run needs the window loaded from disk.
+        '''
         if chain is None:
             chain = []  # Do not use mutables as default values!
 
-        DiffMode = 1
-        if block_height >= 100000: DiffMode = 2
+        out = self.targets.get(block_height)
+        if out is not None:
+            return out
 
-        if DiffMode == 1: return self.get_target_v1(block_height, chain)
-        elif DiffMode == 2: return self.get_target_dgw3(block_height, chain)
+        if self.window_height != block_height:
+            self.load_window(block_height, chain)
 
-        return self.get_target_dgw3(block_height, chain)
+        if block_height >= self.DGW3_HEIGHT:
+            out = self.get_target_dgw3(block_height)
+        else:
+            out = self.get_target_v1(block_height)
+        # a window that could not be loaded gives a placeholder target
+        if self.window_height == block_height:
+            self.targets[block_height] = out
+        return out
 
 Currency = Mazacoin
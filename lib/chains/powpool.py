@@ -0,0 +1,31 @@
+'''Process pool for computing Proof-of-Work hashes of many headers.'''
+
+import multiprocessing
+
+
+class PoWPool(object):
+    '''Splits the PoW hashes of a chunk across worker processes.
+
+    Only the hashing is done in the workers; checking that headers link
+    together and meet their target stays with the caller, in order.
+    '''
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = multiprocessing.Pool(workers)
+
+    def map(self, hash_function, raw_headers):
+        '''Return hash_function(h) for each raw header, in order.'''
+        # a few batches per worker keeps them busy without much IPC
+        chunksize = max(1, len(raw_headers) / (self.workers * 4))
+        return self.pool.map(hash_function, raw_headers, chunksize)
+
+    def map_batches(self, batch_function, raw_headers):
+        '''Like map, for a function hashing a whole list of headers.'''
+        size = -(-len(raw_headers) // self.workers)
+        batches = [raw_headers[i:i + size] for i in xrange(0, len(raw_headers), size)]
+        return sum(self.pool.map(batch_function, batches, 1), [])
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
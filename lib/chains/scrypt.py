@@ -18,6 +18,14 @@
 
 import hashlib
 import hmac
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of headers hashed together by scrypt_1024_1_1_80_batch.
+# Each one needs a 128 KiB scratchpad.
+BATCH_SIZE = 256
 
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, str) or len(header) != 80:
@@ -245,22 +253,73 @@ def _xor_salsa8_2(X):
 
 
 
-if __name__ == '__main__':
+def scrypt_1024_1_1_80_batch(headers):
+    """scrypt_1024_1_1_80 of each header in a list, using NumPy.
 
-    vectors = [
-        ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
-        ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
-        ("010000000000000000000000000000000000000000000000000000000000000000000000d9ced4ed1130f7b7faad9be25323ffafa33232a17c3edf6cfd97bee6bafbdd97b9aa8e4ef0ff0f1ecd513f7c", "001e67b013726fd7382e9acb69165b4b6316227fb3156b5b414ba6340c050000"),
-        ("01000000ae178934851bfa0e83ccb6a3fc4bfddff3641e104b6c4680c31509074e699be2bd672d8d2199ef37a59678f92443083e3b85edef8b45c71759371f823bab59a97126614f44d5001d45920180", "01796dae1f78a72dfb09356db6f027cd884ba0201e6365b72aa54b3b00000000"),
-        ("020000008f49e5fd7ef50db9a2a1bff5d3e93717a096329a8ac802a248463ef366ceea1099b1fd0db4ce8f4728251711f759081d0b5b4da015fb78421d8ffbfda1105a2abda1db521b64101b00e60cd0", "461ae94540dc88c9bffbf42bb47e46a2416280adbeeb1d883c18090000000000"),
-    ]
+    The salsa20/8 rounds operate on uint32 arrays with one element per
+    header, so a whole batch goes through each round at once.
+    """
+    for header in headers:
+        if not isinstance(header, str) or len(header) != 80:
+            raise ValueError('header must be an 80-byte string')
+
+    result = []
+    V = None
+    for start in xrange(0, len(headers), BATCH_SIZE):
+        batch = headers[start:start + BATCH_SIZE]
+        n = len(batch)
+        if V is None or V.shape[0] != n:
+            V = numpy.empty((n, 1024, 32), dtype=numpy.uint32)
+        macs = [hmac.new(header, digestmod=hashlib.sha256) for header in batch]
+
+        B = []
+        for header, mac in zip(batch, macs):
+            for i in xrange(4):
+                m = mac.copy()
+                m.update(header + '\0\0\0' + chr(i + 1))
+                B.append(m.digest())
+        X = numpy.frombuffer(''.join(B), dtype='<u4').astype(numpy.uint32).reshape(n, 32)
+        # one row per word, one column per header
+        X = numpy.ascontiguousarray(X.T)
 
-    from timeit import default_timer
-    t0 = default_timer()
+        for i in xrange(1024):
+            V[:, i, :] = X.T
+            _xor_salsa8_2_batch(X)
 
-    for header, hash in vectors:
-        assert scrypt_1024_1_1_80(header.decode('hex')) == hash.decode('hex')
+        rows = numpy.arange(n)
+        for i in xrange(1024):
+            k = X[16] & 1023
+            X ^= V[rows, k].T
+            _xor_salsa8_2_batch(X)
+
+        tail = '\0'*3 + '\x01'
+        Bout = X.T.astype('<u4').tostring()
+        for j, mac in enumerate(macs):
+            mac.update(Bout[j*128:(j+1)*128] + tail)
+            result.append(mac.digest())
+    return result
+
+def _salsa8_batch(x):
+    def R(a, b, c, r):
+        t = x[b] + x[c]
+        x[a] ^= (t << r) | (t >> (32 - r))
+    for j in xrange(4):
+        R( 4,  0, 12,  7); R( 8,  4,  0,  9); R(12,  8,  4, 13); R( 0, 12,  8, 18)
+        R( 9,  5,  1,  7); R(13,  9,  5,  9); R( 1, 13,  9, 13); R( 5,  1, 13, 18)
+        R(14, 10,  6,  7); R( 2, 14, 10,  9); R( 6,  2, 14, 13); R(10,  6,  2, 18)
+        R( 3, 15, 11,  7); R( 7,  3, 15,  9); R(11,  7,  3, 13); R(15, 11,  7, 18)
+        R( 1,  0,  3,  7); R( 2,  1,  0,  9); R( 3,  2,  1, 13); R( 0,  3,  2, 18)
+        R( 6,  5,  4,  7); R( 7,  6,  5,  9); R( 4,  7,  6, 13); R( 5,  4,  7, 18)
+        R(11, 10,  9,  7); R( 8, 11, 10,  9); R( 9,  8, 11, 13); R(10,  9,  8, 18)
+        R(12, 15, 14,  7); R(13, 12, 15,  9); R(14, 13, 12, 13); R(15, 14, 13, 18)
 
-    dt = (default_timer() - t0) / len(vectors)
-    print "%.1f ms/hash" % (dt*1000)
-    print "%.2f hash/s" % (1.0 / dt)
+def _xor_salsa8_2_batch(X):
+    """_xor_salsa8_2 on a (32, N) uint32 array, in place."""
+    X[:16] ^= X[16:]
+    t = X[:16].copy()
+    _salsa8_batch(t)
+    X[:16] += t
+    X[16:] ^= X[:16]
+    t = X[16:].copy()
+    _salsa8_batch(t)
+    X[16:] += t
@@ -23,6 +23,8 @@ from util import print_msg, format_satoshis, print_stderr
 from bitcoin import is_valid, hash_160_to_bc_address, hash_160
 from decimal import Decimal
 import bitcoin
+import chainparams
+from simple_config import get_config
 from transaction import Transaction
 
 
@@ -58,6 +60,8 @@ paytomany_syntax = "paytomany <recipient> <amount> [<recipient> <amount> ...]\n<
 signmessage_syntax = 'signmessage <address> <message>\nIf you want to lead or end a message with spaces, or want double spaces inside the message make sure you quote the string. I.e. " Hello  This is a weird String "'
 verifymessage_syntax = 'verifymessage <address> <signature> <message>\nIf you want to lead or end a message with spaces, or want double spaces inside the message make sure you quote the string. I.e. " Hello  This is a weird String "'
 setchain_syntax = 'setchain <chain_code>\nChain code is case-insensitive and in the form BTC, MZC, etc.'
+migratewallet_syntax = 'migratewallet <file>\nCopy the wallet to a new SQLite wallet at <file>. Open it with -w <file>.'
+importheaders_syntax = 'importheaders <file> [workers]\nStop the daemon first. Chunks are verified in <workers> processes, by default one per CPU.'
 
 
 #                command
@@ -115,6 +119,9 @@ register_command('check_seed',           1,-1, False, False, False, 'Check that
 
 register_command('getchain',             0, 0, False, True, False, 'Return the code of the active blockchain')
 register_command('setchain',             1, 1, False, True, False, 'Set the code of the new active blockchain', setchain_syntax)
+register_command('exportheaders',        1, 1, False, False, False, 'Export the headers of the active blockchain to a snapshot file', 'exportheaders <file>')
+register_command('importheaders',        1, 2, False, False, False, 'Verify a headers snapshot and use it for the active blockchain', importheaders_syntax)
+register_command('migratewallet',        1, 1, False, False, False, 'Copy the wallet to an SQLite database', migratewallet_syntax)
 
 class Commands:
 
@@ -268,7 +275,8 @@ class Commands:
 
     def sweep(self, privkey, to_address, fee = 0.0001):
         fee = int(Decimal(fee)*100000000)
-        return Transaction.sweep([privkey], self.network, to_address, fee)
+        workers = self.network.config.get('sign_workers') or 1
+        return Transaction.sweep([privkey], self.network, to_address, fee, workers)
 
     def signmessage(self, address, message):
         return self.wallet.sign_message(address, message, self.password)
@@ -399,6 +407,21 @@ class Commands:
     def getchain(self):
         return self.wallet.active_chain_code
 
+    def exportheaders(self, path):
+        import snapshot
+        return snapshot.export_snapshot(get_config(), chainparams.get_active_chain().code, path)
+
+    def importheaders(self, path, workers=None):
+        import snapshot
+        if workers is not None:
+            workers = int(workers)
+        return snapshot.import_snapshot(get_config(), chainparams.get_active_chain().code, path, workers)
+
+    def migratewallet(self, path):
+        import sqlite_storage
+        from wallet import WalletStorage
+        return sqlite_storage.migrate_wallet(WalletStorage.init_path(get_config()), path)
+
     def setchain(self, chaincode):
         result = self.wallet.set_chain(chaincode)
         if result == False:
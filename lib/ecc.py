@@ -0,0 +1,443 @@
+'''Elliptic curve operations on secp256k1, with a choice of backend.
+
+libsecp256k1 is used through ctypes when the shared library can be found
+on the system; otherwise the operations are done in Python, with a
+precomputed table of multiples of the generator. Both backends take and
+return the same values:
+
+    secret      32-byte big-endian secret exponent
+    public key  serialized public key; results are 65-byte uncompressed
+    digest      32-byte hash that is signed
+    signature   DER encoded, with a low S value
+
+Signatures are deterministic (RFC 6979), so both backends make the same
+signature for the same key and digest.
+'''
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+
+import ecdsa
+import ecdsa.numbertheory
+import ecdsa.rfc6979
+from ecdsa.curves import SECP256k1
+from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
+from ecdsa.ellipticcurve import Point
+from ecdsa.util import string_to_number, number_to_string, sigencode_der, sigdecode_der
+
+from util import print_error
+
+_p = curve_secp256k1.p()
+_r = generator_secp256k1.order()
+
+
+def public_key(point):
+    '''An ecdsa Public_key for point, a point known to be on the curve.
+
+    The constructor of Public_key checks the order of the point with a
+    scalar multiplication, which costs as much as deriving the point.
+    '''
+    key = ecdsa.ecdsa.Public_key.__new__(ecdsa.ecdsa.Public_key)
+    key.curve = curve_secp256k1
+    key.generator = generator_secp256k1
+    key.point = point
+    return key
+
+
+def point_from_pubkey(pubkey):
+    '''The curve point of a serialized public key.'''
+    if pubkey[0] == '\x04' and len(pubkey) == 65:
+        x, y = string_to_number(pubkey[1:33]), string_to_number(pubkey[33:])
+    elif pubkey[0] in '\x02\x03' and len(pubkey) == 33:
+        x = string_to_number(pubkey[1:])
+        y = pow((x * x * x + 7) % _p, (_p + 1) / 4, _p)
+        if (y & 1) != (pubkey[0] == '\x03'):
+            y = _p - y
+    else:
+        raise Exception('invalid public key')
+    if not curve_secp256k1.contains_point(x, y):
+        raise Exception('invalid public key')
+    return Point(curve_secp256k1, x, y, _r)
+
+
+def pubkey_from_point(point):
+    return '\x04' + number_to_string(point.x(), _p) + number_to_string(point.y(), _p)
+
+
+def compress(pubkey):
+    '''Compressed serialization of an uncompressed public key.'''
+    return chr(2 + (ord(pubkey[64]) & 1)) + pubkey[1:33]
+
+
+# Jacobian coordinates: (X, Y, Z) is the affine point (X/Z^2, Y/Z^3).
+# None is the point at infinity. Adding and doubling need no modular
+# inverse; only to_affine does.
+
+def to_jacobian(point):
+    x, y = point
+    return x, y, 1
+
+
+def to_affine(P):
+    if P is None:
+        return None
+    X, Y, Z = P
+    z = pow(Z, _p - 2, _p)
+    z2 = z * z % _p
+    return X * z2 % _p, Y * z2 * z % _p
+
+
+def point_double(P):
+    if P is None:
+        return None
+    X, Y, Z = P
+    if Y == 0:
+        return None
+    YY = Y * Y % _p
+    S = 4 * X * YY % _p
+    M = 3 * X * X % _p
+    X3 = (M * M - 2 * S) % _p
+    Y3 = (M * (S - X3) - 8 * YY * YY) % _p
+    Z3 = 2 * Y * Z % _p
+    return X3, Y3, Z3
+
+
+def point_add(P, Q):
+    if P is None:
+        return Q
+    if Q is None:
+        return P
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    Z1Z1 = Z1 * Z1 % _p
+    U2 = X2 * Z1Z1 % _p
+    S2 = Y2 * Z1 * Z1Z1 % _p
+    if Z2 == 1:
+        # Q is affine, as in the generator table
+        U1, S1 = X1, Y1
+    else:
+        Z2Z2 = Z2 * Z2 % _p
+        U1 = X1 * Z2Z2 % _p
+        S1 = Y1 * Z2 * Z2Z2 % _p
+    if U1 == U2:
+        if S1 != S2:
+            return None
+        return point_double(P)
+    H = (U2 - U1) % _p
+    R = (S2 - S1) % _p
+    HH = H * H % _p
+    HHH = H * HH % _p
+    V = U1 * HH % _p
+    X3 = (R * R - HHH - 2 * V) % _p
+    Y3 = (R * (V - X3) - S1 * HHH) % _p
+    Z3 = H * Z1 % _p
+    if Z2 != 1:
+        Z3 = Z3 * Z2 % _p
+    return X3, Y3, Z3
+
+
+def point_multiply(P, k):
+    '''k * P by double-and-add, for a point P other than the generator.'''
+    R = None
+    for bit in bin(k % _r)[2:]:
+        R = point_double(R)
+        if bit == '1':
+            R = point_add(R, P)
+    return R
+
+
+# k * G is the sum of window digits times 16^i * G, read from a table of
+# 64 rows of the 15 nonzero multiples of 16^i * G: 64 additions and no
+# doubling. The table is built the first time it is needed.
+WINDOW_BITS = 4
+_generator_table = None
+
+def generator_table():
+    global _generator_table
+    if _generator_table is None:
+        table = []
+        base = to_jacobian((generator_secp256k1.x(), generator_secp256k1.y()))
+        for i in range(256 / WINDOW_BITS):
+            row = [None]
+            P = base
+            for j in range(1, 1 << WINDOW_BITS):
+                row.append(P)
+                P = point_add(P, base)
+            # affine points make the additions cheaper
+            table.append([None] + [to_jacobian(to_affine(Q)) for Q in row[1:]])
+            base = P
+        _generator_table = table
+    return _generator_table
+
+
+def generator_multiply(k):
+    '''k * G, in Jacobian coordinates.'''
+    table = generator_table()
+    k %= _r
+    mask = (1 << WINDOW_BITS) - 1
+    R = None
+    i = 0
+    while k:
+        digit = k & mask
+        if digit:
+            R = point_add(R, table[i][digit])
+        k >>= WINDOW_BITS
+        i += 1
+    return R
+
+
+def pubkey_from_jacobian(P):
+    if P is None:
+        raise Exception('point at infinity')
+    x, y = to_affine(P)
+    return '\x04' + number_to_string(x, _p) + number_to_string(y, _p)
+
+
+def to_affine_many(points):
+    '''to_affine of each point, with a single modular inverse for all.'''
+    # Montgomery's trick: invert the product of the Z values once, then
+    # peel the inverse of each Z off it
+    products = []
+    acc = 1
+    for X, Y, Z in points:
+        products.append(acc)
+        acc = acc * Z % _p
+    inv = pow(acc, _p - 2, _p)
+    out = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        z = inv * products[i] % _p
+        inv = inv * Z % _p
+        z2 = z * z % _p
+        out[i] = X * z2 % _p, Y * z2 * z % _p
+    return out
+
+
+def jacobian_from_pubkey(pubkey):
+    point = point_from_pubkey(pubkey)
+    return point.x(), point.y(), 1
+
+
+class PythonBackend(object):
+    '''Pure Python operations, with the generator table for k * G.'''
+
+    name = 'python'
+
+    def pubkey_from_secret(self, secret):
+        return pubkey_from_jacobian(generator_multiply(string_to_number(secret)))
+
+    def pubkey_tweak_add(self, pubkey, tweak):
+        '''The public key of pubkey + tweak * G.'''
+        return pubkey_from_jacobian(point_add(generator_multiply(string_to_number(tweak)), jacobian_from_pubkey(pubkey)))
+
+    def pubkey_tweak_add_many(self, pubkey, tweaks):
+        '''pubkey_tweak_add of one public key with each of tweaks.'''
+        Q = jacobian_from_pubkey(pubkey)
+        points = [point_add(generator_multiply(string_to_number(tweak)), Q) for tweak in tweaks]
+        if None in points:
+            raise Exception('point at infinity')
+        return ['\x04' + number_to_string(x, _p) + number_to_string(y, _p) for x, y in to_affine_many(points)]
+
+    def signing_key(self, secret):
+        '''A key that sign can use, made once for many signatures.'''
+        secexp = string_to_number(secret)
+        if not 0 < secexp < _r:
+            raise Exception('invalid secret')
+        return secexp, self.pubkey_from_secret(secret)
+
+    def sign(self, key, digest):
+        secexp, pubkey = key
+        e = string_to_number(digest)
+        retry = 0
+        while True:
+            # RFC 6979, as python-ecdsa and libsecp256k1 do it
+            k = ecdsa.rfc6979.generate_k(_r, secexp, hashlib.sha256, digest + '\x00' * retry)
+            r = to_affine(generator_multiply(k))[0] % _r
+            s = ecdsa.numbertheory.inverse_mod(k, _r) * (e + r * secexp) % _r
+            if r and s:
+                break
+            retry += 1
+        if s > _r / 2:
+            s = _r - s
+        sig = sigencode_der(r, s, _r)
+        assert self.verify(pubkey, sig, digest)
+        return sig
+
+    def verify(self, pubkey, sig, digest):
+        Q = jacobian_from_pubkey(pubkey)
+        try:
+            r, s = sigdecode_der(sig, _r)
+        except Exception:
+            return False
+        if not (0 < r < _r and 0 < s < _r):
+            return False
+        w = ecdsa.numbertheory.inverse_mod(s, _r)
+        P = point_add(generator_multiply(string_to_number(digest) * w), point_multiply(Q, r * w))
+        return P is not None and to_affine(P)[0] % _r == r
+
+    def recover(self, sig, recid, digest):
+        '''The public key that made sig, a 64-byte r + s signature.'''
+        # SEC 1 v2, 4.1.6
+        r, s = string_to_number(sig[:32]), string_to_number(sig[32:])
+        x = r + (recid / 2) * _r
+        y = pow((x * x * x + 7) % _p, (_p + 1) / 4, _p)
+        if (y * y - x * x * x - 7) % _p:
+            raise Exception('invalid signature')
+        if (y - recid) % 2:
+            y = _p - y
+        inv_r = ecdsa.numbertheory.inverse_mod(r, _r)
+        e = string_to_number(digest)
+        Q = point_add(point_multiply((x, y, 1), s * inv_r), generator_multiply(-e * inv_r))
+        return pubkey_from_jacobian(Q)
+
+
+SECP256K1_CONTEXT_VERIFY = (1 << 0) | (1 << 8)
+SECP256K1_CONTEXT_SIGN = (1 << 0) | (1 << 9)
+SECP256K1_EC_UNCOMPRESSED = (1 << 1)
+
+LIBRARY_NAMES = ['libsecp256k1.so.0', 'libsecp256k1.so', 'libsecp256k1.dylib', 'libsecp256k1-0.dll']
+
+# function -> (restype, argtypes), declared when the library is loaded so
+# that ctypes converts the arguments, the size_t lengths in particular.
+# Contexts are opaque pointers; keys, signatures and byte strings are
+# passed as char buffers.
+_ctx = ctypes.c_void_p
+_buf = ctypes.c_char_p
+_size_p = ctypes.POINTER(ctypes.c_size_t)
+LIBRARY_FUNCTIONS = {
+    'secp256k1_context_create': (ctypes.c_void_p, [ctypes.c_uint]),
+    'secp256k1_ec_pubkey_parse': (ctypes.c_int, [_ctx, _buf, _buf, ctypes.c_size_t]),
+    'secp256k1_ec_pubkey_serialize': (ctypes.c_int, [_ctx, _buf, _size_p, _buf, ctypes.c_uint]),
+    'secp256k1_ec_pubkey_create': (ctypes.c_int, [_ctx, _buf, _buf]),
+    'secp256k1_ec_pubkey_tweak_add': (ctypes.c_int, [_ctx, _buf, _buf]),
+    'secp256k1_ec_seckey_verify': (ctypes.c_int, [_ctx, _buf]),
+    'secp256k1_ecdsa_sign': (ctypes.c_int, [_ctx, _buf, _buf, _buf, ctypes.c_void_p, ctypes.c_void_p]),
+    'secp256k1_ecdsa_signature_serialize_der': (ctypes.c_int, [_ctx, _buf, _size_p, _buf]),
+    'secp256k1_ecdsa_signature_parse_der': (ctypes.c_int, [_ctx, _buf, _buf, ctypes.c_size_t]),
+    'secp256k1_ecdsa_signature_normalize': (ctypes.c_int, [_ctx, _buf, _buf]),
+    'secp256k1_ecdsa_verify': (ctypes.c_int, [_ctx, _buf, _buf, _buf]),
+}
+# left out of some builds of the library
+OPTIONAL_LIBRARY_FUNCTIONS = {
+    'secp256k1_context_randomize': (ctypes.c_int, [_ctx, _buf]),
+    'secp256k1_ecdsa_recoverable_signature_parse_compact': (ctypes.c_int, [_ctx, _buf, _buf, ctypes.c_int]),
+    'secp256k1_ecdsa_recover': (ctypes.c_int, [_ctx, _buf, _buf, _buf]),
+}
+
+
+class LibSecp256k1Backend(object):
+    '''Operations in libsecp256k1, called through ctypes.'''
+
+    name = 'libsecp256k1'
+
+    def __init__(self, lib):
+        self.lib = lib
+        for name, (restype, argtypes) in LIBRARY_FUNCTIONS.items() + OPTIONAL_LIBRARY_FUNCTIONS.items():
+            if name in OPTIONAL_LIBRARY_FUNCTIONS and not hasattr(lib, name):
+                continue
+            # raises AttributeError if the function is missing
+            function = getattr(lib, name)
+            function.restype = restype
+            function.argtypes = argtypes
+        self.ctx = ctypes.c_void_p(lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY))
+        if hasattr(lib, 'secp256k1_context_randomize'):
+            lib.secp256k1_context_randomize(self.ctx, os.urandom(32))
+        self.has_recovery = hasattr(lib, 'secp256k1_ecdsa_recover')
+
+    def parse_pubkey(self, pubkey):
+        key = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, key, pubkey, len(pubkey)):
+            raise Exception('invalid public key')
+        return key
+
+    def serialize_pubkey(self, key):
+        out = ctypes.create_string_buffer(65)
+        size = ctypes.c_size_t(65)
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, ctypes.byref(size), key, SECP256K1_EC_UNCOMPRESSED)
+        return out.raw[:size.value]
+
+    def pubkey_from_secret(self, secret):
+        key = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, key, secret):
+            raise Exception('invalid secret')
+        return self.serialize_pubkey(key)
+
+    def pubkey_tweak_add(self, pubkey, tweak):
+        key = self.parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, key, tweak):
+            raise Exception('invalid tweak')
+        return self.serialize_pubkey(key)
+
+    def pubkey_tweak_add_many(self, pubkey, tweaks):
+        key = self.parse_pubkey(pubkey)
+        out = []
+        for tweak in tweaks:
+            child = ctypes.create_string_buffer(key.raw, 64)
+            if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, child, tweak):
+                raise Exception('invalid tweak')
+            out.append(self.serialize_pubkey(child))
+        return out
+
+    def signing_key(self, secret):
+        if not self.lib.secp256k1_ec_seckey_verify(self.ctx, secret):
+            raise Exception('invalid secret')
+        return secret
+
+    def sign(self, key, digest):
+        sig = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, digest, key, None, None):
+            raise Exception('signing failed')
+        out = ctypes.create_string_buffer(72)
+        size = ctypes.c_size_t(72)
+        self.lib.secp256k1_ecdsa_signature_serialize_der(self.ctx, out, ctypes.byref(size), sig)
+        der = out.raw[:size.value]
+        assert self.verify(self.pubkey_from_secret(key), der, digest)
+        return der
+
+    def verify(self, pubkey, sig, digest):
+        key = self.parse_pubkey(pubkey)
+        s = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_signature_parse_der(self.ctx, s, sig, len(sig)):
+            return False
+        # libsecp256k1 only accepts low S values
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, s, s)
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, s, digest, key) == 1
+
+    def recover(self, sig, recid, digest):
+        if not self.has_recovery:
+            return PythonBackend().recover(sig, recid, digest)
+        s = ctypes.create_string_buffer(65)
+        if not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(self.ctx, s, sig, recid):
+            raise Exception('invalid signature')
+        key = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, key, s, digest):
+            raise Exception('cannot recover public key')
+        return self.serialize_pubkey(key)
+
+
+def load_libsecp256k1():
+    '''LibSecp256k1Backend if the library can be loaded, else None.'''
+    names = list(LIBRARY_NAMES)
+    found = ctypes.util.find_library('secp256k1')
+    if found:
+        names.insert(0, found)
+    for name in names:
+        try:
+            lib = ctypes.cdll.LoadLibrary(name)
+        except OSError:
+            continue
+        try:
+            return LibSecp256k1Backend(lib)
+        except AttributeError:
+            print_error('unusable libsecp256k1:', name)
+    return None
+
+
+backend = load_libsecp256k1() or PythonBackend()
+
+
+def set_backend(b):
+    global backend
+    backend = b
@@ -97,6 +97,7 @@ class Network(threading.Thread):
 
         self.lock = threading.Lock()
         self.num_server = 8 if not self.config.get('oneserver') else 0
+        self.reorg_height = None
         self.blockchain = Blockchain(self.config, self)
         self.interfaces = {}
         self.queue = Queue.Queue()
@@ -168,6 +169,8 @@ class Network(threading.Thread):
             value = self.get_servers()
         elif key == 'interfaces':
             value = self.get_interfaces()
+        elif key == 'reorg':
+            value = self.reorg_height
         return value
 
     def notify(self, key):
@@ -326,6 +329,11 @@ class Network(threading.Thread):
         self.interfaces.pop(i.server)
         self.notify('interfaces')
 
+    def blockchain_reorg(self, height):
+        '''Tell clients that the saved headers were replaced from height up.'''
+        self.reorg_height = height
+        self.notify('reorg')
+
     def new_blockchain_height(self, blockchain_height, i):
         if self.is_connected():
             if self.server_is_lagging():
@@ -493,7 +501,11 @@ class Network(threading.Thread):
             return self.running
 
     def get_header(self, tx_height):
-        return self.blockchain.read_header(tx_height)
+        header = self.blockchain.read_header(tx_height)
+        # headers are sent to clients as JSON
+        if header is not None:
+            header = header.as_dict()
+        return header
 
     def get_local_height(self):
         return self.blockchain.height()
@@ -69,6 +69,7 @@ class NetworkProxy(threading.Thread):
         self.blockchain_height = 0
         self.server_height = 0
         self.interfaces = []
+        self.reorg_height = None
 
     def switch_to_active_chain(self):
 #        print("\nNetworkProxy switch to active chain, waiting for lock")
@@ -135,6 +136,8 @@ class NetworkProxy(threading.Thread):
                 self.servers = value
             elif key == 'interfaces':
                 self.interfaces = value
+            elif key == 'reorg':
+                self.reorg_height = value
             self.trigger_callback(key)
             return
 
@@ -226,6 +229,9 @@ class NetworkProxy(threading.Thread):
     def get_local_height(self):
         return self.blockchain_height
 
+    def get_reorg_height(self):
+        return self.reorg_height
+
     def get_server_height(self):
         return self.server_height
 
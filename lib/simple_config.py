@@ -2,7 +2,7 @@ import ast
 import threading
 import os
 
-from util import user_dir, print_error, print_msg
+from util import user_dir, print_error, print_msg, FlushScheduler, get_flush_interval
 
 import chainparams
 SYSTEM_CONFIG_PATH = "/etc/encompass.conf"
@@ -78,6 +78,9 @@ class SimpleConfig(object):
         # user config.
         self.user_config = read_user_config_function(self.path)
 
+        # set_key saves are coalesced; flush() saves at once
+        self.saver = FlushScheduler(self.save_user_config, get_flush_interval(self))
+
         set_config(self)  # Make a singleton instance of 'self'
 
     def init_path(self):
@@ -106,7 +109,7 @@ class SimpleConfig(object):
             if self.user_config.get(value, None) is None:
                 self.user_config[value] = {}
             if save:
-                self.save_user_config()
+                self.saver.mark_dirty()
         return True
 
     def get_active_chain_code(self, default=None):
@@ -133,7 +136,7 @@ class SimpleConfig(object):
         with self.lock:
             self.user_config[key] = value
             if save:
-                self.save_user_config()
+                self.saver.mark_dirty()
         return
 
     def get_chain_config(self, chaincode):
@@ -160,7 +163,7 @@ class SimpleConfig(object):
                 self.user_config[active_chain_code] = {}
                 self.user_config[active_chain_code][key] = value
             if save:
-                self.save_user_config()
+                self.saver.mark_dirty()
 
         return
 
@@ -183,6 +186,9 @@ class SimpleConfig(object):
             return False
         return True
 
+    def flush(self):
+        self.saver.flush()
+
     def save_user_config(self):
         if not self.path: return
 
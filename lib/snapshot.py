@@ -0,0 +1,140 @@
+'''Export and import checksummed snapshots of a chain's headers file.
+
+A snapshot is a one-line JSON description followed by the raw headers:
+
+    {"chain": "BTC", "count": 2016, "sha256": "..."}\n<count * 80 bytes>
+
+Importing checks the checksum, then verifies the headers the same way a
+sync would: hash linkage in one pass over the whole file, then each chunk
+(targets and Proof-of-Work) in a pool of worker processes. Chunks can be
+verified independently because the headers before them are already in
+the file being imported. Only the parent process writes that file; the
+workers just read it.
+'''
+
+import hashlib
+import json
+import multiprocessing
+import os
+
+import chainparams
+from blockchain import headers_path
+from util import print_error
+
+HEADER_SIZE = 80
+
+
+def export_snapshot(config, code, path):
+    '''Write the headers of chain code to a snapshot file at path.'''
+    with open(headers_path(config, code), 'rb') as f:
+        data = f.read()
+    count = len(data) / HEADER_SIZE
+    data = data[:count * HEADER_SIZE]
+    info = {'chain': code, 'count': count, 'sha256': hashlib.sha256(data).hexdigest()}
+    with open(path, 'wb') as f:
+        f.write(json.dumps(info, sort_keys=True) + '\n')
+        f.write(data)
+    return info
+
+
+def read_snapshot(path):
+    '''Return (info, data) of a snapshot file, checking its checksum.'''
+    with open(path, 'rb') as f:
+        info = json.loads(f.readline())
+        data = f.read()
+    if len(data) != info['count'] * HEADER_SIZE:
+        raise Exception('snapshot is truncated')
+    if hashlib.sha256(data).hexdigest() != info['sha256']:
+        raise Exception('snapshot checksum mismatch')
+    return info, data
+
+
+def verify_links(chain, data):
+    '''Check that every header links to the one before it.'''
+    previous_hash = '0' * 64
+    for height in xrange(len(data) / HEADER_SIZE):
+        header = chain.header_from_string(data[height*HEADER_SIZE:(height+1)*HEADER_SIZE], height)
+        if header.prev_block_hash != previous_hash:
+            return height
+        previous_hash = chain.hash_header(header)
+    return None
+
+
+# chain instance of a worker process, by (code, path)
+_worker_chain = {}
+
+def _close_worker_chain():
+    for chain in _worker_chain.values():
+        chain.header_store.close()
+    _worker_chain.clear()
+
+def _skip_save(index, chunk):
+    pass
+
+def _verify_chunk(args):
+    code, path, index, use_checkpoints = args
+    chain = _worker_chain.get((code, path))
+    if chain is None:
+        chain = chainparams.get_chain_instance(code)
+        chain.set_headers_path(path)
+        chain.use_checkpoints = use_checkpoints
+        # the chunks are already in the file: verify them, don't save them
+        chain.save_chunk = _skip_save
+        _close_worker_chain()
+        _worker_chain[(code, path)] = chain
+    data = chain.header_store.read_range(index * chain.chunk_size, chain.chunk_size)
+    try:
+        if chain.is_checkpointed(index):
+            chain.verify_checkpointed_chunk(index, data.encode('hex'))
+        else:
+            chain.verify_chunk(index, data.encode('hex'))
+    except Exception:
+        return index
+    return None
+
+
+def import_snapshot(config, code, path, workers=None):
+    '''Verify a snapshot and make it the headers file of chain code.'''
+    info, data = read_snapshot(path)
+    if info['chain'].upper() != code.upper():
+        raise Exception('snapshot is for %s, not %s' % (info['chain'], code))
+    chain = chainparams.get_chain_instance(code)
+
+    bad = verify_links(chain, data)
+    if bad is not None:
+        raise Exception('header %d does not link to the previous one' % bad)
+
+    target = headers_path(config, code)
+    if os.path.exists(target) and os.path.getsize(target) / HEADER_SIZE >= info['count']:
+        raise Exception('local headers are already at height %d' % (os.path.getsize(target) / HEADER_SIZE - 1))
+
+    tmp = target + '.import'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        num_chunks = -(-info['count'] // chain.chunk_size)
+        use_checkpoints = not config.get('full_verification')
+        tasks = [(code, tmp, index, use_checkpoints) for index in xrange(num_chunks)]
+        workers = workers or multiprocessing.cpu_count()
+        print_error('verifying %d chunks with %d workers' % (num_chunks, workers))
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                failed = filter(lambda x: x is not None, pool.map(_verify_chunk, tasks, 1))
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            failed = filter(lambda x: x is not None, map(_verify_chunk, tasks))
+            _close_worker_chain()
+        if failed:
+            raise Exception('chunk %d failed verification' % min(failed))
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return {'chain': code, 'height': info['count'] - 1}
@@ -0,0 +1,329 @@
+'''SQLite backend of WalletStorage, for wallets with large histories.
+
+Keys are stored one row each in the kv table. The transactions,
+addr_history, verified_tx3 and tx_outputs keys of each chain are stored
+one row per item in tables of their own. They are read item by item when
+asked for rather than loaded when the wallet is opened, and saving them
+after a new transaction only writes the rows that changed, in a single
+SQLite transaction.
+'''
+
+import json
+import os
+import shutil
+import sqlite3
+import chainparams
+
+from util import print_error, freeze, thaw
+from wallet import WalletStorage, is_sqlite_wallet
+
+# key -> (table, item column, value column)
+TABLES = {
+    'transactions': ('transactions', 'tx_hash', 'raw'),
+    'addr_history': ('addr_history', 'address', 'history'),
+    'verified_tx3': ('verified_tx', 'tx_hash', 'info'),
+    'tx_outputs': ('tx_outputs', 'tx_hash', 'outputs'),
+}
+
+# chain of the keys that are above chains
+ABOVE_CHAIN = ''
+
+
+class SqliteTable(object):
+    '''The value of one of the TABLES keys of a chain, read from its table
+    item by item.
+
+    Items put since the last save are kept in changed, removed ones as
+    None, until save writes them; cleared is set when the whole value was
+    put, so that the rows saved before are dropped. Like the other values
+    of WalletStorage it is read-only, and copy.deepcopy of it returns an
+    ordinary dict. Unlike them it is a live view, which shows the items
+    put after get returned it: it reads under the storage lock, and
+    iterates over a copy of changed, so it can be iterated while items
+    are put.
+    '''
+
+    def __init__(self, db, lock, chain, key):
+        self.db = db
+        self.lock = lock
+        self.chain = chain
+        self.table, self.item, self.value = TABLES[key]
+        self.changed = {}
+        self.cleared = False
+
+    def get(self, k, default=None):
+        with self.lock:
+            if k in self.changed:
+                v = self.changed[k]
+            elif self.cleared:
+                v = None
+            else:
+                row = self.db.execute('SELECT %s FROM %s WHERE chain = ? AND %s = ?' % (self.value, self.table, self.item),
+                                      (self.chain, k)).fetchone()
+                v = None if row is None else freeze(json.loads(row[0]))
+        return default if v is None else v
+
+    def __getitem__(self, k):
+        v = self.get(k)
+        if v is None:
+            raise KeyError(k)
+        return v
+
+    def __contains__(self, k):
+        return self.get(k) is not None
+
+    def keys(self):
+        with self.lock:
+            if self.cleared:
+                keys = set()
+            else:
+                keys = set(k for k, in self.db.execute('SELECT %s FROM %s WHERE chain = ?' % (self.item, self.table),
+                                                        (self.chain,)))
+            for k, v in self.changed.iteritems():
+                if v is None:
+                    keys.discard(k)
+                else:
+                    keys.add(k)
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        with self.lock:
+            if self.cleared:
+                rows = []
+            else:
+                rows = self.db.execute('SELECT %s, %s FROM %s WHERE chain = ?' % (self.item, self.value, self.table),
+                                       (self.chain,)).fetchall()
+            changed = dict(self.changed)
+        for k, v in rows:
+            if k not in changed:
+                yield k, freeze(json.loads(v))
+        for k, v in changed.iteritems():
+            if v is not None:
+                yield k, v
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [v for k, v in self.iteritems()]
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __deepcopy__(self, memo):
+        return dict((k, thaw(v)) for k, v in self.iteritems())
+
+    def set_item(self, k, v):
+        self.changed[k] = None if v is None else freeze(v)
+
+    def replace(self, value):
+        '''Replace all the items with the ones of value.'''
+        if value is self:
+            return
+        changed = dict((k, freeze(v)) for k, v in value.iteritems())
+        self.changed = changed
+        self.cleared = True
+
+    def save(self):
+        '''Write the items changed since the last save.'''
+        if self.cleared:
+            self.db.execute('DELETE FROM %s WHERE chain = ?' % self.table, (self.chain,))
+        changed = [(self.chain, k, json.dumps(v)) for k, v in self.changed.iteritems() if v is not None]
+        removed = [(self.chain, k) for k, v in self.changed.iteritems() if v is None]
+        if changed:
+            self.db.executemany('INSERT OR REPLACE INTO %s (chain, %s, %s) VALUES (?, ?, ?)' % (self.table, self.item, self.value),
+                                changed)
+        if removed:
+            self.db.executemany('DELETE FROM %s WHERE chain = ? AND %s = ?' % (self.table, self.item), removed)
+
+    def saved(self):
+        '''Forget the changed items, once what save wrote is committed.'''
+        self.changed = {}
+        self.cleared = False
+
+
+class SqliteWalletStorage(WalletStorage):
+    '''WalletStorage kept in an SQLite database.
+
+    The keys in TABLES are stored as SqliteTable values, which read their
+    items from the database when asked for; the other keys are loaded
+    when the wallet is opened.
+    '''
+
+    def read(self, path):
+        self.file_exists = os.path.exists(path) and os.path.getsize(path) > 0
+        # (chain, key) -> SqliteTable, including the tables of keys removed since
+        self.tables = {}
+        self.connect(path)
+        for chain, key, value in self.db.execute('SELECT chain, key, value FROM kv'):
+            self.container(chain)[key] = json.loads(value)
+        for key, (table, item, value) in TABLES.items():
+            for chain, in self.db.execute('SELECT DISTINCT chain FROM %s' % table):
+                self.container(chain)[key] = self.get_table(chain, key)
+
+    def connect(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS kv (chain TEXT NOT NULL, key TEXT NOT NULL, '
+                            'value TEXT NOT NULL, PRIMARY KEY (chain, key))')
+            for table, item, value in TABLES.values():
+                self.db.execute('CREATE TABLE IF NOT EXISTS %s (chain TEXT NOT NULL, %s TEXT NOT NULL, '
+                                '%s TEXT NOT NULL, PRIMARY KEY (chain, %s))' % (table, item, value, item))
+        self.set_permissions(path)
+
+    def container(self, chain):
+        if chain == ABOVE_CHAIN:
+            return self.data
+        return self.data.setdefault(chain, {})
+
+    def get_table(self, chain, key):
+        table = self.tables.get((chain, key))
+        if table is None:
+            table = self.tables[(chain, key)] = SqliteTable(self.db, self.lock, chain, key)
+        return table
+
+    def put_above_chain(self, key, value, save = True):
+        if not self.is_chain_dict(key, value):
+            return WalletStorage.put_above_chain(self, key, value, save)
+        with self.lock:
+            WalletStorage.put_above_chain(self, key, dict((k, v) for k, v in value.iteritems() if k not in TABLES), save)
+            for k in TABLES:
+                if k in value:
+                    table = self.get_table(key, k)
+                    table.replace(value[k])
+                    self.data[key][k] = table
+                elif (key, k) in self.tables:
+                    self.tables[(key, k)].replace({})
+
+    def put(self, key, value, save = True):
+        if key not in TABLES:
+            return WalletStorage.put(self, key, value, save)
+        try:
+            active_chain_code = self.config.get_active_chain_code()
+        except:
+            active_chain_code = chainparams.get_active_chain().code
+        with self.lock:
+            table = self.get_table(active_chain_code, key)
+            table.replace(value or {})
+            if value is not None:
+                self.data[active_chain_code][key] = table
+            else:
+                self.data[active_chain_code].pop(key, None)
+            if save:
+                self.saver.mark_dirty()
+
+    def put_item(self, key, item, value, save=True):
+        if key not in TABLES:
+            return WalletStorage.put_item(self, key, item, value, save)
+        try:
+            active_chain_code = self.config.get_active_chain_code()
+        except:
+            active_chain_code = chainparams.get_active_chain().code
+        with self.lock:
+            table = self.get_table(active_chain_code, key)
+            table.set_item(item, value)
+            self.data[active_chain_code][key] = table
+            if save:
+                self.saver.mark_dirty()
+
+    def save_pending(self):
+        '''Write the keys changed since they were last saved.'''
+        self.check_writable()
+        with self.lock:
+            with self.db:
+                for table in self.tables.values():
+                    table.save()
+                for code, key in self.pending_items:
+                    self.save_key(code, key, None, self.data[code].get(key))
+                for (code, key), old in self.pending.items():
+                    if code is None:
+                        new = self.data.get(key)
+                        if self.is_chain_dict(key, new):
+                            # a whole chain was put: save its keys one by one
+                            old = old or {}
+                            for k in set(old) | set(new):
+                                if k not in TABLES:
+                                    self.save_key(key, k, old.get(k), new.get(k))
+                        else:
+                            self.save_key(ABOVE_CHAIN, key, old, new)
+                    else:
+                        self.save_key(code, key, old, self.data.get(code, {}).get(key))
+            # only once they are committed, so that a failed save is retried
+            self.saved()
+
+    def save_key(self, chain, key, old, new):
+        if new is None:
+            if old is not None:
+                self.db.execute('DELETE FROM kv WHERE chain = ? AND key = ?', (chain, key))
+        elif new != old:
+            self.db.execute('INSERT OR REPLACE INTO kv (chain, key, value) VALUES (?, ?, ?)', (chain, key, json.dumps(new)))
+
+    def write(self):
+        '''Save the tables and rewrite the other keys of the database.'''
+        self.check_writable()
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM kv')
+                for table in self.tables.values():
+                    table.save()
+                for key, value in self.data.items():
+                    if self.is_chain_dict(key, value):
+                        for k, v in value.items():
+                            if k not in TABLES:
+                                self.save_key(key, k, None, v)
+                    else:
+                        self.save_key(ABOVE_CHAIN, key, None, value)
+            self.saved()
+
+    def saved(self):
+        for table in self.tables.values():
+            table.saved()
+        self.pending = {}
+        self.pending_items = {}
+
+    def set_path(self, path):
+        '''Save the wallet under path from now on: the database is copied
+        there, then written.'''
+        self.flush()
+        with self.lock:
+            self.db.close()
+            shutil.copyfile(self.path, path)
+            self.path = path
+            self.connect(path)
+            for table in self.tables.values():
+                table.db = self.db
+        self.write()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+
+def migrate_wallet(path, new_path):
+    '''Copy the wallet file at path to a new SQLite wallet at new_path.'''
+    if is_sqlite_wallet(path):
+        raise Exception('%s is already an SQLite wallet' % path)
+    if os.path.exists(new_path):
+        raise Exception('%s already exists' % new_path)
+    source = WalletStorage({'wallet_path': path}, read_only=True)
+    if not source.file_exists:
+        raise Exception('no wallet at %s' % path)
+    target = SqliteWalletStorage({'wallet_path': new_path})
+    for key, value in source.data.items():
+        target.put_above_chain(key, value, False)
+    target.write()
+    target.close()
+    print_error('migrated wallet', path, 'to', new_path)
+    return {'wallet': new_path}
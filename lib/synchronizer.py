@@ -75,7 +75,7 @@ class WalletSynchronizer(threading.Thread):
         for history in self.wallet.history.values():
             if history == ['*']: continue
             for tx_hash, tx_height in history:
-                if self.wallet.transactions.get(tx_hash) is None and (tx_hash, tx_height) not in missing_tx:
+                if tx_hash not in self.wallet.transactions and (tx_hash, tx_height) not in missing_tx:
                     missing_tx.append( (tx_hash, tx_height) )
 
         if missing_tx:
@@ -168,11 +168,15 @@ class WalletSynchronizer(threading.Thread):
                         raise Exception("error: status mismatch: %s"%addr)
 
                     # store received history
-                    self.wallet.receive_history_callback(addr, hist)
+                    added, removed, changed = self.wallet.receive_history_callback(addr, hist)
+                    # added ones are notified once their tx is received,
+                    # unless the wallet has it already
+                    if removed or changed or any(tx_hash in self.wallet.transactions for tx_hash, height in added):
+                        self.was_updated = True
 
                     # request transactions that we don't have
                     for tx_hash, tx_height in hist:
-                        if self.wallet.transactions.get(tx_hash) is None:
+                        if tx_hash not in self.wallet.transactions:
                             if (tx_hash, tx_height) not in requested_tx and (tx_hash, tx_height) not in missing_tx:
                                 missing_tx.append( (tx_hash, tx_height) )
 
@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+import unittest
+
+from lib.blockchain import Blockchain
+from lib import chainparams
+
+
+class FakeConfig(object):
+    """A stub config to be used in tests"""
+    def __init__(self, path):
+        self.path = path
+        self.store = {}
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+
+class FakeInterface(object):
+    """Answers chunk requests immediately from a dict of chunks"""
+    def __init__(self, server, chunks):
+        self.server = server
+        self.chunks = chunks
+        self.is_connected = True
+        self.requests = []
+
+    def send_request(self, request, queue=None):
+        index = request['params'][0]
+        self.requests.append(index)
+        queue.put((self, {'method': request['method'], 'params': [index], 'result': self.chunks[index]}))
+
+
+class FakeNetwork(object):
+    def __init__(self, interfaces):
+        self.interfaces = dict((i.server, i) for i in interfaces)
+        self.heights = dict((i.server, 10**6) for i in interfaces)
+
+
+class FakeChain(object):
+    """Accepts chunks whose data is 'good'"""
+    code = 'BTC'
+    chunk_size = 2016
+    header_store = None
+
+    def __init__(self):
+        self.verified = []
+
+    def is_checkpointed(self, index):
+        return False
+
+    def verify_chunk(self, index, data):
+        assert data == 'good'
+        self.verified.append(index)
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        chainparams.set_active_chain('BTC')
+        self.user_dir = tempfile.mkdtemp()
+        self.config = FakeConfig(self.user_dir)
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def make_blockchain(self, interfaces):
+        blockchain = Blockchain(self.config, FakeNetwork(interfaces))
+        blockchain.active_chain = FakeChain()
+        blockchain.running = True
+        return blockchain
+
+
+class TestGetAndVerifyChunks(BlockchainTestCase):
+
+    def test_chunks_verified_in_order(self):
+        good = dict((n, 'good') for n in range(11))
+        interfaces = [FakeInterface('a', good), FakeInterface('b', good), FakeInterface('c', good)]
+        blockchain = self.make_blockchain(interfaces)
+        self.assertTrue(blockchain.get_and_verify_chunks(interfaces[0], None, 10*2016))
+        self.assertEqual(range(11), blockchain.active_chain.verified)
+        # requests were spread across servers
+        for i in interfaces:
+            self.assertTrue(i.requests)
+
+    def test_bad_chunk_retried_from_other_server(self):
+        good = dict((n, 'good') for n in range(6))
+        bad = dict(good)
+        bad[2] = 'bad'
+        liar = FakeInterface('liar', bad)
+        honest = FakeInterface('honest', good)
+        self.config.store['chunk_window'] = 2
+        blockchain = self.make_blockchain([liar, honest])
+        self.assertTrue(blockchain.get_and_verify_chunks(liar, None, 5*2016 + 2014))
+        self.assertEqual(range(6), blockchain.active_chain.verified)
+        self.assertIn(2, liar.requests)
+        self.assertIn(2, honest.requests)
@@ -0,0 +1,104 @@
+import os
+import struct
+
+from lib import chainparams
+from lib.chains.bitcoin import Bitcoin
+from lib.chains.cryptocur import Hash, hash_encode
+from lib.tests.test_blockchain import BlockchainTestCase, FakeInterface
+
+EASY_BITS = 0x207fffff
+
+
+def make_fixture_chain(count, bad_bits_at=None):
+    """Headers linked from genesis, with no Proof-of-Work to speak of"""
+    headers = []
+    prev = '\0'*32
+    for height in range(count):
+        bits = 0x1d00ffff if height == bad_bits_at else EASY_BITS
+        raw = struct.pack('<I', 1) + prev + Hash(str(height)) + struct.pack('<III', 1400000000 + 600*height, bits, height)
+        headers.append(raw)
+        prev = Hash(raw)
+    return headers
+
+
+class FixtureChain(Bitcoin):
+    """Bitcoin rules with a target that every header meets"""
+
+    def __init__(self, checkpoints):
+        self.checkpoints = checkpoints
+        self.targets_checked = []
+
+    def get_target(self, index, chain=None):
+        self.targets_checked.append(index)
+        return EASY_BITS, 1 << 256
+
+
+class TestCheckpoints(BlockchainTestCase):
+
+    def sync(self, headers, checkpoints, full_verification=False):
+        self.config.store['full_verification'] = full_verification
+        chain = FixtureChain(checkpoints)
+        blockchain = self.make_blockchain([])
+        # Blockchain set up the active chain from the config
+        active_chain = chainparams.get_active_chain()
+        self.addCleanup(setattr, active_chain, 'use_checkpoints', True)
+        chain.use_checkpoints = active_chain.use_checkpoints
+        blockchain.active_chain = chain
+        open(blockchain.path(), 'wb').close()
+        chain.set_headers_path(blockchain.path())
+        self.addCleanup(chain.header_store.close)
+
+        chunks = {}
+        for index in range(len(headers)/2016):
+            chunks[index] = ''.join(headers[index*2016:(index+1)*2016]).encode('hex')
+        interface = FakeInterface('a', chunks)
+        blockchain.network.interfaces[interface.server] = interface
+        blockchain.network.heights[interface.server] = len(headers) - 1
+        blockchain.local_height = -1
+        # the chunk holding height + 1 is the last one requested
+        return blockchain, blockchain.get_and_verify_chunks(interface, None, len(headers) - 2)
+
+    def test_sync_with_checkpoints(self):
+        headers = make_fixture_chain(3*2016)
+        last = hash_encode(Hash(headers[2*2016-1]))
+        blockchain, ok = self.sync(headers, {2*2016-1: last})
+        self.assertTrue(ok)
+        self.assertEqual(3*2016 - 1, blockchain.height())
+        # only the chunk after the last checkpoint had its target checked
+        self.assertEqual([2], blockchain.active_chain.targets_checked)
+        self.assertEqual(headers[-1], blockchain.read_header(3*2016-1).raw)
+
+    def test_sync_full_verification(self):
+        headers = make_fixture_chain(3*2016)
+        last = hash_encode(Hash(headers[2*2016-1]))
+        blockchain, ok = self.sync(headers, {2*2016-1: last}, full_verification=True)
+        self.assertTrue(ok)
+        self.assertEqual(3*2016 - 1, blockchain.height())
+        self.assertEqual([0, 1, 2], blockchain.active_chain.targets_checked)
+
+    def test_targets_not_checked_below_checkpoint(self):
+        headers = make_fixture_chain(3*2016, bad_bits_at=10)
+        last = hash_encode(Hash(headers[2*2016-1]))
+        blockchain, ok = self.sync(headers, {2*2016-1: last})
+        self.assertTrue(ok)
+        blockchain, ok = self.sync(headers, {2*2016-1: last}, full_verification=True)
+        self.assertFalse(ok)
+
+    def test_checkpoint_mismatch(self):
+        headers = make_fixture_chain(3*2016)
+        blockchain, ok = self.sync(headers, {2016: '00'*32, 2*2016-1: '00'*32})
+        self.assertFalse(ok)
+        self.assertEqual(2015, blockchain.height())
+
+    def test_unaligned_last_checkpoint(self):
+        headers = make_fixture_chain(3*2016)
+        # the chunks before the one holding the checkpoint are only trusted
+        # once the checkpoint itself has been matched
+        blockchain, ok = self.sync(headers, {2*2016 + 100: '00'*32})
+        self.assertFalse(ok)
+        self.assertEqual(2*2016 - 1, blockchain.height())
+
+        last = hash_encode(Hash(headers[2*2016 + 100]))
+        blockchain, ok = self.sync(headers, {2*2016 + 100: last})
+        self.assertTrue(ok)
+        self.assertEqual([2], blockchain.active_chain.targets_checked)
@@ -0,0 +1,55 @@
+import unittest
+
+from lib.chains.cryptocur import Header
+from lib import chainparams
+
+# Bitcoin genesis block header
+GENESIS_RAW = ('0100000000000000000000000000000000000000000000000000000000000000'
+               '000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa'
+               '4b1e5e4a29ab5f49ffff001d1dac2b7c').decode('hex')
+GENESIS_HASH = '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
+GENESIS_DICT = {
+    'version': 1,
+    'prev_block_hash': '00'*32,
+    'merkle_root': '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b',
+    'timestamp': 1231006505,
+    'bits': 0x1d00ffff,
+    'nonce': 2083236893,
+}
+
+
+class TestHeader(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHeader, self).setUp()
+        self.chain = chainparams.get_chain_instance('BTC')
+
+    def test_fields(self):
+        header = Header(GENESIS_RAW, 0)
+        for k, v in GENESIS_DICT.items():
+            self.assertEqual(v, getattr(header, k))
+            self.assertEqual(v, header.get(k))
+        self.assertEqual(0, header.get('block_height'))
+        self.assertIsNone(Header(GENESIS_RAW).get('block_height'))
+
+    def test_dict_round_trip(self):
+        header = Header.from_dict(GENESIS_DICT)
+        self.assertEqual(GENESIS_RAW, header.raw)
+        self.assertEqual(GENESIS_DICT, Header(GENESIS_RAW).as_dict())
+
+    def test_hash(self):
+        header = self.chain.header_from_string(GENESIS_RAW)
+        self.assertEqual(GENESIS_HASH, self.chain.hash_header(header))
+        self.assertEqual(GENESIS_HASH, self.chain.hash_header(GENESIS_DICT))
+        self.assertEqual(GENESIS_RAW.encode('hex'), self.chain.header_to_string(GENESIS_DICT))
+
+
+class TestBranchTargets(unittest.TestCase):
+
+    def test_branch_headers_before_saved_ones(self):
+        chain = chainparams.get_chain_instance('BTC')
+        saved = dict((h, Header.from_dict(dict(GENESIS_DICT, timestamp=1231006505 + 600*h))) for h in [0, 2015])
+        chain.read_header = saved.get
+        # a branch whose retarget period took half as long
+        fork = Header.from_dict(dict(GENESIS_DICT, timestamp=1231006505 + 300*2015, block_height=2015))
+        self.assertEqual(chain.get_target(1)[1] / 2, chain.get_target(1, [fork])[1])
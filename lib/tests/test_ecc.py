@@ -0,0 +1,151 @@
+import hashlib
+import unittest
+
+import ecdsa
+from ecdsa.ecdsa import generator_secp256k1
+
+from lib import ecc
+from lib.bitcoin import EC_KEY, bip32_root, bip32_private_derivation, bip32_public_derivation, xpub_from_xprv
+
+
+class TestPoints(unittest.TestCase):
+
+    scalars = [1, 2, 15, 16, 17, 255, 256, 2**128 + 1, ecc._r - 1, int(hashlib.sha256('k').hexdigest(), 16)]
+
+    def test_generator_multiply(self):
+        for k in self.scalars:
+            point = generator_secp256k1 * k
+            self.assertEqual((point.x(), point.y()), ecc.to_affine(ecc.generator_multiply(k)))
+        self.assertEqual(None, ecc.generator_multiply(ecc._r))
+
+    def test_add_and_double(self):
+        G = generator_secp256k1
+        P, Q = ecc.generator_multiply(12345), ecc.point_multiply(ecc.to_jacobian((G.x(), G.y())), 678)
+        for point, expected in [(ecc.point_add(P, Q), G * (12345 + 678)),
+                                (ecc.point_add(Q, P), G * (12345 + 678)),
+                                (ecc.point_add(P, P), G * (2 * 12345)),
+                                (ecc.point_double(Q), G * (2 * 678))]:
+            self.assertEqual((expected.x(), expected.y()), ecc.to_affine(point))
+        self.assertEqual(None, ecc.point_add(P, ecc.generator_multiply(ecc._r - 12345)))
+
+
+class TestPythonBackend(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPythonBackend, self).setUp()
+        self.backend = ecc.PythonBackend()
+        self.secret = hashlib.sha256('secret').digest()
+        self.digest = hashlib.sha256('message').digest()
+
+    def test_signature_is_low_s(self):
+        for i in range(8):
+            digest = hashlib.sha256('message %d' % i).digest()
+            sig = self.backend.sign(self.backend.signing_key(self.secret), digest)
+            r, s = ecc.sigdecode_der(sig, ecc._r)
+            self.assertTrue(s <= ecc._r / 2)
+            self.assertTrue(self.backend.verify(self.backend.pubkey_from_secret(self.secret), sig, digest))
+
+    def test_signature_matches_ecdsa(self):
+        key = ecdsa.SigningKey.from_string(self.secret, curve=ecdsa.SECP256k1)
+        r, s = key.sign_digest_deterministic(self.digest, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_strings)
+        r, s = ecc.string_to_number(r), ecc.string_to_number(s)
+        expected = ecc.sigencode_der(r, min(s, ecc._r - s), ecc._r)
+        self.assertEqual(expected, self.backend.sign(self.backend.signing_key(self.secret), self.digest))
+
+    def test_recover(self):
+        pubkey = self.backend.pubkey_from_secret(self.secret)
+        r, s = ecc.sigdecode_der(self.backend.sign(self.backend.signing_key(self.secret), self.digest), ecc._r)
+        compact = ecc.number_to_string(r, ecc._r) + ecc.number_to_string(s, ecc._r)
+        self.assertIn(pubkey, [self.backend.recover(compact, recid, self.digest) for recid in range(2)])
+
+    def test_pubkey_matches_ecdsa(self):
+        for i in range(4):
+            secret = hashlib.sha256('secret %d' % i).digest()
+            tweak = hashlib.sha256('tweak %d' % i).digest()
+            key = ecdsa.SigningKey.from_string(secret, curve=ecdsa.SECP256k1)
+            pubkey = '\x04' + key.get_verifying_key().to_string()
+            self.assertEqual(pubkey, self.backend.pubkey_from_secret(secret))
+            point = key.get_verifying_key().pubkey.point + generator_secp256k1 * ecc.string_to_number(tweak)
+            expected = ecc.pubkey_from_point(point)
+            self.assertEqual(expected, self.backend.pubkey_tweak_add(pubkey, tweak))
+            self.assertEqual(expected, self.backend.pubkey_tweak_add(ecc.compress(pubkey), tweak))
+            self.assertEqual([expected], self.backend.pubkey_tweak_add_many(pubkey, [tweak]))
+
+    def test_recover_matches_ecdsa(self):
+        # python-ecdsa cannot recover keys: each recovered key must verify
+        # the signature, and one of them must be the signer's
+        for i in range(4):
+            secret = hashlib.sha256('secret %d' % i).digest()
+            digest = hashlib.sha256('message %d' % i).digest()
+            key = ecdsa.SigningKey.from_string(secret, curve=ecdsa.SECP256k1)
+            compact = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256)
+            recovered = [self.backend.recover(compact, recid, digest) for recid in range(2)]
+            self.assertIn('\x04' + key.get_verifying_key().to_string(), recovered)
+            for pubkey in recovered:
+                verifying_key = ecdsa.VerifyingKey.from_string(pubkey[1:], curve=ecdsa.SECP256k1)
+                self.assertTrue(verifying_key.verify_digest(compact, digest))
+
+    def test_compressed_pubkey(self):
+        pubkey = self.backend.pubkey_from_secret(self.secret)
+        point = ecc.point_from_pubkey(ecc.compress(pubkey))
+        self.assertEqual(pubkey, ecc.pubkey_from_point(point))
+
+
+class TestBackendsAgree(unittest.TestCase):
+    """libsecp256k1 and the Python backend give the same results"""
+
+    def setUp(self):
+        super(TestBackendsAgree, self).setUp()
+        self.fast = ecc.load_libsecp256k1()
+        if self.fast is None:
+            self.skipTest('libsecp256k1 is not installed')
+        self.python = ecc.PythonBackend()
+        self.saved_backend = ecc.backend
+        self.cases = [(hashlib.sha256('secret %d' % i).digest(), hashlib.sha256('message %d' % i).digest())
+                      for i in range(4)]
+
+    def tearDown(self):
+        ecc.set_backend(self.saved_backend)
+        super(TestBackendsAgree, self).tearDown()
+
+    def test_functions_declared(self):
+        for name, (restype, argtypes) in ecc.LIBRARY_FUNCTIONS.items():
+            self.assertEqual(argtypes, getattr(self.fast.lib, name).argtypes)
+            self.assertEqual(restype, getattr(self.fast.lib, name).restype)
+
+    def test_keys(self):
+        for secret, digest in self.cases:
+            pubkey = self.python.pubkey_from_secret(secret)
+            self.assertEqual(pubkey, self.fast.pubkey_from_secret(secret))
+            self.assertEqual(self.python.pubkey_tweak_add(pubkey, digest), self.fast.pubkey_tweak_add(pubkey, digest))
+            self.assertEqual(self.python.pubkey_tweak_add(ecc.compress(pubkey), digest),
+                             self.fast.pubkey_tweak_add(ecc.compress(pubkey), digest))
+
+    def test_signatures(self):
+        for secret, digest in self.cases:
+            pubkey = self.python.pubkey_from_secret(secret)
+            sig = self.python.sign(self.python.signing_key(secret), digest)
+            self.assertEqual(sig, self.fast.sign(self.fast.signing_key(secret), digest))
+            self.assertTrue(self.fast.verify(pubkey, sig, digest))
+            self.assertFalse(self.fast.verify(pubkey, sig, hashlib.sha256(digest).digest()))
+            r, s = ecc.sigdecode_der(sig, ecc._r)
+            compact = ecc.number_to_string(r, ecc._r) + ecc.number_to_string(s, ecc._r)
+            recovered = [self.fast.recover(compact, recid, digest) for recid in range(2)]
+            self.assertIn(pubkey, recovered)
+            self.assertEqual(recovered, [self.python.recover(compact, recid, digest) for recid in range(2)])
+
+    def test_bitcoin_functions(self):
+        results = []
+        for backend in [self.python, self.fast]:
+            ecc.set_backend(backend)
+            xprv, xpub = bip32_root('00' * 16)
+            xprv, xpub = bip32_private_derivation(xprv, 'm/', "m/0'/1")
+            key = EC_KEY(self.cases[0][0])
+            results.append((xpub, xpub_from_xprv(xprv), bip32_public_derivation(xpub, "m/0'/1", "m/0'/1/2/3"),
+                            key.get_public_key(), key.sign_message('hello', True, key_address(key))))
+        self.assertEqual(results[0], results[1])
+
+
+def key_address(key):
+    from lib.bitcoin import public_key_to_bc_address
+    return public_key_to_bc_address(key.get_public_key(True).decode('hex'))
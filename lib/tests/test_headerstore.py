@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.chains.headerstore import HeaderStore
+from lib import chainparams
+
+
+def fake_header(n):
+    return ('%02x' % (n % 256)).decode('hex') * 80
+
+
+class HeaderStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(HeaderStoreTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'blockchain_headers')
+        open(self.path, 'wb+').close()
+        self.store = HeaderStore(self.path)
+
+    def tearDown(self):
+        super(HeaderStoreTestCase, self).tearDown()
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestHeaderStore(HeaderStoreTestCase):
+
+    def test_empty_file(self):
+        self.assertEqual(0, self.store.size())
+        self.assertIsNone(self.store.read(0))
+        self.assertIsNone(self.store.read(-1))
+
+    def test_write_and_read(self):
+        data = ''.join(fake_header(i) for i in range(10))
+        self.store.write(0, data)
+        self.assertEqual(10, self.store.size())
+        for i in range(10):
+            self.assertEqual(fake_header(i), self.store.read(i))
+        self.assertIsNone(self.store.read(10))
+
+    def test_grows_after_write(self):
+        self.store.write(0, fake_header(0))
+        self.assertIsNone(self.store.read(1))
+        self.store.write(1, fake_header(1))
+        self.assertEqual(fake_header(1), self.store.read(1))
+
+    def test_sees_external_writes(self):
+        self.store.write(0, fake_header(0))
+        self.store.flush()
+        with open(self.path, 'ab') as f:
+            f.write(fake_header(1))
+        self.assertEqual(fake_header(1), self.store.read(1))
+
+    def test_append(self):
+        self.store.write(0, fake_header(0))
+        self.store.append(fake_header(1) + fake_header(2))
+        self.assertEqual(3, self.store.size())
+        self.assertEqual(fake_header(2), self.store.read(2))
+
+    def test_overwrite_mapped_header(self):
+        self.store.write(0, fake_header(0) + fake_header(1))
+        self.assertEqual(fake_header(1), self.store.read(1))
+        self.store.write(1, fake_header(5))
+        self.assertEqual(fake_header(5), self.store.read(1))
+
+    def test_flush_and_reopen(self):
+        self.store.write(0, fake_header(0) + fake_header(1))
+        self.store.flush(sync=True)
+        self.assertEqual(2*80, os.path.getsize(self.path))
+        other = HeaderStore(self.path)
+        self.assertEqual(fake_header(1), other.read(1))
+        other.close()
+
+    def test_truncate(self):
+        self.store.write(0, ''.join(fake_header(i) for i in range(5)))
+        self.store.truncate(3)
+        self.assertEqual(3, self.store.size())
+        self.assertEqual(fake_header(2), self.store.read(2))
+        self.assertIsNone(self.store.read(3))
+
+
+class TestChainHeaderStore(HeaderStoreTestCase):
+
+    def setUp(self):
+        super(TestChainHeaderStore, self).setUp()
+        self.chain = chainparams.get_chain_instance('BTC')
+        self.chain.set_headers_path(self.path)
+
+    def tearDown(self):
+        self.chain.header_store.close()
+        super(TestChainHeaderStore, self).tearDown()
+
+    def test_save_and_read_header(self):
+        header = {'version': 1, 'prev_block_hash': '00'*32, 'merkle_root': '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b',
+                  'timestamp': 1231006505, 'bits': 0x1d00ffff, 'nonce': 2083236893, 'block_height': 0}
+        self.chain.save_header(header)
+        h = self.chain.read_header(0)
+        self.assertEqual('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f', self.chain.hash_header(h))
+        self.assertIsNone(self.chain.read_header(1))
+
+    def test_save_headers(self):
+        headers = [self.chain.header_from_string(fake_header(i), i) for i in range(3)]
+        self.chain.save_headers(headers)
+        self.assertEqual(3, self.chain.header_store.size())
+        self.assertEqual(3*80, os.path.getsize(self.path))
+        self.assertEqual(fake_header(2), self.chain.read_header(2).raw)
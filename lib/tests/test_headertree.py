@@ -0,0 +1,126 @@
+import struct
+import unittest
+
+from lib.chains.cryptocur import Hash
+from lib.chains.headertree import HeaderTree
+from lib.tests.test_blockchain import BlockchainTestCase
+from lib.tests.test_checkpoints import EASY_BITS, FixtureChain, make_fixture_chain
+
+
+class TreeChain(object):
+    """Headers are dicts naming their own hash and work"""
+    def __init__(self, saved):
+        self.saved = saved
+
+    def read_header(self, height):
+        return self.saved[height] if 0 <= height < len(self.saved) else None
+
+    def hash_header(self, header):
+        return header['hash']
+
+    def header_work(self, header):
+        return header['work']
+
+
+def make_branch(prefix, parent, start, count, work=1):
+    headers = []
+    for height in range(start, start + count):
+        h = {'hash': '%s%d' % (prefix, height), 'prev_block_hash': parent, 'block_height': height, 'work': work}
+        headers.append(h)
+        parent = h['hash']
+    return headers
+
+
+class TestHeaderTree(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHeaderTree, self).setUp()
+        self.saved = make_branch('m', '0', 0, 20)
+        self.tree = HeaderTree(TreeChain(self.saved), 10)
+        self.tree.load(19)
+
+    def test_load(self):
+        self.assertEqual('m19', self.tree.tip.hash)
+        self.assertEqual(10, self.tree.base_height())
+        self.assertNotIn('m8', self.tree)
+        self.assertEqual([], self.tree.branch('m19'))
+
+    def test_longer_branch_wins(self):
+        for h in make_branch('f', 'm15', 16, 5):
+            self.tree.add(h)
+        self.assertEqual('f20', self.tree.best().hash)
+        self.assertEqual(['f16', 'f17', 'f18', 'f19', 'f20'], [h['hash'] for h in self.tree.branch('f20')])
+        self.assertEqual(16, self.tree.set_main('f20'))
+        self.assertEqual('f20', self.tree.tip.hash)
+        self.assertEqual([], self.tree.branch('f20'))
+
+    def test_most_work_wins_over_height(self):
+        for h in make_branch('f', 'm15', 16, 2, work=3):
+            self.tree.add(h)
+        self.assertEqual('f17', self.tree.best().hash)
+        self.assertEqual(16, self.tree.set_main('f17'))
+        self.assertEqual(None, self.tree.main.get(18))
+
+    def test_equal_work_keeps_main(self):
+        for h in make_branch('f', 'm15', 16, 4):
+            self.tree.add(h)
+        self.assertEqual('m19', self.tree.best().hash)
+
+    def test_prune(self):
+        for h in make_branch('f', 'm11', 12, 2):
+            self.tree.add(h)
+        for h in make_branch('m', 'm19', 20, 5):
+            self.tree.add(h)
+        self.tree.set_main('m24')
+        self.assertEqual(15, self.tree.base_height())
+        self.assertNotIn('m13', self.tree)
+        # the fork below the anchor is gone
+        self.assertNotIn('f13', self.tree)
+        self.assertIn('m24', self.tree)
+
+
+class FakeReorgNetwork(object):
+    def __init__(self):
+        self.interfaces = {}
+        self.heights = {}
+        self.reorgs = []
+
+    def blockchain_reorg(self, height):
+        self.reorgs.append(height)
+
+
+class TestSwitchToBest(BlockchainTestCase):
+
+    def test_rewrites_divergent_suffix(self):
+        from lib.blockchain import Blockchain
+        blockchain = Blockchain(self.config, FakeReorgNetwork())
+        chain = FixtureChain({})
+        blockchain.active_chain = chain
+        blockchain.tree = HeaderTree(chain, 100)
+        open(blockchain.path(), 'wb').close()
+        chain.set_headers_path(blockchain.path())
+        self.addCleanup(chain.header_store.close)
+
+        main = make_fixture_chain(10)
+        chain.header_store.write(0, ''.join(main))
+        blockchain.set_local_height()
+        blockchain.tree.load(blockchain.local_height)
+
+        # a fork from height 7 that is one header longer
+        prev = Hash(main[6])
+        fork = []
+        for height in range(7, 11):
+            raw = struct.pack('<I', 2) + prev + Hash('fork%d' % height) + struct.pack('<III', 1400000000 + 600*height, EASY_BITS, height)
+            header = chain.header_from_string(raw, height)
+            fork.append(header)
+            prev = Hash(raw)
+        for header in fork:
+            blockchain.tree.add(header)
+        blockchain.switch_to_best()
+
+        self.assertEqual(10, blockchain.height())
+        self.assertEqual([7], blockchain.network.reorgs)
+        for height in range(7):
+            self.assertEqual(main[height], chain.read_header(height).raw)
+        for header in fork:
+            self.assertEqual(header.raw, chain.read_header(header.block_height).raw)
@@ -0,0 +1,179 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib.chains.cryptocur import Hash, hash_encode, hash_decode
+from lib.chains.mazacoin import Mazacoin
+
+BITS = [0x1d03ffff, 0x1c7fffff, 0x1b0404cb, 0x1c00ffff]
+
+
+def fake_headers(count, seed):
+    rand = random.Random(seed)
+    return ''.join(struct.pack('<I', 1) + '\0'*64 +
+                   struct.pack('<III', 1400000000 + 120*h + rand.randint(-300, 300), rand.choice(BITS), 0)
+                   for h in range(count))
+
+
+def reference_target(chain, headers, block_height):
+    """(bits, target) at block_height as computed before the target window,
+    by walking back through headers, a list of header dicts"""
+    max_target = 0x00000FFFF0000000000000000000000000000000000000000000000000000000
+    if block_height >= chain.DGW3_HEIGHT:
+        if block_height-1 < 24:
+            return 0x1e0ffff0, max_target
+        nActualTimespan = 0
+        LastBlockTime = 0
+        PastDifficultyAverage = PastDifficultyAveragePrev = 0
+        for CountBlocks in range(1, 25):
+            BlockReading = headers[block_height - CountBlocks]
+            bnNum = chain.bits_to_target(BlockReading['bits'])
+            if CountBlocks == 1:
+                PastDifficultyAverage = bnNum
+            else:
+                PastDifficultyAverage = ((PastDifficultyAveragePrev * CountBlocks)+(bnNum)) / (CountBlocks + 1)
+            PastDifficultyAveragePrev = PastDifficultyAverage
+            if LastBlockTime > 0:
+                nActualTimespan += LastBlockTime - BlockReading['timestamp']
+            LastBlockTime = BlockReading['timestamp']
+        nTargetTimespan = 24 * 120
+        nActualTimespan = max(nActualTimespan, nTargetTimespan/3)
+        nActualTimespan = min(nActualTimespan, nTargetTimespan*3)
+        bnNew = min(PastDifficultyAverage * nActualTimespan / nTargetTimespan, max_target)
+        return chain.target_to_bits(bnNew), bnNew
+
+    nAveragingTargetTimespan = 80 * 120
+    if block_height == 0: return 0x1e0ffff0, max_target
+    start_target = 0x00000003FFFF0000000000000000000000000000000000000000000000000000
+    if block_height < 80: return 0x1d03ffff, start_target
+    if block_height % 4:
+        return reference_target(chain, headers, block_height - 1)
+    last = headers[block_height-1]
+    first = headers[(block_height-1)-79]
+    nActualTimespan = last['timestamp'] - first['timestamp']
+    nActualTimespan = max(nActualTimespan, nAveragingTargetTimespan * 85 / 100)
+    nActualTimespan = min(nActualTimespan, nAveragingTargetTimespan * 120 / 100)
+    new_target = min(max_target, chain.bits_to_target(last['bits']) * nActualTimespan / nAveragingTargetTimespan)
+    return chain.target_to_bits(new_target), new_target
+
+
+class TestTargets(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTargets, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'blockchain_headers')
+        with open(self.path, 'wb') as f:
+            f.write(fake_headers(300, 1))
+        self.chains = []
+
+    def tearDown(self):
+        for chain in self.chains:
+            chain.header_store.close()
+        shutil.rmtree(self.tmpdir)
+        super(TestTargets, self).tearDown()
+
+    def make_chain(self):
+        chain = Mazacoin()
+        chain.DGW3_HEIGHT = 200
+        chain.set_headers_path(self.path)
+        self.chains.append(chain)
+        return chain
+
+    def test_sliding_window_matches_cold_start(self):
+        chain = self.make_chain()
+        for height in range(300):
+            target = chain.get_target(height)
+            chain.push_header(chain.read_header(height), height)
+            self.assertEqual(self.make_chain().get_target(height), target)
+            self.chains.pop().header_store.close()
+
+    def test_v1_changes_on_interval(self):
+        chain = self.make_chain()
+        for height in range(80, 200):
+            self.assertEqual(chain.get_target(height - height % chain.interval), chain.get_target(height))
+
+    def test_invalidate_targets(self):
+        chain = self.make_chain()
+        old_target = chain.get_target(250)
+        # a fork replaces the headers from 150 up
+        chain.header_store.write(150, fake_headers(300, 2)[150*80:])
+        chain.invalidate_targets(150)
+        self.assertFalse([h for h in chain.targets if h >= 150])
+        new_target = chain.get_target(250)
+        self.assertNotEqual(old_target, new_target)
+        self.assertEqual(self.make_chain().get_target(250), new_target)
+
+    def test_matches_reference(self):
+        chain = self.make_chain()
+        headers = [chain.read_header(height).as_dict() for height in range(300)]
+        for height in range(300):
+            self.assertEqual(reference_target(chain, headers, height), chain.get_target(height))
+            chain.push_header(chain.read_header(height), height)
+
+    def test_missing_window_not_cached(self):
+        chain = self.make_chain()
+        # the headers below 400 are not known
+        self.assertEqual(0x1e0ffff0, chain.get_target(400)[0])
+        self.assertNotIn(400, chain.targets)
+
+
+class FixtureMazacoin(Mazacoin):
+    """Mazacoin rules, with header hashes that meet any target"""
+    DGW3_HEIGHT = 100
+
+    def hash_header(self, header):
+        return '0'*16 + hash_encode(Hash(self.raw_header(header)))[16:]
+
+
+def make_branch(chain, headers, start, count, seed):
+    """Extend headers (dicts) below start with count valid headers"""
+    rand = random.Random(seed)
+    headers = headers[:start]
+    for height in range(start, start + count):
+        prev = chain.hash_header(chain.header_from_string(headers[-1]['raw'])) if headers else '00'*32
+        bits = reference_target(chain, headers, height)[0]
+        raw = struct.pack('<I', 1) + hash_decode(prev) + Hash(str(seed)) + \
+              struct.pack('<III', 1400000000 + 120*height + rand.randint(-300, 300), bits, 0)
+        d = chain.header_from_string(raw, height).as_dict()
+        d['raw'] = raw
+        headers.append(d)
+    return headers
+
+
+class TestFork(unittest.TestCase):
+
+    def setUp(self):
+        super(TestFork, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.chain = FixtureMazacoin()
+        self.main = make_branch(self.chain, [], 0, 140, 1)
+        path = os.path.join(self.tmpdir, 'blockchain_headers')
+        with open(path, 'wb') as f:
+            f.write(''.join(h['raw'] for h in self.main))
+        self.chain.set_headers_path(path)
+
+    def tearDown(self):
+        self.chain.header_store.close()
+        shutil.rmtree(self.tmpdir)
+        super(TestFork, self).tearDown()
+
+    def test_multi_block_fork(self):
+        fork = make_branch(self.chain, self.main, 120, 25, 2)[120:]
+        branch = [self.chain.header_from_string(h['raw'], h['block_height']) for h in fork]
+        self.assertNotEqual([h['bits'] for h in self.main[120:140]], [h.bits for h in branch[:20]])
+        for height in range(140):
+            self.chain.get_target(height)
+            self.chain.push_header(self.chain.read_header(height), height)
+        targets = dict(self.chain.targets)
+
+        self.assertTrue(self.chain.verify_chain(branch))
+        # the targets of the saved branch are left alone
+        self.assertEqual(targets, self.chain.targets)
+        self.assertEqual(140, self.chain.window_height)
+
+        bad = branch[:5] + [self.chain.header_from_string(self.main[125]['raw'], 125)]
+        self.assertFalse(self.chain.verify_chain(bad))
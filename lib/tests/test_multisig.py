@@ -77,6 +77,8 @@ class WalletTestCase(unittest.TestCase):
 
         self.fake_config = FakeConfig(self.user_dir)
         self.fake_config.set_active_chain_code('BTC')
+        # save at once, so that no flush is left to run after tearDown
+        self.fake_config.set_key_above_chain('flush_interval', 0)
 
         self._saved_stdout = sys.stdout
         self._stdout_buffer = StringIO()
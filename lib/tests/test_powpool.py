@@ -0,0 +1,36 @@
+import os
+import unittest
+
+from lib import chainparams
+from lib.chains import scrypt
+
+
+class TestPoWHashes(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPoWHashes, self).setUp()
+        self.chain = chainparams.get_chain_instance('LTC')
+        self.headers = [os.urandom(80) for i in range(6)]
+
+    def tearDown(self):
+        self.chain.set_pow_workers(1)
+        self.chain.pow_batch_function = None
+        super(TestPoWHashes, self).tearDown()
+
+    def test_pool_matches_sequential(self):
+        expected = self.chain.pow_hashes(self.headers)
+        self.chain.set_pow_workers(2)
+        self.assertEqual(expected, self.chain.pow_hashes(self.headers))
+
+    def test_pow_hash_header(self):
+        header = self.chain.header_from_string(self.headers[0])
+        self.assertEqual(self.chain.pow_hashes(self.headers[:1])[0], self.chain.pow_hash_header(header))
+
+    def test_batch_function(self):
+        if scrypt.numpy is None:
+            self.skipTest('numpy is not installed')
+        expected = self.chain.pow_hashes(self.headers)
+        self.chain.pow_batch_function = scrypt.scrypt_1024_1_1_80_batch
+        self.assertEqual(expected, self.chain.pow_hashes(self.headers))
+        self.chain.set_pow_workers(2)
+        self.assertEqual(expected, self.chain.pow_hashes(self.headers))
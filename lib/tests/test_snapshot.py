@@ -0,0 +1,89 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib import snapshot
+from lib.blockchain import headers_path
+from lib.chains.cryptocur import Hash
+
+GENESIS = '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c'.decode('hex')
+
+
+class FakeConfig(object):
+    def __init__(self, path):
+        self.path = path
+        self.store = {}
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = FakeConfig(os.path.join(self.tmpdir, 'source'))
+        self.dest = FakeConfig(os.path.join(self.tmpdir, 'dest'))
+        os.mkdir(self.source.path)
+        os.mkdir(self.dest.path)
+        self.snapshot = os.path.join(self.tmpdir, 'headers.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestSnapshot, self).tearDown()
+
+    def export(self, data):
+        with open(headers_path(self.source, 'BTC'), 'wb') as f:
+            f.write(data)
+        return snapshot.export_snapshot(self.source, 'BTC', self.snapshot)
+
+    def test_export_and_import(self):
+        info = self.export(GENESIS + 'x'*40)
+        self.assertEqual(1, info['count'])
+        for workers in [1, 2]:
+            result = snapshot.import_snapshot(self.dest, 'BTC', self.snapshot, workers)
+            self.assertEqual(0, result['height'])
+            with open(headers_path(self.dest, 'BTC'), 'rb') as f:
+                self.assertEqual(GENESIS, f.read())
+            os.remove(headers_path(self.dest, 'BTC'))
+        self.assertFalse(os.path.exists(headers_path(self.dest, 'BTC') + '.import'))
+
+    def test_workers_do_not_write(self):
+        from lib.chains.cryptocur import CryptoCur
+        def save_chunk(chain, index, chunk):
+            raise Exception('a worker saved chunk %d' % index)
+        self.export(GENESIS)
+        saved = CryptoCur.__dict__['save_chunk']
+        CryptoCur.save_chunk = save_chunk
+        try:
+            snapshot.import_snapshot(self.dest, 'BTC', self.snapshot, 1)
+        finally:
+            CryptoCur.save_chunk = saved
+        with open(headers_path(self.dest, 'BTC'), 'rb') as f:
+            self.assertEqual(GENESIS, f.read())
+
+    def test_checksum_mismatch(self):
+        self.export(GENESIS)
+        with open(self.snapshot, 'rb+') as f:
+            f.seek(-1, 2)
+            f.write('\0')
+        self.assertRaises(Exception, snapshot.import_snapshot, self.dest, 'BTC', self.snapshot, 1)
+
+    def test_wrong_chain(self):
+        self.export(GENESIS)
+        self.assertRaises(Exception, snapshot.import_snapshot, self.dest, 'LTC', self.snapshot, 1)
+
+    def test_bad_link(self):
+        self.export(GENESIS + GENESIS)
+        self.assertRaises(Exception, snapshot.import_snapshot, self.dest, 'BTC', self.snapshot, 1)
+
+    def test_bad_proof_of_work(self):
+        header = struct.pack('<I', 1) + Hash(GENESIS) + '\0'*32 + struct.pack('<III', 1231006506, 0x1d00ffff, 0)
+        self.export(GENESIS + header)
+        # chunk 0 is below the Bitcoin checkpoints
+        self.dest.store['full_verification'] = True
+        self.assertRaises(Exception, snapshot.import_snapshot, self.dest, 'BTC', self.snapshot, 2)
+        self.assertFalse(os.path.exists(headers_path(self.dest, 'BTC')))
@@ -0,0 +1,198 @@
+import copy
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from lib.wallet import WalletStorage
+from lib.sqlite_storage import SqliteWalletStorage, SqliteTable, migrate_wallet
+from lib import chainparams
+
+
+class FakeConfig(dict):
+
+    def get_above_chain(self, key, default=None):
+        return self.get(key, default)
+
+
+class SqliteStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(SqliteStorageTestCase, self).setUp()
+        chainparams.set_active_chain('BTC')
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'somewallet')
+
+    def tearDown(self):
+        super(SqliteStorageTestCase, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def open(self, **options):
+        return WalletStorage(FakeConfig(wallet_path=self.path, **options))
+
+    def rows(self, table):
+        db = sqlite3.connect(self.path)
+        rows = db.execute('SELECT * FROM %s' % table).fetchall()
+        db.close()
+        return rows
+
+
+class TestSqliteWalletStorage(SqliteStorageTestCase):
+
+    def test_selected_by_config(self):
+        storage = self.open()
+        self.assertIs(WalletStorage, type(storage))
+        storage.flush()
+        os.remove(self.path + '.journal')
+        storage = self.open(wallet_storage='sqlite')
+        self.assertIs(SqliteWalletStorage, type(storage))
+        self.assertFalse(storage.file_exists)
+        storage.close()
+        # an existing database is opened as one whatever the config says
+        storage = self.open()
+        self.assertIs(SqliteWalletStorage, type(storage))
+        self.assertTrue(storage.file_exists)
+        storage.close()
+
+    def test_put_and_reopen(self):
+        storage = self.open(wallet_storage='sqlite')
+        storage.put_above_chain('seed_version', 4)
+        storage.put('labels', {'a': 'b'})
+        storage.put('transactions', {'aa': '0100', 'bb': '0200'})
+        storage.put('addr_history', {'1A': [['aa', 10]]}, False)
+        storage.put('verified_tx3', {'aa': [10, 1400000000, 1]})
+        storage.close()
+
+        storage = self.open()
+        self.assertEqual(4, storage.get_above_chain('seed_version'))
+        self.assertEqual({'a': 'b'}, storage.get('labels'))
+        self.assertEqual({'aa': '0100', 'bb': '0200'}, storage.get('transactions'))
+        self.assertEqual({'1A': [['aa', 10]]}, storage.get('addr_history'))
+        self.assertEqual({'aa': [10, 1400000000, 1]}, storage.get('verified_tx3'))
+        storage.close()
+
+    def test_table_rows_updated_individually(self):
+        storage = self.open(wallet_storage='sqlite')
+        storage.put('transactions', {'aa': '0100', 'bb': '0200'})
+        storage.flush()
+        storage.put('transactions', {'bb': '0200', 'cc': '0300'})
+        storage.close()
+        self.assertEqual([('BTC', 'bb', '"0200"'), ('BTC', 'cc', '"0300"')],
+                         sorted(self.rows('transactions')))
+
+    def test_put_item(self):
+        storage = self.open(wallet_storage='sqlite')
+        storage.put('transactions', {'aa': '0100', 'bb': '0200'})
+        storage.put_item('transactions', 'cc', '0300')
+        storage.put_item('transactions', 'aa', None)
+        storage.put_item('labels', 'x', 'y')
+        storage.close()
+        self.assertEqual([('BTC', 'bb', '"0200"'), ('BTC', 'cc', '"0300"')],
+                         sorted(self.rows('transactions')))
+        storage = self.open()
+        self.assertEqual({'x': 'y'}, storage.get('labels'))
+        storage.close()
+
+    def test_failed_save_is_retried(self):
+        storage = self.open(wallet_storage='sqlite')
+        storage.put('transactions', {'aa': '0100'})
+        storage.put_item('labels', 'x', 'y')
+        storage.put_above_chain('seed_version', 4)
+
+        def fail(chain, key, old, new):
+            raise sqlite3.OperationalError('disk I/O error')
+        storage.save_key = fail
+        self.assertRaises(sqlite3.OperationalError, storage.flush)
+        self.assertEqual([], self.rows('transactions'))
+
+        del storage.save_key
+        storage.close()
+        self.assertEqual([('BTC', 'aa', '"0100"')], self.rows('transactions'))
+        storage = self.open()
+        self.assertEqual({'x': 'y'}, storage.get('labels'))
+        self.assertEqual(4, storage.get_above_chain('seed_version'))
+        storage.close()
+
+    def test_tables_read_lazily(self):
+        storage = self.open(wallet_storage='sqlite')
+        storage.put('transactions', {'aa': '0100', 'bb': '0200'})
+        storage.close()
+
+        storage = self.open()
+        transactions = storage.get('transactions')
+        self.assertIsInstance(transactions, SqliteTable)
+        self.assertEqual({}, transactions.changed)
+        self.assertEqual('0100', transactions['aa'])
+        self.assertIsNone(transactions.get('cc'))
+        storage.put_item('transactions', 'cc', '0300')
+        storage.put_item('transactions', 'aa', None)
+        self.assertNotIn('aa', transactions)
+        self.assertEqual(['bb', 'cc'], sorted(transactions.keys()))
+        self.assertEqual({'bb': '0200', 'cc': '0300'}, copy.deepcopy(transactions))
+        storage.close()
+
+    def test_set_path(self):
+        storage = self.open(wallet_storage='sqlite')
+        storage.put('labels', {'a': 'b'})
+        storage.put('transactions', {'aa': '0100'})
+        storage.flush()
+        new_path = os.path.join(self.user_dir, 'otherwallet')
+        storage.set_path(new_path)
+        storage.put_item('transactions', 'bb', '0200')
+        storage.close()
+
+        storage = WalletStorage(FakeConfig(wallet_path=new_path))
+        self.assertEqual({'a': 'b'}, storage.get('labels'))
+        self.assertEqual({'aa': '0100', 'bb': '0200'}, storage.get('transactions'))
+        storage.close()
+
+    def test_put_whole_chain(self):
+        storage = self.open(wallet_storage='sqlite')
+        chain = copy.deepcopy(storage.get_above_chain('BTC'))
+        chain['transactions'] = {'aa': '0100'}
+        chain['accounts'] = {'0': {}}
+        storage.put_above_chain('BTC', chain)
+        storage.close()
+        self.assertEqual([('BTC', 'aa', '"0100"')], self.rows('transactions'))
+        storage = self.open()
+        self.assertEqual({'0': {}}, storage.get('accounts'))
+        storage.close()
+
+
+class TestMigrateWallet(SqliteStorageTestCase):
+
+    def test_migrate(self):
+        storage = self.open()
+        storage.put_above_chain('seed', 'abc')
+        storage.put('transactions', {'aa': '0100'})
+        storage.put('addr_history', {'1A': [['aa', 10]]})
+        storage.flush()
+        new_path = os.path.join(self.user_dir, 'newwallet')
+        migrate_wallet(self.path, new_path)
+
+        storage = WalletStorage(FakeConfig(wallet_path=new_path))
+        self.assertIs(SqliteWalletStorage, type(storage))
+        self.assertEqual('abc', storage.get_above_chain('seed'))
+        self.assertEqual({'aa': '0100'}, storage.get('transactions'))
+        self.assertEqual({'1A': [['aa', 10]]}, storage.get('addr_history'))
+        storage.close()
+
+        self.assertRaises(Exception, migrate_wallet, self.path, new_path)
+        self.assertRaises(Exception, migrate_wallet, new_path, self.path + '2')
+
+    def test_source_read_only(self):
+        # a wallet from before some chains were known
+        with open(self.path, 'w') as f:
+            json.dump({'seed': 'abc', 'BTC': {'transactions': {'aa': '0100'}}}, f)
+        source = WalletStorage(FakeConfig(wallet_path=self.path), read_only=True)
+        self.assertFalse(source.saver.dirty)
+        self.assertRaises(IOError, source.write)
+
+        new_path = os.path.join(self.user_dir, 'newwallet')
+        migrate_wallet(self.path, new_path)
+        self.assertFalse(os.path.exists(self.path + '.journal'))
+        storage = WalletStorage(FakeConfig(wallet_path=new_path))
+        self.assertEqual({'aa': '0100'}, storage.get('transactions'))
+        storage.close()
@@ -0,0 +1,60 @@
+import unittest
+
+from lib import chainparams
+from lib.bitcoin import Hash, public_key_from_private_key, ser_to_point, SECP256k1
+from lib.transaction import Transaction, SighashCache, SIGN_POOL_MIN
+
+import ecdsa
+
+
+class TestSighashCache(unittest.TestCase):
+
+    privkey = "L52XzL2cMkHxqxBXRyEpnPQZGUs3uKiL3R11XbAdHigRzDozKZeW"
+    address = "15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma"
+    redeem_script = '522102ee780aa224c9fe54caff984205077b7cca08ced3188a3f3c639d83deda6b9a592103124429ddbed55593d0abea0d0d3d283eca4546e40017b2945f4666c561b494ba52ae'
+    p2sh_address = '3MqemPAHZDGLr537QBvU7i4dRFY3Xvad7X'
+
+    def setUp(self):
+        super(TestSighashCache, self).setUp()
+        chainparams.set_active_chain('BTC')
+        self.pubkey = public_key_from_private_key(self.privkey, chainparams.get_active_chain().wif_version)
+
+    def make_tx(self, num_inputs, p2sh=False):
+        inputs = []
+        for i in range(num_inputs):
+            txin = {'prevout_hash': '%064x' % (i + 1), 'prevout_n': i % 3, 'value': 10000,
+                    'address': self.address, 'pubkeys': [self.pubkey], 'x_pubkeys': [self.pubkey],
+                    'signatures': [None], 'num_sig': 1}
+            inputs.append(txin)
+        if p2sh:
+            inputs[1].update({'address': self.p2sh_address, 'redeemScript': self.redeem_script,
+                              'pubkeys': [None, None], 'x_pubkeys': [None, None],
+                              'signatures': [None, None], 'num_sig': 2})
+        outputs = [('address', self.address, 5000), ('address', self.p2sh_address, 3000)]
+        return Transaction(inputs, outputs)
+
+    def test_preimage_matches_serialization(self):
+        tx = self.make_tx(5, p2sh=True)
+        cache = SighashCache(tx)
+        for i in range(len(tx.inputs)):
+            preimage = tx.tx_for_sig(i).decode('hex')
+            self.assertEqual(preimage, cache.preimage(i))
+            self.assertEqual(Hash(preimage), cache.sighash(i))
+
+    def test_signatures_are_valid(self):
+        tx = self.make_tx(4)
+        expected = [Hash(tx.tx_for_sig(i).decode('hex')) for i in range(len(tx.inputs))]
+        tx.sign({self.pubkey: self.privkey})
+        self.assertTrue(tx.is_complete())
+        public_key = ecdsa.VerifyingKey.from_public_point(ser_to_point(self.pubkey.decode('hex')), curve=SECP256k1)
+        for i, txin in enumerate(tx.inputs):
+            sig = txin['signatures'][0].decode('hex')
+            self.assertTrue(public_key.verify_digest(sig, expected[i], sigdecode=ecdsa.util.sigdecode_der))
+
+    def test_pool_matches_sequential(self):
+        tx = self.make_tx(SIGN_POOL_MIN)
+        other = self.make_tx(SIGN_POOL_MIN)
+        tx.sign({self.pubkey: self.privkey})
+        other.sign({self.pubkey: self.privkey}, 2)
+        self.assertTrue(other.is_complete())
+        self.assertEqual(tx.raw, other.raw)
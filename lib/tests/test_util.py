@@ -1,5 +1,7 @@
+import threading
+import time
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, FlushScheduler
 
 class TestUtil(unittest.TestCase):
 
@@ -63,3 +65,85 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+
+class TestFlushScheduler(unittest.TestCase):
+
+    def setUp(self):
+        super(TestFlushScheduler, self).setUp()
+        self.saves = []
+
+    def save(self):
+        self.saves.append(time.time())
+
+    def test_coalesces_until_interval(self):
+        scheduler = FlushScheduler(self.save, 0.1)
+        for i in range(5):
+            scheduler.mark_dirty()
+        self.assertEqual([], self.saves)
+        time.sleep(0.3)
+        self.assertEqual(1, len(self.saves))
+        self.assertEqual(1, scheduler.flushes)
+        self.assertEqual(4, scheduler.flushes_avoided)
+
+    def test_flush(self):
+        scheduler = FlushScheduler(self.save, 60)
+        scheduler.flush()
+        self.assertEqual([], self.saves)
+        scheduler.mark_dirty()
+        scheduler.flush()
+        scheduler.flush()
+        self.assertEqual(1, len(self.saves))
+        self.assertIsNone(scheduler.timer)
+
+    def test_flush_while_timer_waits(self):
+        scheduler = FlushScheduler(self.save, 0.05)
+        scheduler.mark_dirty()
+        flusher = threading.Thread(target=scheduler.flush)
+        flusher.daemon = True
+        with scheduler.lock:
+            # the timer fires and waits for the flush holding flush_lock
+            flusher.start()
+            time.sleep(0.2)
+        flusher.join(2)
+        self.assertFalse(flusher.is_alive())
+        self.assertEqual(1, len(self.saves))
+
+    def test_no_interval_saves_at_once(self):
+        scheduler = FlushScheduler(self.save, 0)
+        scheduler.mark_dirty()
+        scheduler.mark_dirty()
+        self.assertEqual(2, len(self.saves))
+        self.assertEqual(0, scheduler.flushes_avoided)
+
+    def test_failed_flush_is_retried(self):
+        failures = [IOError("disk full")]
+        def save():
+            if failures:
+                raise failures.pop()
+            self.save()
+        scheduler = FlushScheduler(save, 60)
+        scheduler.mark_dirty()
+        self.assertRaises(IOError, scheduler.flush)
+        self.assertTrue(scheduler.dirty)
+        scheduler.flush()
+        self.assertEqual(1, len(self.saves))
+        self.assertFalse(scheduler.dirty)
+
+    def test_failed_flush_is_retried_later(self):
+        failures = [IOError("disk full")]
+        def save():
+            if failures:
+                raise failures.pop()
+            self.save()
+        scheduler = FlushScheduler(save, 0.05)
+        scheduler.dirty = True
+        self.assertRaises(IOError, scheduler.flush)
+        time.sleep(0.3)
+        self.assertEqual(1, len(self.saves))
+
+        # without an interval, on the next change
+        failures.append(IOError("disk full"))
+        scheduler = FlushScheduler(save, 0)
+        self.assertRaises(IOError, scheduler.mark_dirty)
+        scheduler.mark_dirty()
+        self.assertEqual(2, len(self.saves))
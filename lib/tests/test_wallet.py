@@ -4,10 +4,13 @@ import sys
 import unittest
 import os
 import json
+import copy
 
 from StringIO import StringIO
 from lib.wallet import WalletStorage, NewWallet
 from lib import chainparams
+from lib.transaction import Transaction
+from lib.bitcoin import bc_address_to_hash_160
 
 if chainparams.get_active_chain() is None:
     chainparams.set_active_chain('BTC')
@@ -29,6 +32,12 @@ class FakeConfig(object):
         return self.store.get(key, default)
 
 
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.pending_transactions_for_notifications = []
+
+
 class FakeSynchronizer(object):
 
     def __init__(self):
@@ -45,6 +54,8 @@ class WalletTestCase(unittest.TestCase):
         self.user_dir = tempfile.mkdtemp()
 
         self.fake_config = FakeConfig(self.user_dir)
+        # save at once, so that no flush is left to run after tearDown
+        self.fake_config.set('flush_interval', 0)
 
         self._saved_stdout = sys.stdout
         self._stdout_buffer = StringIO()
@@ -107,6 +118,218 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_put_is_journaled(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.write()
+        storage.put("history", {"a": [1], "b": [2]})
+        storage.flush()
+        storage.put("history", {"a": [1], "b": [2], "c": [3]})
+        storage.flush()
+        storage.put("labels", {"x": "y"})
+        storage.flush()
+        storage.put("labels", None)
+        storage.flush()
+
+        with open(storage.journal_path(), "r") as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(["update", {"set": {"c": [3]}, "del": []}], entries[1][2:])
+        self.assertEqual(["del", None], entries[-1][2:])
+
+        other = WalletStorage(self.fake_config)
+        self.assertEqual({"a": [1], "b": [2], "c": [3]}, other.get("history"))
+        self.assertIsNone(other.get("labels"))
+
+    def test_put_without_save_is_journaled_later(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", 1, False)
+        storage.put_above_chain("b", 2)
+        storage.flush()
+        other = WalletStorage(self.fake_config)
+        self.assertEqual(1, other.get("a"))
+        self.assertEqual(2, other.get_above_chain("b"))
+
+    def test_truncated_journal_entry_is_ignored(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", 1)
+        storage.flush()
+        with open(storage.journal_path(), "a") as f:
+            f.write('["BTC", "a", "se')
+        other = WalletStorage(self.fake_config)
+        self.assertEqual(1, other.get("a"))
+
+    def test_failed_save_is_retried(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", 1)
+
+        journal = storage.journal
+        class FullJournal(object):
+            def write(self, s):
+                journal.write(s[:10])
+                journal.flush()
+                raise IOError("disk full")
+            def close(self):
+                journal.close()
+        storage.journal = FullJournal()
+        self.assertRaises(IOError, storage.put, "b", 2)
+        self.assertTrue(storage.saver.dirty)
+
+        # saved with the next change, after the entry that was cut short
+        storage.put_item("labels", "x", "y")
+        self.assertEqual({}, storage.pending)
+        other = WalletStorage(self.fake_config)
+        self.assertEqual((1, 2), (other.get("a"), other.get("b")))
+        self.assertEqual({"x": "y"}, other.get("labels"))
+
+    def test_journal_is_compacted(self):
+        from lib import wallet
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        compact_size = wallet.JOURNAL_COMPACT_SIZE
+        wallet.JOURNAL_COMPACT_SIZE = 0
+        try:
+            storage = WalletStorage(self.fake_config)
+            storage.write()
+            storage.put("a", "x" * 10000)
+            storage.flush()
+            storage.compactor.join()
+        finally:
+            wallet.JOURNAL_COMPACT_SIZE = compact_size
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        self.assertFalse(os.path.exists(storage.journal_path('.old')))
+        with open(path, "r") as f:
+            self.assertEqual("x" * 10000, json.load(f)["BTC"]["a"])
+        storage.put("b", 1)
+        storage.flush()
+        other = WalletStorage(self.fake_config)
+        self.assertEqual("x" * 10000, other.get("a"))
+        self.assertEqual(1, other.get("b"))
+
+    def test_interrupted_compaction_is_kept(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.write()
+        storage.put("a", 1)
+        # a compaction that stopped before writing the wallet file, the
+        # last entry of its journal cut short
+        storage.close_journal()
+        os.rename(storage.journal_path(), storage.journal_path('.old'))
+        with open(storage.journal_path('.old'), "a") as f:
+            f.write('["BTC", "x", "se')
+
+        storage = WalletStorage(self.fake_config)
+        self.assertEqual(1, storage.get("a"))
+        storage.put("b", 2)
+
+        def fail(s):
+            raise IOError("disk full")
+        storage.write_file = fail
+        self.assertRaises(IOError, storage.compact)
+        self.assertIsNone(storage.compactor)
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        other = WalletStorage(self.fake_config)
+        self.assertEqual((1, 2), (other.get("a"), other.get("b")))
+
+        del storage.write_file
+        storage.compact()
+        self.assertFalse(os.path.exists(storage.journal_path('.old')))
+        with open(path, "r") as f:
+            data = json.load(f)["BTC"]
+        self.assertEqual((1, 2), (data["a"], data["b"]))
+
+    def test_get_returns_frozen_value(self):
+        storage = WalletStorage(self.fake_config)
+        history = {"a": [["tx", 1]]}
+        storage.put("addr_history", history)
+        history["b"] = []
+        value = storage.get("addr_history")
+        self.assertEqual({"a": [["tx", 1]]}, value)
+        self.assertIs(value, storage.get("addr_history"))
+        self.assertRaises(TypeError, value.__setitem__, "b", [])
+        self.assertRaises(TypeError, value["a"].append, ["tx2", 2])
+        chain = storage.get_above_chain("BTC")
+        self.assertRaises(TypeError, chain.pop, "addr_history")
+        mutable = copy.deepcopy(value)
+        mutable["a"].append(["tx2", 2])
+        storage.put("addr_history", mutable)
+        self.assertEqual(2, len(storage.get("addr_history")["a"]))
+        self.assertEqual(1, len(value["a"]))
+
+    def test_put_item(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.write()
+        storage.put("addr_history", {"a": [["tx", 1]], "b": []})
+        storage.flush()
+        before = storage.get("addr_history")
+        storage.put_item("addr_history", "c", [["tx2", 2]], False)
+        storage.put_item("addr_history", "b", None)
+        storage.flush()
+        # only the items are journaled, and earlier values are left alone
+        with open(storage.journal_path(), "r") as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(["update", {"set": {"c": [["tx2", 2]]}, "del": ["b"]}], entries[-1][2:])
+        self.assertEqual({"a": [["tx", 1]], "b": []}, before)
+        value = storage.get("addr_history")
+        self.assertEqual({"a": [["tx", 1]], "c": [["tx2", 2]]}, value)
+        self.assertRaises(TypeError, value["c"].append, [])
+        self.assertEqual(value, WalletStorage(self.fake_config).get("addr_history"))
+
+    def test_put_item_after_get(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.put_item("labels", "a", "x")
+        value = storage.get("labels")
+        chain_value = storage.get_above_chain("BTC")["labels"]
+        # the dict that was handed out is copied, then updated in place
+        storage.put_item("labels", "b", "y")
+        d = storage.data["BTC"]["labels"]
+        storage.put_item("labels", "c", "z")
+        self.assertIs(d, storage.data["BTC"]["labels"])
+        self.assertEqual("z", storage.get_item("labels", "c"))
+        storage.put_item("labels", "d", "w")
+        self.assertIs(d, storage.data["BTC"]["labels"])
+        self.assertEqual({"a": "x"}, value)
+        self.assertEqual({"a": "x"}, chain_value)
+        self.assertEqual({"a": "x", "b": "y", "c": "z", "d": "w"}, storage.get("labels"))
+
+    def test_set_path(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        storage = WalletStorage(self.fake_config)
+        storage.put("a", 1)
+        storage.flush()
+        storage.set_path(path + ".copy")
+        storage.put("a", 2)
+        storage.flush()
+        self.assertEqual(1, WalletStorage(self.fake_config).get("a"))
+        self.fake_config.set("wallet_path", path + ".copy")
+        self.assertEqual(2, WalletStorage(self.fake_config).get("a"))
+
+    def test_saves_are_coalesced(self):
+        path = os.path.join(self.user_dir, "somewallet")
+        self.fake_config.set("wallet_path", path)
+        self.fake_config.set("flush_interval", 60)
+        storage = WalletStorage(self.fake_config)
+        avoided = storage.saver.flushes_avoided
+        for i in range(10):
+            storage.put("a", i)
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        self.assertEqual(avoided + 10, storage.saver.flushes_avoided)
+        storage.flush()
+        self.assertEqual(1, storage.saver.flushes)
+        self.assertEqual(9, WalletStorage(self.fake_config).get("a"))
+
 
 class TestNewWallet(WalletTestCase):
 
@@ -165,7 +388,261 @@ class TestNewWallet(WalletTestCase):
         self.assertEqual(0, len(self.wallet.addresses()))
         self.assertNotIn(self.import_key_address, self.wallet.addresses())
 
+    def test_address_index(self):
+        self.wallet.synchronize()
+        self.wallet.import_key(self.import_private_key, "")
+        new_address = self.wallet.create_new_address(self.wallet.accounts['0'], 1)
+        for account_id, account in self.wallet.accounts.items():
+            for for_change in [0, 1]:
+                for n, addr in enumerate(account.get_addresses(for_change)):
+                    self.assertTrue(self.wallet.is_mine(addr))
+                    self.assertEqual((account_id, (for_change, n)), self.wallet.get_address_index(addr))
+        self.assertTrue(self.wallet.is_change(new_address))
+
+        self.wallet.delete_imported_key(self.import_key_address)
+        self.assertFalse(self.wallet.is_mine(self.import_key_address))
+        self.assertRaises(Exception, self.wallet.get_address_index, self.import_key_address)
+        self.assertEqual(len(self.wallet.addresses()), len(self.wallet.address_index))
+
+    def test_derive_range(self):
+        from lib.account import DERIVE_POOL_MIN
+        account = self.wallet.accounts['0']
+        for for_change in [0, 1]:
+            expected = [account.derive_pubkeys(for_change, n) for n in range(5, 30)]
+            self.assertEqual(expected, account.derive_range(for_change, 5, 25))
+        pubkeys = account.derive_range(0, 0, DERIVE_POOL_MIN)
+        self.assertEqual(pubkeys, account.derive_range(0, 0, DERIVE_POOL_MIN, 2))
+
+        self.wallet.synchronize()
+        self.assertEqual(account.gap_limit, len(account.get_addresses(0)))
+        self.assertEqual(map(account.pubkeys_to_address, pubkeys[:account.gap_limit]), account.get_addresses(0))
+        # an address in use moves the gap forward
+        self.wallet.history[account.get_addresses(0)[3]] = ['*']
+        self.wallet.synchronize()
+        self.assertEqual(map(account.pubkeys_to_address, pubkeys[:account.gap_limit + 4]), account.get_addresses(0))
+
     def test_update_password(self):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+
+def make_raw_tx(prevout_hash, address, value, pubkey=None):
+    """A transaction with one input and one output. The input is signed
+    with a dummy signature if pubkey is given."""
+    import struct
+    from lib.bitcoin import bc_address_to_hash_160
+    script_sig = ''
+    if pubkey:
+        sig = '30' + '00' * 69 + '01'
+        script_sig = '%02x' % (len(sig) / 2) + sig + '%02x' % (len(pubkey) / 2) + pubkey
+    return ('01000000' + '01' + prevout_hash + '00000000' + '%02x' % (len(script_sig) / 2) + script_sig + 'ffffffff'
+            + '01' + struct.pack('<Q', value).encode('hex')
+            + '1976a914' + bc_address_to_hash_160(address)[1].encode('hex') + '88ac' + '00000000')
+
+
+class TestOldAccount(unittest.TestCase):
+
+    seed = "abcdef0123456789"
+    mpk = "f3255d12852361248a308a097ce75807973a078b79f96b50511d7dc555015f6b9f1246efc5ffe72ce2960c6f1a1662d439d8202df545efc7e3275db8031f4308"
+
+    def test_keys(self):
+        from lib.account import OldAccount
+        self.assertEqual(self.mpk, OldAccount.mpk_from_seed(self.seed))
+        account = OldAccount({'mpk': self.mpk, 0: [], 1: []})
+        self.assertTrue(account.check_seed(self.seed))
+        self.assertRaises(Exception, account.check_seed, "0123456789abcdef")
+        pubkeys = account.derive_range(1, 2, 2)
+        self.assertEqual(["04" + x for x in [
+            "5ecf7dff5302c32837513c61f8348fae5755a410c0740731a97dd8037fcea358f78ef07395e695ef819e1f420e50cf6e7d05cb0c1e6ba7761e0edb657ad433e2",
+            "f76745c14b2570f2c0bf38b7fbd9a629882067b6d1481e92547802dd05f88861f8d7f44b7ac4fa39844d4bd12ebcbd7228e6913f41991e543e90a00d5881e18f"]],
+            pubkeys)
+        self.assertEqual(pubkeys[1], account.derive_pubkeys(1, 3))
+        self.assertEqual("04c00a5a4cb001602d5b701914a99cc60a1a6ee69fb1354d8765fabf92034e87d308dcb02516f41e9e08399f43ded0a8d4854815e5b8a1486823f90cf6d9471b54",
+                         account.derive_pubkeys(0, 0))
+        pk = account.get_private_key_from_stretched_exponent(1, 3, OldAccount.stretch_key(self.seed))
+        self.assertEqual("5HqwqZdZMNeuSTNxxrLX4gB2cmz4qEUarUTrQGkaC28rosbt9Q4", pk)
+
+
+class TestWalletTransactions(WalletTestCase):
+
+    wallet_storage = None
+
+    def setUp(self):
+        super(TestWalletTransactions, self).setUp()
+        self.fake_config.set('wallet_storage', self.wallet_storage)
+        self.storage = WalletStorage(self.fake_config)
+        wallet = NewWallet(self.storage)
+        wallet.add_seed(TestNewWallet.seed_text, None)
+        wallet.create_master_keys(None)
+        wallet.create_main_account(None)
+        wallet.synchronize()
+        self.address = wallet.addresses(False)[0]
+        transactions = {}
+        history = []
+        for i in range(3):
+            raw = make_raw_tx('%064x' % (i + 1), self.address, 1000 * (i + 1))
+            tx = Transaction.deserialize(raw)
+            transactions[tx.hash()] = raw
+            history.append([tx.hash(), 100 + i])
+        # not in the history: dropped when loading
+        transactions['ff' * 32] = make_raw_tx('aa' * 32, self.address, 1)
+        self.storage.put('transactions', transactions)
+        self.storage.put('addr_history', {self.address: history})
+        self.tx_hashes = [h for h, height in history]
+
+    def test_transactions_parsed_on_demand(self):
+        # the first time, transactions are parsed to build the output index
+        NewWallet(self.storage)
+        wallet = NewWallet(self.storage)
+        self.assertEqual(3, len(wallet.transactions))
+        self.assertNotIn('ff' * 32, wallet.transactions)
+        self.assertEqual({}, wallet.transactions.parsed)
+        tx = wallet.transactions.get(self.tx_hashes[0])
+        self.assertEqual(self.tx_hashes[0], tx.hash())
+        self.assertEqual([self.tx_hashes[0]], wallet.transactions.parsed.keys())
+
+    def test_output_index_saved(self):
+        wallet = NewWallet(self.storage)
+        index = self.storage.get('tx_outputs')
+        self.assertEqual(sorted(self.tx_hashes), sorted(index.keys()))
+        self.assertEqual([[self.address, 1000]], index[self.tx_hashes[0]][0])
+
+        wallet = NewWallet(self.storage)
+        self.assertEqual((6000, 0), wallet.get_balance())
+        self.assertEqual({}, wallet.transactions.parsed)
+        self.assertEqual(2000, wallet.prevout_values[self.tx_hashes[1] + ':0'])
+
+    def test_unspent_coins(self):
+        wallet = NewWallet(self.storage)
+        coins = wallet.get_unspent_coins()
+        self.assertEqual(self.tx_hashes, [c['prevout_hash'] for c in coins])
+        self.assertEqual([100, 101, 102], [c['height'] for c in coins])
+        self.assertEqual(coins, wallet.get_unspent_coins([self.address]))
+        self.assertEqual(coins, wallet.get_account_coins(wallet.accounts.keys()[0]))
+        self.assertEqual([], wallet.get_unspent_coins([wallet.addresses()[1]]))
+
+    def test_unspent_coins_updated(self):
+        wallet = NewWallet(self.storage)
+        wallet.network = FakeNetwork()
+        other = wallet.addresses()[1]
+        pubkey = wallet.get_public_keys(self.address)[0]
+        raw = make_raw_tx(self.tx_hashes[0].decode('hex')[::-1].encode('hex'), other, 900, pubkey)
+        tx = Transaction.deserialize(raw)
+        self.assertEqual(self.address, tx.inputs[0]['address'])
+        history = wallet.history[self.address] + [[tx.hash(), 0]]
+        wallet.receive_history_callback(self.address, history)
+        wallet.receive_history_callback(other, [[tx.hash(), 0]])
+        wallet.receive_tx_callback(tx.hash(), tx, 0)
+
+        coins = wallet.get_unspent_coins()
+        self.assertEqual(self.tx_hashes[1:] + [tx.hash()], [c['prevout_hash'] for c in coins])
+        self.assertEqual(0, coins[-1]['height'])
+        self.assertEqual([tx.hash()], [c['prevout_hash'] for c in wallet.get_unspent_coins([other])])
+
+
+    def test_balance_cache_invalidated(self):
+        wallet = NewWallet(self.storage)
+        wallet.network = FakeNetwork()
+        other = wallet.addresses()[1]
+        account = wallet.accounts.keys()[0]
+        self.assertEqual((6000, 0), wallet.get_account_balance(account))
+        self.assertIn(self.address, wallet.balance_cache)
+
+        pubkey = wallet.get_public_keys(self.address)[0]
+        raw = make_raw_tx(self.tx_hashes[0].decode('hex')[::-1].encode('hex'), other, 900, pubkey)
+        tx = Transaction.deserialize(raw)
+        history = wallet.history[self.address] + [[tx.hash(), 0]]
+        wallet.receive_history_callback(self.address, history)
+        wallet.receive_history_callback(other, [[tx.hash(), 0]])
+        self.assertEqual((6000, 0), wallet.get_addr_balance(self.address))
+        wallet.receive_tx_callback(tx.hash(), tx, 0)
+        self.assertEqual((6000, -1000), wallet.get_addr_balance(self.address))
+        self.assertEqual((0, 900), wallet.get_addr_balance(other))
+        self.assertEqual((6000, -100), wallet.get_account_balance(account))
+
+        # confirmed
+        wallet.receive_history_callback(other, [[tx.hash(), 103]])
+        self.assertEqual((900, 0), wallet.get_addr_balance(other))
+        self.assertEqual((6000, -1000), wallet.get_addr_balance(self.address))
+
+    def test_tx_addresses_index(self):
+        wallet = NewWallet(self.storage)
+        wallet.network = FakeNetwork()
+        other = wallet.addresses()[1]
+        self.assertEqual(set(self.tx_hashes), set(wallet.tx_addresses))
+        self.assertEqual(set([self.address]), wallet.tx_addresses[self.tx_hashes[0]])
+
+        pubkey = wallet.get_public_keys(self.address)[0]
+        tx = Transaction.deserialize(make_raw_tx(self.tx_hashes[0].decode('hex')[::-1].encode('hex'), other, 900, pubkey))
+        self.assertFalse(wallet.check_new_tx(tx.hash(), tx))
+        wallet.receive_history_callback(self.address, wallet.history[self.address] + [[tx.hash(), 0]])
+        wallet.receive_history_callback(other, [[tx.hash(), 0]])
+        self.assertEqual(set([self.address, other]), wallet.tx_addresses[tx.hash()])
+        self.assertTrue(wallet.check_new_tx(tx.hash(), tx))
+        wallet.receive_tx_callback(tx.hash(), tx, 0)
+
+        # still in the history of other: not orphaned
+        wallet.receive_history_callback(self.address, wallet.history[self.address][:3])
+        self.assertEqual(set([other]), wallet.tx_addresses[tx.hash()])
+        self.assertIn(tx.hash(), wallet.transactions)
+
+    def test_history_diff(self):
+        wallet = NewWallet(self.storage)
+        old = wallet.history[self.address]
+        new = [old[0], [self.tx_hashes[1], 200], ['ee' * 32, 0]]
+        self.assertEqual(([('ee' * 32, 0)], [self.tx_hashes[2]], [(self.tx_hashes[1], 200)]),
+                         wallet.diff_history(old, new))
+        self.assertEqual(([], self.tx_hashes, []), wallet.diff_history(old, ['*']))
+
+        class FakeVerifier(object):
+            def __init__(self):
+                self.added = []
+            def add(self, tx_hash, tx_height):
+                self.added.append((tx_hash, tx_height))
+        wallet.verifier = FakeVerifier()
+        confirmed = old[:2] + [[self.tx_hashes[2], 300]]
+        self.assertEqual(([], [], [(self.tx_hashes[2], 300)]), wallet.receive_history_callback(self.address, confirmed))
+        self.assertEqual([(self.tx_hashes[2], 300)], wallet.verifier.added)
+        self.assertEqual(300, wallet.get_unspent_coins()[-1]['height'])
+        self.assertEqual(([], [], []), wallet.receive_history_callback(self.address, confirmed))
+        self.assertEqual(1, len(wallet.verifier.added))
+        # the synchronizer passes tuples
+        flushes = self.storage.saver.flushes
+        self.assertEqual(([], [], []), wallet.receive_history_callback(self.address, map(tuple, confirmed)))
+        self.assertEqual(flushes, self.storage.saver.flushes)
+
+    def test_pubkey_input_resolved_later(self):
+        import struct
+        wallet = NewWallet(self.storage)
+        wallet.network = FakeNetwork()
+        other = wallet.addresses()[1]
+        pubkey = wallet.get_public_keys(self.address)[0]
+        # funding pays to the public key, and is received after the
+        # transaction spending it
+        funding = Transaction.deserialize('01000000' + '01' + 'cc' * 32 + '00000000' + '00' + 'ffffffff'
+                                          + '01' + struct.pack('<Q', 5000).encode('hex')
+                                          + '%02x' % (len(pubkey) / 2 + 2) + '%02x' % (len(pubkey) / 2) + pubkey + 'ac'
+                                          + '00000000')
+        sig = '30' + '00' * 69 + '01'
+        spending = Transaction.deserialize('01000000' + '01' + funding.hash().decode('hex')[::-1].encode('hex') + '00000000'
+                                           + '%02x' % (len(sig) / 2 + 1) + '%02x' % (len(sig) / 2) + sig + 'ffffffff'
+                                           + '01' + struct.pack('<Q', 4000).encode('hex')
+                                           + '1976a914' + bc_address_to_hash_160(other)[1].encode('hex') + '88ac'
+                                           + '00000000')
+        wallet.receive_history_callback(self.address, wallet.history[self.address] + [[funding.hash(), 0]])
+        wallet.receive_history_callback(other, [[spending.hash(), 0]])
+        wallet.receive_tx_callback(spending.hash(), spending, 0)
+        self.assertEqual("(pubkey)", wallet.tx_outputs[spending.hash()][1][0][1])
+        wallet.receive_tx_callback(funding.hash(), funding, 0)
+
+        self.assertEqual(self.address, self.storage.get('tx_outputs')[spending.hash()][1][0][1])
+        for w in [wallet, NewWallet(self.storage)]:
+            coins = [c['prevout_hash'] for c in w.get_unspent_coins()]
+            self.assertNotIn(funding.hash(), coins)
+            self.assertIn(spending.hash(), coins)
+
+
+class TestSqliteWalletTransactions(TestWalletTransactions):
+
+    wallet_storage = 'sqlite'
@@ -22,6 +22,7 @@
 
 import bitcoin
 from bitcoin import *
+import ecc
 from util import print_error
 import time
 import struct
@@ -34,6 +35,7 @@ import struct
 import StringIO
 import mmap
 import random
+import multiprocessing
 
 NO_SIGNATURE = 'ff'
 
@@ -501,6 +503,99 @@ def deserialize(raw):
 
 push_script = lambda x: op_push(len(x)/2) + x
 
+
+class SighashCache(object):
+    '''Signature hashes (SIGHASH_ALL) of the inputs of a transaction.
+
+    The preimage for input i is the transaction with the script of input i
+    and empty scripts for the other inputs. The parts shared by every
+    input are serialized once, as bytes; each hash then only adds the
+    script of its input, so that signing n inputs does not serialize the
+    transaction n times.
+    '''
+
+    # outpoint, empty script and sequence
+    empty_input_size = 36 + 1 + 4
+
+    def __init__(self, tx):
+        self.tx = tx
+        self.outpoints = [txin['prevout_hash'].decode('hex')[::-1] + struct.pack('<I', txin['prevout_n'])
+                          for txin in tx.inputs]
+        # inputs with empty scripts, one after the other
+        empty = [outpoint + '\x00\xff\xff\xff\xff' for outpoint in self.outpoints]
+        self.empty_inputs = ''.join(empty)
+        self.prefix = struct.pack('<I', 1) + var_int(len(tx.inputs)).decode('hex')
+        outputs = [var_int(len(tx.outputs)).decode('hex')]
+        for type, addr, amount in tx.outputs:
+            script = tx.pay_script(type, addr).decode('hex')
+            outputs.append(struct.pack('<Q', amount) + var_int(len(script)).decode('hex') + script)
+        outputs.append(struct.pack('<I', 0))                 # lock time
+        outputs.append(struct.pack('<I', 1))                 # hash type
+        self.suffix = ''.join(outputs)
+
+    def script_code(self, i):
+        txin = self.tx.inputs[i]
+        if txin.get('redeemScript') is not None:
+            return txin['redeemScript'].decode('hex')
+        return self.tx.pay_script('address', txin['address']).decode('hex')
+
+    def preimage(self, i):
+        script = self.script_code(i)
+        start = i * self.empty_input_size
+        return ''.join([self.prefix, self.empty_inputs[:start], self.outpoints[i],
+                        var_int(len(script)).decode('hex'), script, '\xff\xff\xff\xff',
+                        self.empty_inputs[start + self.empty_input_size:], self.suffix])
+
+    def sighash(self, i):
+        '''Double SHA256 of the preimage of input i.'''
+        script = self.script_code(i)
+        start = i * self.empty_input_size
+        h = hashlib.sha256(self.prefix)
+        h.update(buffer(self.empty_inputs, 0, start))
+        h.update(self.outpoints[i])
+        h.update(var_int(len(script)).decode('hex'))
+        h.update(script)
+        h.update('\xff\xff\xff\xff')
+        h.update(buffer(self.empty_inputs, start + self.empty_input_size))
+        h.update(self.suffix)
+        return hashlib.sha256(h.digest()).digest()
+
+
+# fewer signatures than this are not worth starting worker processes for
+SIGN_POOL_MIN = 16
+
+# signing keys of the current process, by secret exponent
+_signing_keys = {}
+
+def _sign_digest(args):
+    secexp, digest = args
+    key = _signing_keys.get(secexp)
+    if key is None:
+        key = _signing_keys[secexp] = ecc.backend.signing_key(number_to_string(secexp, SECP256k1.order))
+    return ecc.backend.sign(key, digest)
+
+
+def sign_digests(jobs, workers=1):
+    '''DER signatures of a list of (secret exponent, digest), in order.
+
+    With more than one worker and enough jobs, the signatures are made in
+    a pool of worker processes. The keys are sent to the workers through
+    pipes, never written to disk, and the pool is terminated once done.
+    '''
+    if workers > 1 and len(jobs) >= SIGN_POOL_MIN:
+        pool = multiprocessing.Pool(workers)
+        try:
+            chunksize = max(1, len(jobs) / (workers * 4))
+            return pool.map(_sign_digest, jobs, chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+    try:
+        return map(_sign_digest, jobs)
+    finally:
+        _signing_keys.clear()
+
+
 class Transaction:
 
     def __str__(self):
@@ -530,14 +625,16 @@ class Transaction:
         self.locktime = d['lockTime']
 
     @classmethod
-    def sweep(klass, privkeys, network, to_address, fee):
+    def sweep(klass, privkeys, network, to_address, fee, workers=1):
         inputs = []
+        keypairs = {}
         for privkey in privkeys:
             pubkey = public_key_from_private_key(privkey, chainparams.get_active_chain().wif_version)
             address = address_from_private_key(privkey,
                 chainparams.get_active_chain().p2pkh_version, chainparams.get_active_chain().wif_version)
             u = network.synchronous_get([ ('blockchain.address.listunspent',[address])])[0]
             pay_script = klass.pay_script('address', address)
+            keypairs[pubkey] = privkey
             for item in u:
                 item['scriptPubKey'] = pay_script
                 item['redeemPubkey'] = pubkey
@@ -545,7 +642,7 @@ class Transaction:
                 item['prevout_hash'] = item['tx_hash']
                 item['prevout_n'] = item['tx_pos']
                 item['pubkeys'] = [pubkey]
-                item['x_pubkeys'] = [None]
+                item['x_pubkeys'] = [pubkey]
                 item['signatures'] = [None]
                 item['num_sig'] = 1
             inputs += u
@@ -556,7 +653,7 @@ class Transaction:
         total = sum( map(lambda x:int(x.get('value')), inputs) ) - fee
         outputs = [('address', to_address, total)]
         self = klass(inputs, outputs)
-        self.sign({ pubkey:privkey })
+        self.sign(keypairs, workers)
         return self
 
     @classmethod
@@ -735,8 +832,11 @@ class Transaction:
                 out.add(x_pubkey)
         return out
 
-    def sign(self, keypairs):
+    def sign(self, keypairs, workers=1):
         print_error("tx.sign(), keypairs:", keypairs)
+        sighashes = None
+        keys = {}       # sec -> (pubkey, secret exponent)
+        jobs = []       # (input index, pubkey index, secret exponent, sighash)
         for i, txin in enumerate(self.inputs):
             signatures = filter(lambda x: x is not None, txin['signatures'])
             num = txin['num_sig']
@@ -745,27 +845,28 @@ class Transaction:
                 continue
 
             for x_pubkey in txin['x_pubkeys']:
-                if x_pubkey in keypairs.keys():
+                if x_pubkey in keypairs:
                     print_error("adding signature for", x_pubkey)
                     # add pubkey to txin
                     txin = self.inputs[i]
                     x_pubkeys = txin['x_pubkeys']
                     ii = x_pubkeys.index(x_pubkey)
                     sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec, self.chain.wif_version)
+                    if sec not in keys:
+                        pubkey = public_key_from_private_key(sec, self.chain.wif_version)
+                        keys[sec] = pubkey, regenerate_key(sec, self.chain.wif_version).secret
+                    pubkey, secexp = keys[sec]
                     txin['x_pubkeys'][ii] = pubkey
                     txin['pubkeys'][ii] = pubkey
                     self.inputs[i] = txin
-                    # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec, self.chain.wif_version)
-                    secexp = pkey.secret
-                    private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][ii] = sig.encode('hex')
-                    self.inputs[i] = txin
+                    if sighashes is None:
+                        sighashes = SighashCache(self)
+                    jobs.append((i, ii, secexp, sighashes.sighash(i)))
+
+        # add signatures
+        sigs = sign_digests([(secexp, for_sig) for i, ii, secexp, for_sig in jobs], workers)
+        for (i, ii, secexp, for_sig), sig in zip(jobs, sigs):
+            self.inputs[i]['signatures'][ii] = sig.encode('hex')
 
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
@@ -1,5 +1,8 @@
 import os, sys, re, json
 import platform
+import atexit
+import threading
+import weakref
 import shutil
 from datetime import datetime
 is_verbose = False
@@ -356,3 +359,146 @@ class QueuePipe:
     def send_all(self, requests):
         for request in requests:
             self.send(request)
+
+
+# seconds a save may be delayed to be coalesced with the ones that follow
+FLUSH_INTERVAL = 1.0
+
+_flush_schedulers = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    for scheduler in list(_flush_schedulers):
+        try:
+            scheduler.flush()
+        except Exception as e:
+            print_error("flush failed:", e)
+
+
+class FlushScheduler(object):
+    """Coalesces saves that come in quick succession.
+
+    mark_dirty() schedules a call to flush_function interval seconds
+    later; the saves requested meanwhile are covered by that call and
+    counted in flushes_avoided. flush() saves now if anything is pending.
+    Everything pending is flushed when the interpreter exits.
+
+    If flush_function raises, the saves stay pending: flush re-raises,
+    and they are tried again by the next flush (scheduled interval
+    seconds later, or on the next mark_dirty without an interval).
+    """
+
+    def __init__(self, flush_function, interval=FLUSH_INTERVAL):
+        self.flush_function = flush_function
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.dirty = False
+        self.timer = None
+        self.flushes = 0
+        self.flushes_avoided = 0
+        _flush_schedulers.add(self)
+
+    def mark_dirty(self):
+        with self.lock:
+            if self.dirty and self.interval > 0:
+                self.flushes_avoided += 1
+                return
+            self.dirty = True
+            if self.interval > 0:
+                self.schedule()
+        if self.interval <= 0:
+            self.flush()
+
+    def schedule(self):
+        """Start the timer of the next flush. Call with self.lock held."""
+        self.timer = threading.Timer(self.interval, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if self.timer is not None:
+                    # not joined: a timer that already fired may be waiting
+                    # for flush_lock, and finds nothing to save once it has it
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+            try:
+                self.flush_function()
+            except Exception:
+                with self.lock:
+                    self.dirty = True
+                    if self.interval > 0 and self.timer is None:
+                        self.schedule()
+                raise
+            with self.lock:
+                self.flushes += 1
+
+
+def get_flush_interval(config):
+    value = config.get('flush_interval')
+    return FLUSH_INTERVAL if value is None else float(value)
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("%s is read-only" % type(self).__name__)
+
+
+class FrozenDict(dict):
+    """A dict that cannot be changed in place.
+
+    copy.deepcopy returns an ordinary, mutable copy.
+    """
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    """A list that cannot be changed in place.
+
+    copy.deepcopy returns an ordinary, mutable copy.
+    """
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value):
+    """Return a read-only copy of a JSON-like value.
+
+    Parts that are already frozen are shared rather than copied.
+    """
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, tuple):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Return a mutable deep copy of a value returned by freeze."""
+    if isinstance(value, dict):
+        return dict((k, thaw(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(thaw(v) for v in value)
+    return value
@@ -17,7 +17,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, time, Queue, os, sys, shutil
+import threading, time, Queue, os, sys, shutil, copy
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
 
@@ -33,8 +33,9 @@ class TxVerifier(threading.Thread):
         self.storage = storage
         self.network = network
         self.transactions    = {}                                 # requested verifications (with height sent by the requestor)
-        self.verified_tx     = storage.get('verified_tx3',{})      # height, timestamp of verified transactions
-        self.merkle_roots    = storage.get('merkle_roots',{})      # hashed by me
+        self.verified_tx     = copy.deepcopy(storage.get('verified_tx3',{}))      # height, timestamp of verified transactions
+        self.merkle_roots    = copy.deepcopy(storage.get('merkle_roots',{}))      # hashed by me
+        self.requested_merkle = set()
         self.lock = threading.Lock()
         self.running = False
         self.queue = Queue.Queue()
@@ -96,7 +97,6 @@ class TxVerifier(threading.Thread):
     def run(self):
         with self.lock:
             self.running = True
-        requested_merkle = []
 
         while self.is_running():
             # request missing tx
@@ -105,10 +105,10 @@ class TxVerifier(threading.Thread):
                     # do not request merkle branch before headers are available
                     if tx_height > self.network.get_local_height():
                         continue
-                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
+                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in self.requested_merkle:
                         if self.network.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], self.queue.put):
                             print_error('requesting merkle', tx_hash)
-                            requested_merkle.append(tx_hash)
+                            self.requested_merkle.add(tx_hash)
 
             try:
                 r = self.queue.get(timeout=0.1)
@@ -147,7 +147,7 @@ class TxVerifier(threading.Thread):
         with self.lock:
             self.verified_tx[tx_hash] = (tx_height, timestamp, pos)
         print_error("verified %s"%tx_hash)
-        self.storage.put('verified_tx3', self.verified_tx, True)
+        self.storage.put_item('verified_tx3', tx_hash, self.verified_tx[tx_hash])
         self.network.trigger_callback('updated')
 
 
@@ -163,11 +163,18 @@ class TxVerifier(threading.Thread):
     def undo_verifications(self, height):
         with self.lock:
             items = self.verified_tx.items()[:]
+        undone = False
         for tx_hash, item in items:
             tx_height, timestamp, pos = item
             if tx_height >= height:
                 print_error("redoing", tx_hash)
+                undone = True
                 with self.lock:
                     self.verified_tx.pop(tx_hash)
+                    self.storage.put_item('verified_tx3', tx_hash, None)
                     if tx_hash in self.merkle_roots:
                         self.merkle_roots.pop(tx_hash)
+                    # request the merkle branch again
+                    self.requested_merkle.discard(tx_hash)
+        if undone:
+            self.network.trigger_callback('updated')
@@ -26,9 +26,10 @@ import time
 import math
 import json
 import copy
+import shutil
 import chainparams
 
-from util import print_msg, print_error
+from util import print_msg, print_error, FlushScheduler, get_flush_interval, freeze, FrozenDict
 
 from bitcoin import *
 from account import *
@@ -46,18 +47,83 @@ from mnemonic import Mnemonic
 IMPORTED_ACCOUNT = '/x'
 
 
+def is_sqlite_wallet(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(16) == 'SQLite format 3\x00'
+    except IOError:
+        return False
+
+
+# Size in bytes past which the journal is folded back into the wallet file.
+# The wallet file's own size is used instead if it is larger.
+JOURNAL_COMPACT_SIZE = 1 << 20
+
+
 class WalletStorage(object):
+    """Wallet data, saved as a JSON file plus a journal of later changes.
+
+    Saving a key appends only what changed to the journal, so saving after
+    each transaction does not rewrite the whole wallet. The journal is
+    replayed when the wallet is opened, and folded back into the JSON file
+    by a background thread once it grows past JOURNAL_COMPACT_SIZE. The
+    JSON file has the same format as before, so older wallets open as is.
+
+    Saves are coalesced for flush_interval seconds (see FlushScheduler);
+    call flush() where they must be on disk before going on.
+
+    Values are stored frozen (see util.freeze) and get returns them
+    without copying. Change a copy.deepcopy of a value, then put it.
+
+    Wallets in an SQLite database, and new wallets when the config has
+    wallet_storage = sqlite, are opened as a SqliteWalletStorage instead.
+
+    A wallet opened with read_only set is only read: nothing is added to
+    it when it is opened, and saving it raises IOError.
+    """
 
-    def __init__(self, config):
+    def __new__(cls, config, read_only=False):
+        if cls is WalletStorage:
+            path = cls.init_path(config)
+            new = not os.path.exists(path) and not os.path.exists(path + '.journal')
+            if is_sqlite_wallet(path) or (new and config.get('wallet_storage') == 'sqlite'):
+                from sqlite_storage import SqliteWalletStorage
+                cls = SqliteWalletStorage
+        return object.__new__(cls)
+
+    def __init__(self, config, read_only=False):
         self.lock = threading.RLock()
         self.config = config
+        self.read_only = read_only
         self.data = {}
         self.file_exists = False
+        self.journal = None
+        self.journal_size = 0
+        self.file_size = 0
+        # (chain code, key) -> value last saved, for keys put without saving
+        self.pending = {}
+        # (chain code, key) -> items put with put_item since the last save
+        self.pending_items = {}
+        self.compactor = None
+        self.saver = FlushScheduler(self.save_pending, get_flush_interval(config))
         self.path = self.init_path(config)
         print_error( "wallet path", self.path )
         if self.path:
             self.read(self.path)
-        self._init_chains()
+        self._freeze_data()
+        if not read_only:
+            self._init_chains()
+
+    def _freeze_data(self):
+        for key, value in self.data.items():
+            if self.is_chain_dict(key, value):
+                self.data[key] = dict((k, freeze(v)) for k, v in value.iteritems())
+            else:
+                self.data[key] = freeze(value)
+
+    @staticmethod
+    def is_chain_dict(key, value):
+        return isinstance(value, dict) and chainparams.is_known_chain(key)
 
     def _init_chains(self):
         """Make sure there's a dictionary for each chain"""
@@ -65,7 +131,8 @@ class WalletStorage(object):
             if self.get_above_chain(code, None) is None:
                 self.put_above_chain(code, {})
 
-    def init_path(self, config):
+    @staticmethod
+    def init_path(config):
         """Set the path of the wallet."""
 
         # command line -w option
@@ -96,38 +163,79 @@ class WalletStorage(object):
 
         return new_path
 
+    def journal_path(self, suffix=''):
+        return self.path + '.journal' + suffix
+
     def read(self, path):
-        """Read the contents of the wallet file."""
+        """Read the contents of the wallet file, then replay its journal."""
         try:
             with open(self.path, "r") as f:
                 data = f.read()
         except IOError:
-            return
-        try:
-            self.data = json.loads(data)
-        except:
+            data = None
+        if data is not None:
+            self.file_size = len(data)
             try:
-                d = ast.literal_eval(data)  #parse raw data from reading wallet file
-            except Exception:
-                raise IOError("Cannot read wallet file.")
-            self.data = {}
-            for key, value in d.items():
+                self.data = json.loads(data)
+            except:
                 try:
-                    json.dumps(key)
-                    json.dumps(value)
-                except:
+                    d = ast.literal_eval(data)  #parse raw data from reading wallet file
+                except Exception:
+                    raise IOError("Cannot read wallet file.")
+                self.data = {}
+                for key, value in d.items():
+                    try:
+                        json.dumps(key)
+                        json.dumps(value)
+                    except:
+                        continue
+                    self.data[key] = value
+            self.file_exists = True
+        # a journal left by an interrupted compaction comes first
+        for journal in [self.journal_path('.old'), self.journal_path()]:
+            if os.path.exists(journal):
+                self.replay(journal)
+                self.file_exists = True
+
+    def replay(self, journal):
+        with open(journal, "r") as f:
+            for line in f:
+                try:
+                    code, key, op, value = json.loads(line)
+                except ValueError:
+                    # an entry cut short: the last one of a journal, or of
+                    # one that more entries were appended to
+                    print_error("wallet journal: ignoring", repr(line[:40]))
                     continue
-                self.data[key] = value
-        self.file_exists = True
+                d = self.data if code is None else self.data.setdefault(code, {})
+                if op == 'set':
+                    d[key] = value
+                elif op == 'del':
+                    d.pop(key, None)
+                elif op == 'update':
+                    v = d.setdefault(key, {})
+                    v.update(value['set'])
+                    for k in value['del']:
+                        v.pop(k, None)
+        if journal == self.journal_path():
+            self.journal_size = os.path.getsize(journal)
 
     def get_above_chain(self, key, default=None):
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
-            else:
-                v = copy.deepcopy(v)
-            return v
+            elif self.is_chain_dict(key, v):
+                v = freeze(v)
+                for x in v.values():
+                    self.share(x)
+            return self.share(v)
+
+    @staticmethod
+    def share(v):
+        if isinstance(v, ItemDict):
+            v.shared = True
+        return v
 
     def get_chain_value(self, code, key, default=None):
         """Shortcut for getting info within a certain chain"""
@@ -147,9 +255,19 @@ class WalletStorage(object):
             v = self.data[active_chain_code].get(key)
             if v is None:
                 v = default
-            else:
-                v = copy.deepcopy(v)
-            return v
+            return self.share(v)
+
+    def get_item(self, key, item, default=None):
+        """One item of the dict stored under key. Unlike get, it does not
+        make the next put_item copy the dict."""
+        try:
+            active_chain_code = self.config.get_active_chain_code()
+        except:
+            active_chain_code = chainparams.get_active_chain().code
+        with self.lock:
+            d = self.data[active_chain_code].get(key)
+            v = d.get(item) if d is not None else None
+            return default if v is None else v
 
     def put_above_chain(self, key, value, save = True):
         '''Bypass the usual practice of storing something in the active chain's dict'''
@@ -160,12 +278,15 @@ class WalletStorage(object):
             print_error("json error: cannot save", key)
             return
         with self.lock:
-            if value is not None:
-                self.data[key] = copy.deepcopy(value)
+            self.pending.setdefault((None, key), self.data.get(key))
+            if self.is_chain_dict(key, value):
+                self.data[key] = dict((k, freeze(v)) for k, v in value.iteritems())
+            elif value is not None:
+                self.data[key] = freeze(value)
             elif key in self.data:
                 self.data.pop(key)
             if save:
-                self.write()
+                self.saver.mark_dirty()
 
     def put(self, key, value, save = True):
         try:
@@ -179,21 +300,311 @@ class WalletStorage(object):
         except:
             active_chain_code = chainparams.get_active_chain().code
         with self.lock:
+            self.pending.setdefault((active_chain_code, key), self.data[active_chain_code].get(key))
             if value is not None:
-                self.data[active_chain_code][key] = copy.deepcopy(value)
+                self.data[active_chain_code][key] = freeze(value)
             elif key in self.data[active_chain_code]:
                 self.data[active_chain_code].pop(key)
             if save:
-                self.write()
+                self.saver.mark_dirty()
+
+    def put_item(self, key, item, value, save=True):
+        """Set one item of the dict stored under key, or remove it if value
+        is None. Only that item is frozen and saved, so this costs the same
+        however large the dict is."""
+        try:
+            active_chain_code = self.config.get_active_chain_code()
+        except:
+            active_chain_code = chainparams.get_active_chain().code
+        with self.lock:
+            d = self.data[active_chain_code].get(key)
+            if not isinstance(d, ItemDict) or d.shared:
+                # copied, so that the holders of the dict never see it change
+                d = self.data[active_chain_code][key] = ItemDict(d or {})
+            self.pending_items.setdefault((active_chain_code, key), set()).add(item)
+            if value is not None:
+                dict.__setitem__(d, item, freeze(value))
+            else:
+                dict.pop(d, item, None)
+            if save:
+                self.saver.mark_dirty()
+
+    def flush(self):
+        self.saver.flush()
+
+    def save_pending(self):
+        """Append the keys changed since they were last saved to the journal."""
+        self.check_writable()
+        with self.lock:
+            lines = []
+            for (code, key), items in self.pending_items.items():
+                d = self.data[code].get(key) or {}
+                changed = dict((k, d[k]) for k in items if k in d)
+                removed = [k for k in items if k not in d]
+                lines.append(json.dumps([code, key, 'update', {'set': changed, 'del': removed}]) + '\n')
+            for (code, key), old in self.pending.items():
+                d = self.data if code is None else self.data.get(code, {})
+                entry = self.journal_entry(old, d.get(key))
+                if entry is not None:
+                    lines.append(json.dumps([code, key] + entry) + '\n')
+            if lines:
+                self.append_to_journal(''.join(lines))
+            # only once they are written, so that a failed save is retried
+            self.pending_items = {}
+            self.pending = {}
+            if not lines:
+                return
+            if self.journal_size > max(JOURNAL_COMPACT_SIZE, self.file_size) and self.compactor is None:
+                self.compactor = threading.Thread(target=self.compact)
+                self.compactor.daemon = True
+                self.compactor.start()
+
+    def append_to_journal(self, s):
+        if self.journal is None:
+            s = self.journal_separator(self.journal_path()) + s
+            self.journal = open(self.journal_path(), "a")
+            self.set_permissions(self.journal_path())
+        try:
+            self.journal.write(s)
+            self.journal.flush()
+        except Exception:
+            # the journal may end with part of s: it is reopened, and
+            # the entries written again after it, by the next save
+            exc_info = sys.exc_info()
+            try:
+                self.journal.close()
+            except Exception:
+                pass
+            self.journal = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.journal_size += len(s)
+
+    @staticmethod
+    def journal_separator(path):
+        """'\n' if the journal at path ends with an entry that was cut
+        short, so that the entries appended to it start on a new line."""
+        if not os.path.exists(path):
+            return ''
+        with open(path, "r") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - 1, 0))
+            return '\n' if size and f.read(1) != '\n' else ''
+
+    def check_writable(self):
+        if self.read_only:
+            raise IOError("wallet opened read-only: %s" % self.path)
+
+    def journal_entry(self, old, new):
+        """[op, value] taking old to new, or None if they are the same."""
+        if new is None:
+            return None if old is None else ['del', None]
+        if isinstance(old, dict) and isinstance(new, dict):
+            changed = dict((k, v) for k, v in new.iteritems() if k not in old or old[k] != v)
+            removed = [k for k in old if k not in new]
+            if not changed and not removed:
+                return None
+            if len(changed) < len(new):
+                return ['update', {'set': changed, 'del': removed}]
+        elif old == new:
+            return None
+        return ['set', new]
+
+    def compact(self):
+        """Fold the journal into the wallet file."""
+        try:
+            with self.lock:
+                s = json.dumps(self.data, indent=4, sort_keys=True)
+                # changes from now on go to a new journal
+                self.close_journal()
+                self.move_journal_to_old()
+                self.journal_size = 0
+            self.write_file(s)
+            with self.lock:
+                if os.path.exists(self.journal_path('.old')):
+                    os.remove(self.journal_path('.old'))
+        finally:
+            with self.lock:
+                self.compactor = None
+
+    def move_journal_to_old(self):
+        """Move the journal to the .old journal, which is removed once
+        the wallet file is written."""
+        if not os.path.exists(self.journal_path()):
+            return
+        if not os.path.exists(self.journal_path('.old')):
+            os.rename(self.journal_path(), self.journal_path('.old'))
+            return
+        # left by an interrupted compaction, and not in the wallet file
+        # yet: append to it rather than replace it
+        separator = self.journal_separator(self.journal_path('.old'))
+        with open(self.journal_path(), "r") as f:
+            with open(self.journal_path('.old'), "a") as old:
+                old.write(separator)
+                shutil.copyfileobj(f, old)
+                old.flush()
+                os.fsync(old.fileno())
+        os.remove(self.journal_path())
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def set_path(self, path):
+        """Save the wallet under path from now on, starting with a full write."""
+        self.flush()
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            self.close_journal()
+            self.path = path
+        self.write()
 
     def write(self):
-        s = json.dumps(self.data, indent=4, sort_keys=True)
-        f = open(self.path,"w")
+        """Write the whole wallet to its file and empty the journal."""
+        self.check_writable()
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            s = json.dumps(self.data, indent=4, sort_keys=True)
+            self.write_file(s)
+            self.pending = {}
+            self.pending_items = {}
+            self.close_journal()
+            for journal in [self.journal_path(), self.journal_path('.old')]:
+                if os.path.exists(journal):
+                    os.remove(journal)
+            self.journal_size = 0
+
+    def write_file(self, s):
+        temp_path = self.path + '.tmp'
+        f = open(temp_path,"w")
         f.write(s)
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        self.set_permissions(temp_path)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+        self.file_size = len(s)
+
+    def set_permissions(self, path):
         if 'ANDROID_DATA' not in os.environ:
             import stat
-            os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+            os.chmod(path,stat.S_IREAD | stat.S_IWRITE)
+
+
+class ItemDict(FrozenDict):
+    """A dict stored by WalletStorage that put_item updates in place.
+
+    shared is set once get has returned it: the next put_item then
+    changes a copy, so that what get returned never changes.
+    """
+    shared = False
+
+
+class LazyTransactionMap(object):
+    """tx_hash -> Transaction, deserializing each one when first used.
+
+    Pay-to-pubkey inputs are resolved against the other transactions of
+    the map when parsed. If storage is given, the raw transactions are
+    read from its 'transactions' key when needed, and the ones added or
+    removed are saved one by one; otherwise they are kept in raw.
+    """
+
+    def __init__(self, raw=None, storage=None):
+        self.raw = dict(raw or {})
+        self.parsed = {}
+        self.storage = storage
+        self.lock = threading.RLock()
+
+    def raw_map(self):
+        if self.storage:
+            return self.storage.get('transactions', {})
+        return self.raw
+
+    def get_raw(self, tx_hash):
+        if self.storage:
+            return self.storage.get_item('transactions', tx_hash)
+        return self.raw.get(tx_hash)
+
+    def set_raw(self, tx_hash, raw):
+        if self.storage:
+            self.storage.put_item('transactions', tx_hash, raw)
+        elif raw is None:
+            self.raw.pop(tx_hash, None)
+        else:
+            self.raw[tx_hash] = raw
+
+    def __len__(self):
+        return len(self.raw_map())
+
+    def __contains__(self, tx_hash):
+        return self.get_raw(tx_hash) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        with self.lock:
+            self.set_raw(tx_hash, str(tx))
+            self.parsed[tx_hash] = tx
+
+    def get(self, tx_hash, default=None):
+        with self.lock:
+            tx = self.parsed.get(tx_hash)
+            if tx is not None:
+                return tx
+            raw = self.get_raw(tx_hash)
+            if raw is None:
+                return default
+            try:
+                tx = Transaction.deserialize(raw)
+            except Exception:
+                print_msg("Warning: Cannot deserialize transactions. skipping")
+                self.set_raw(tx_hash, None)
+                return default
+            self.parsed[tx_hash] = tx
+            tx.add_pubkey_addresses(self)
+            return tx
+
+    def pop(self, tx_hash, *default):
+        with self.lock:
+            tx = self.get(tx_hash)
+            if self.get_raw(tx_hash) is not None:
+                self.set_raw(tx_hash, None)
+                self.parsed.pop(tx_hash)
+            elif default:
+                return default[0]
+            else:
+                raise KeyError(tx_hash)
+            return tx
+
+    def keys(self):
+        with self.lock:
+            return self.raw_map().keys()
+
+    def items(self):
+        out = []
+        for tx_hash in self.keys():
+            tx = self.get(tx_hash)
+            if tx is not None:
+                out.append((tx_hash, tx))
+        return out
+
+    def values(self):
+        return [tx for tx_hash, tx in self.items()]
+
 
 
 class Abstract_Wallet(object):
@@ -215,26 +626,30 @@ class Abstract_Wallet(object):
         self.use_change            = storage.get('use_change',True)
         self.use_encryption        = storage.get_above_chain('use_encryption', False)
         self.seed                  = storage.get_above_chain('seed', '')               # encrypted
-        self.labels                = storage.get('labels', {})
-        self.frozen_addresses      = storage.get('frozen_addresses',[])
-        self.addressbook           = storage.get('contacts', [])
+        self.labels                = copy.deepcopy(storage.get('labels', {}))
+        self.frozen_addresses      = copy.deepcopy(storage.get('frozen_addresses',[]))
+        self.addressbook           = copy.deepcopy(storage.get('contacts', []))
 
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = copy.deepcopy(storage.get('addr_history',{}))        # address -> list(txid, height)
         self.fee_per_kb            = int(storage.get('fee_per_kb', self.active_chain.RECOMMENDED_FEE))
 
         # This attribute is set when wallet.start_threads is called.
         self.synchronizer = None
 
         # imported_keys is deprecated. The GUI should call convert_imported_keys
-        self.imported_keys = self.storage.get('imported_keys',{})
+        self.imported_keys = copy.deepcopy(self.storage.get('imported_keys',{}))
 
         self.load_accounts()
 
         self.load_transactions()
 
-        # not saved
+        # rebuilt from the saved 'tx_outputs' index
         self.prevout_values = {}     # my own transaction outputs
-        self.spent_outputs = []
+        self.spent_outputs = set()
+        self.utxos = {}              # "tx_hash:n" -> coin
+        self.address_utxos = {}      # address -> set of "tx_hash:n"
+        self.account_utxos = {}      # account id -> set of "tx_hash:n"
+        self.balance_cache = {}      # address -> (confirmed, unconfirmed)
         # spv
         self.verifier = None
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
@@ -244,8 +659,8 @@ class Abstract_Wallet(object):
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
         self.tx_event = threading.Event()
-        for tx_hash, tx in self.transactions.items():
-            self.update_tx_outputs(tx_hash)
+        self.load_tx_outputs()
+        self.load_utxos()
 
         # save wallet type the first time
         if self.storage.get_above_chain('wallet_type') is None:
@@ -260,21 +675,42 @@ class Abstract_Wallet(object):
         self.__init__(self.storage)
 
     def load_transactions(self):
-        self.transactions = {}
-        tx_list = self.storage.get('transactions',{})
-        for k, raw in tx_list.items():
-            try:
-                tx = Transaction.deserialize(raw)
-            except Exception:
-                print_msg("Warning: Cannot deserialize transactions. skipping")
-                continue
-            self.add_pubkey_addresses(tx)
-            self.transactions[k] = tx
-        for h,tx in self.transactions.items():
-            if not self.check_new_tx(h, tx):
+        self.transactions = LazyTransactionMap(storage=self.storage)
+        self.tx_addresses = {}      # tx_hash -> set of addresses whose history has it
+        for addr, hist in self.history.items():
+            if hist != ['*']:
+                self.update_tx_addresses(addr, [tx_hash for tx_hash, height in hist], [])
+        for h in self.transactions.keys():
+            if h not in self.tx_addresses:
                 print_error("removing unreferenced tx", h)
                 self.transactions.pop(h)
 
+    def update_tx_addresses(self, addr, added, removed):
+        """Update tx_addresses with the txids added to and removed from
+        the history of addr."""
+        for tx_hash in removed:
+            addresses = self.tx_addresses.get(tx_hash)
+            addresses.discard(addr)
+            if not addresses:
+                self.tx_addresses.pop(tx_hash)
+        for tx_hash in added:
+            self.tx_addresses.setdefault(tx_hash, set()).add(addr)
+
+    def load_tx_outputs(self):
+        """Index the outputs of the transactions, parsing only the ones
+        that are missing from the saved index."""
+        saved = self.storage.get('tx_outputs', {})
+        self.tx_outputs = {}
+        for tx_hash in self.transactions.keys():
+            entry = saved.get(tx_hash)
+            if entry is None:
+                self.update_tx_outputs(tx_hash)
+                self.storage.put_item('tx_outputs', tx_hash, self.tx_outputs[tx_hash])
+            else:
+                self.add_tx_outputs(tx_hash, entry)
+        for tx_hash in [h for h in saved.keys() if h not in self.tx_outputs]:
+            self.storage.put_item('tx_outputs', tx_hash, None)
+
     def add_pubkey_addresses(self, tx):
         # find the address corresponding to pay-to-pubkey inputs
         h = tx.hash()
@@ -282,12 +718,19 @@ class Abstract_Wallet(object):
         # inputs
         tx.add_pubkey_addresses(self.transactions)
 
-        # outputs of tx: inputs of tx2
-        for type, x, v in tx.outputs:
-            if type == 'pubkey':
-                for tx2 in self.transactions.values():
-                    tx2.chain = self.active_chain
-                    tx2.add_pubkey_addresses({h:tx})
+        # outputs of tx: inputs of the transactions spending them, whose
+        # entries in tx_outputs are updated and saved with the addresses
+        if 'pubkey' not in [type for type, x, v in tx.outputs]:
+            return
+        prefix = h + ':'
+        for tx_hash, (outputs, inputs) in self.tx_outputs.items():
+            if [key for key, addr in inputs if addr == "(pubkey)" and key.startswith(prefix)]:
+                tx2 = self.transactions.get(tx_hash)
+                tx2.chain = self.active_chain
+                tx2.add_pubkey_addresses({h:tx})
+                self.update_tx_outputs(tx_hash)
+                self.storage.put_item('tx_outputs', tx_hash, self.tx_outputs[tx_hash])
+                self.update_tx_utxos(tx_hash)
 
     def get_action(self):
         pass
@@ -304,8 +747,9 @@ class Abstract_Wallet(object):
 
     def load_accounts(self):
         self.accounts = {}
+        self.address_index = {}     # address -> (account id, (for_change, n))
 
-        d = self.storage.get('accounts', {})
+        d = copy.deepcopy(self.storage.get('accounts', {}))
         for k, v in d.items():
             if self.wallet_type == 'old' and k in [0, '0']:
                 v['mpk'] = self.storage.get('master_public_key')
@@ -322,6 +766,42 @@ class Abstract_Wallet(object):
                 self.accounts[k] = PendingAccount(v)
             else:
                 print_error("cannot load account", v)
+        for k in self.accounts.keys():
+            self.index_account(k)
+
+    def index_account(self, account_id):
+        account = self.accounts[account_id]
+        for for_change in [0, 1]:
+            for n, addr in enumerate(account.get_addresses(for_change)):
+                self.address_index[addr] = account_id, (for_change, n)
+
+    def unindex_account(self, account_id):
+        account = self.accounts.get(account_id)
+        if account is None: return
+        for for_change in [0, 1]:
+            for addr in account.get_addresses(for_change):
+                if self.address_index.get(addr, (None,))[0] == account_id:
+                    self.address_index.pop(addr)
+
+    def index_new_addresses(self, addresses):
+        # the account that just created addresses has them as its newest ones
+        for account_id, account in self.accounts.items():
+            for for_change in [0, 1]:
+                last = account.get_last_address(for_change)
+                if last is not None and last[1] == addresses[-1]:
+                    first = last[0] + 1 - len(addresses)
+                    for i, address in enumerate(addresses):
+                        self.address_index[address] = account_id, (for_change, first + i)
+                    return
+
+    def set_account(self, account_id, account):
+        self.unindex_account(account_id)
+        self.accounts[account_id] = account
+        self.index_account(account_id)
+
+    def remove_account(self, account_id):
+        self.unindex_account(account_id)
+        return self.accounts.pop(account_id)
 
     def synchronize(self):
         pass
@@ -361,9 +841,13 @@ class Abstract_Wallet(object):
         if self.is_mine(address):
             raise Exception('Address already in wallet')
 
-        if self.accounts.get(IMPORTED_ACCOUNT) is None:
-            self.accounts[IMPORTED_ACCOUNT] = ImportedAccount({'imported':{}})
-        self.accounts[IMPORTED_ACCOUNT].add(address, pubkey, sec, password)
+        account = self.accounts.get(IMPORTED_ACCOUNT)
+        if account is None:
+            account = ImportedAccount({'imported':{}})
+        # imported addresses are sorted: their indexes shift
+        self.unindex_account(IMPORTED_ACCOUNT)
+        account.add(address, pubkey, sec, password)
+        self.set_account(IMPORTED_ACCOUNT, account)
         self.save_accounts()
 
         if self.synchronizer:
@@ -372,8 +856,11 @@ class Abstract_Wallet(object):
 
     def delete_imported_key(self, addr):
         account = self.accounts[IMPORTED_ACCOUNT]
+        self.unindex_account(IMPORTED_ACCOUNT)
         account.remove(addr)
-        if not account.get_addresses(0):
+        if account.get_addresses(0):
+            self.index_account(IMPORTED_ACCOUNT)
+        else:
             self.accounts.pop(IMPORTED_ACCOUNT)
         self.save_accounts()
 
@@ -402,7 +889,7 @@ class Abstract_Wallet(object):
         return o
 
     def is_mine(self, address):
-        return address in self.addresses(True)
+        return address in self.address_index
 
     def is_change(self, address):
         if not self.is_mine(address): return False
@@ -411,13 +898,10 @@ class Abstract_Wallet(object):
         return s[0] == 1
 
     def get_address_index(self, address):
-        for account in self.accounts.keys():
-            for for_change in [0,1]:
-                addresses = self.accounts[account].get_addresses(for_change)
-                for addr in addresses:
-                    if address == addr:
-                        return account, (for_change, addresses.index(addr))
-        raise Exception("Address not found", address)
+        try:
+            return self.address_index[address]
+        except KeyError:
+            raise Exception("Address not found", address)
 
     def get_private_key(self, address, password):
         if self.is_watching_only():
@@ -482,17 +966,80 @@ class Abstract_Wallet(object):
 
     def update_tx_outputs(self, tx_hash):
         tx = self.transactions.get(tx_hash)
+        outputs = map(list, tx.get_outputs())
+        inputs = [[item['prevout_hash'] + ':%d'%item['prevout_n'], item.get('address')]
+                  for item in tx.inputs if not item.get('is_coinbase')]
+        self.add_tx_outputs(tx_hash, [outputs, inputs])
+
+    def add_tx_outputs(self, tx_hash, entry):
+        """Index a transaction from its entry in tx_outputs:
+        [[address, value] of each output, [prevout, address] of each input]."""
+        outputs, inputs = entry
+        self.tx_outputs[tx_hash] = entry
+        for i, (addr, value) in enumerate(outputs):
+            self.prevout_values[tx_hash + ':%d'%i] = value
+        for key, addr in inputs:
+            if self.is_mine(addr):
+                self.spent_outputs.add(key)
 
-        for i, (addr, value) in enumerate(tx.get_outputs()):
-            key = tx_hash+ ':%d'%i
-            self.prevout_values[key] = value
-
-        for item in tx.inputs:
-            if self.is_mine(item.get('address')):
-                key = item['prevout_hash'] + ':%d'%item['prevout_n']
-                self.spent_outputs.append(key)
+    def load_utxos(self):
+        with self.lock:
+            for addr in self.history.keys():
+                self.update_address_utxos(addr, self.address_index.get(addr, (None,))[0])
+
+    def update_address_utxos(self, address, account=None):
+        """Recompute the unspent outputs of address from its history.
+        Call with self.lock held."""
+        self.balance_cache.pop(address, None)
+        for key in self.address_utxos.pop(address, ()):
+            coin = self.utxos.pop(key)
+            self.account_utxos.get(coin['account'], set()).discard(key)
+        h = self.history.get(address, [])
+        if h == ['*']: return
+        keys = set()
+        for tx_hash, tx_height in h:
+            entry = self.tx_outputs.get(tx_hash)
+            if entry is None or tx_hash not in self.transactions: continue
+            outputs, inputs = entry
+            for i, (addr, value) in enumerate(outputs):
+                if addr != address: continue
+                key = tx_hash + ':%d'%i
+                if key in self.spent_outputs: continue
+                if account is None:
+                    try:
+                        account, _ = self.get_address_index(address)
+                    except Exception:
+                        pass
+                self.utxos[key] = {'address':address, 'value':value, 'prevout_n':i, 'prevout_hash':tx_hash,
+                                   'height':tx_height, 'coinbase':not inputs, 'account':account}
+                keys.add(key)
+        if keys:
+            self.address_utxos[address] = keys
+            self.account_utxos.setdefault(account, set()).update(keys)
+
+    def update_tx_utxos(self, tx_hash):
+        """Recompute the unspent outputs of the addresses a transaction touches."""
+        entry = self.tx_outputs.get(tx_hash)
+        if entry is None: return
+        outputs, inputs = entry
+        addresses = set(addr for addr, value in outputs) | set(addr for key, addr in inputs)
+        with self.lock:
+            for addr in addresses:
+                if addr in self.history:
+                    self.update_address_utxos(addr)
 
     def get_addr_balance(self, address):
+        """(confirmed, unconfirmed) balance of address.
+
+        Cached until the history of the address or one of its
+        transactions changes, see update_address_utxos."""
+        balance = self.balance_cache.get(address)
+        if balance is None:
+            with self.lock:
+                balance = self.balance_cache[address] = self.compute_addr_balance(address)
+        return balance
+
+    def compute_addr_balance(self, address):
         #assert self.is_mine(address)
         h = self.history.get(address,[])
         if h == ['*']: return 0,0
@@ -500,29 +1047,28 @@ class Abstract_Wallet(object):
         received_coins = []   # list of coins received at address
 
         for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
-            if not tx: continue
+            entry = self.tx_outputs.get(tx_hash)
+            if entry is None or tx_hash not in self.transactions: continue
+            outputs, inputs = entry
 
-            for i, (addr, value) in enumerate(tx.get_outputs()):
+            for i, (addr, value) in enumerate(outputs):
                 if addr == address:
                     key = tx_hash + ':%d'%i
                     received_coins.append(key)
 
         for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
-            if not tx: continue
+            entry = self.tx_outputs.get(tx_hash)
+            if entry is None or tx_hash not in self.transactions: continue
+            outputs, inputs = entry
             v = 0
 
-            for item in tx.inputs:
-                addr = item.get('address')
+            for key, addr in inputs:
                 if addr == address:
-                    key = item['prevout_hash']  + ':%d'%item['prevout_n']
                     value = self.prevout_values.get( key )
                     if key in received_coins:
                         v -= value
 
-            for i, (addr, value) in enumerate(tx.get_outputs()):
-                key = tx_hash + ':%d'%i
+            for addr, value in outputs:
                 if addr == address:
                     v += value
 
@@ -566,32 +1112,31 @@ class Abstract_Wallet(object):
         return cc, uu
 
     def get_unspent_coins(self, domain=None):
+        with self.lock:
+            if domain is None:
+                keys = [key for account in self.accounts.keys() for key in self.account_utxos.get(account, ())]
+            else:
+                keys = [key for addr in domain for key in self.address_utxos.get(addr, ())]
+            return self.sort_coins(keys)
+
+    def get_account_coins(self, account):
+        """Unspent coins of an account, or of the whole wallet if account is None."""
+        if account is None:
+            return self.get_unspent_coins()
+        with self.lock:
+            return self.sort_coins(self.account_utxos.get(account, ()))
+
+    def sort_coins(self, keys):
+        # oldest first, then unconfirmed ones
         coins = []
-        if domain is None: domain = self.addresses(True)
-        for addr in domain:
-            h = self.history.get(addr, [])
-            if h == ['*']: continue
-            for tx_hash, tx_height in h:
-                tx = self.transactions.get(tx_hash)
-                if tx is None: raise Exception("Wallet not synchronized")
-                is_coinbase = tx.inputs[0].get('prevout_hash') == '0'*64
-                for i, (address, value) in enumerate(tx.get_outputs()):
-                    output = {'address':address, 'value':value, 'prevout_n':i}
-                    if address != addr: continue
-                    key = tx_hash + ":%d"%i
-                    if key in self.spent_outputs: continue
-                    output['prevout_hash'] = tx_hash
-                    output['height'] = tx_height
-                    output['coinbase'] = is_coinbase
-                    coins.append((tx_height, output))
-
-        # sort by age
-        if coins:
-            coins = sorted(coins)
-            if coins[-1][0] != 0:
-                while coins[0][0] == 0:
-                    coins = coins[1:] + [ coins[0] ]
-        return [x[1] for x in coins]
+        for key in keys:
+            coin = dict(self.utxos[key])
+            del coin['account']
+            coins.append((coin['height'], coin))
+        coins.sort()
+        confirmed = [x[1] for x in coins if x[0] != 0]
+        unconfirmed = [x[1] for x in coins if x[0] == 0]
+        return confirmed + unconfirmed if confirmed else unconfirmed
 
 
 
@@ -623,31 +1168,49 @@ class Abstract_Wallet(object):
                 return
             self.transactions[tx_hash] = tx
             self.network.pending_transactions_for_notifications.append(tx)
-            self.save_transactions()
             if self.verifier and tx_height>0:
                 self.verifier.add(tx_hash, tx_height)
             self.update_tx_outputs(tx_hash)
-
-    def save_transactions(self):
-        tx = {}
-        for k,v in self.transactions.items():
-            tx[k] = str(v)
-        self.storage.put('transactions', tx, True)
+            self.storage.put_item('tx_outputs', tx_hash, self.tx_outputs[tx_hash])
+            self.update_tx_utxos(tx_hash)
+
+    def diff_history(self, old_hist, new_hist):
+        """Return the changes from old_hist to new_hist: (added, removed,
+        changed), the lists of (tx_hash, height) that are new, of tx_hash
+        that are gone and of (tx_hash, height) whose height changed."""
+        if old_hist == ['*']: old_hist = []
+        if new_hist == ['*']: new_hist = []
+        old = dict(old_hist)
+        new = dict(new_hist)
+        added = [(tx_hash, height) for tx_hash, height in new_hist if tx_hash not in old]
+        removed = [tx_hash for tx_hash, height in old_hist if tx_hash not in new]
+        changed = [(tx_hash, height) for tx_hash, height in new_hist
+                   if tx_hash in old and old[tx_hash] != height]
+        return added, removed, changed
 
     def receive_history_callback(self, addr, hist):
-
-        if not self.check_new_history(addr, hist):
+        """Store the new history of addr and process what changed in it.
+        Return the changes, as returned by diff_history."""
+        old_hist = self.get_history(addr) or []
+        # entries are lists once saved, and tuples from the synchronizer
+        if map(list, hist) == map(list, old_hist):
+            return [], [], []
+        delta = added, removed, changed = self.diff_history(old_hist, hist)
+
+        if not self.check_new_history(addr, hist, delta):
             raise Exception("error: received history for %s is not consistent with known transactions"%addr)
 
         with self.lock:
+            self.update_tx_addresses(addr, [tx_hash for tx_hash, height in added], removed)
             self.history[addr] = hist
-            self.storage.put('addr_history', self.history, True)
+            self.storage.put_item('addr_history', addr, hist)
+            self.update_address_utxos(addr)
 
-        if hist != ['*']:
-            for tx_hash, tx_height in hist:
-                if tx_height>0:
-                    # add it in case it was previously unconfirmed
-                    if self.verifier: self.verifier.add(tx_hash, tx_height)
+        for tx_hash, tx_height in added + changed:
+            if tx_height>0:
+                # add it in case it was previously unconfirmed
+                if self.verifier: self.verifier.add(tx_hash, tx_height)
+        return delta
 
     def get_tx_history(self, account=None):
         if not self.verifier:
@@ -754,10 +1317,11 @@ class Abstract_Wallet(object):
         # get coins
         if not coins:
             if domain is None:
-                domain = self.addresses(True)
-            for i in self.frozen_addresses:
-                if i in domain: domain.remove(i)
-            coins = self.get_unspent_coins(domain)
+                coins = [c for c in self.get_unspent_coins() if c['address'] not in self.frozen_addresses]
+            else:
+                for i in self.frozen_addresses:
+                    if i in domain: domain.remove(i)
+                coins = self.get_unspent_coins(domain)
 
         amount = sum( map(lambda x:x[2], outputs) )
         total = fee = 0
@@ -853,7 +1417,7 @@ class Abstract_Wallet(object):
             if sec:
                 keypairs[ x ] = sec
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, self.storage.config.get('sign_workers') or 1)
         run_hook('sign_transaction', tx, password)
 
     def sendtx(self, tx):
@@ -898,7 +1462,7 @@ class Abstract_Wallet(object):
         for code in chaincodes:
             # skip the active chain
             if code == self.active_chain.code: continue
-            chain = self.storage.get_above_chain(code)
+            chain = copy.deepcopy(self.storage.get_above_chain(code))
             master_keys = chain.get('master_private_keys', None)
             if master_keys is None: continue
             for k, v in master_keys.items():
@@ -945,34 +1509,27 @@ class Abstract_Wallet(object):
                     self.verifier.add(tx_hash, tx_height)
 
         # if we are on a pruning server, remove unverified transactions
-        vr = self.verifier.transactions.keys() + self.verifier.verified_tx.keys()
+        vr = set(self.verifier.transactions.keys() + self.verifier.verified_tx.keys())
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
                 self.transactions.pop(tx_hash)
+                self.update_tx_utxos(tx_hash)
 
-    def check_new_history(self, addr, hist):
-        # check that all tx in hist are relevant
-        if hist != ['*']:
-            for tx_hash, height in hist:
-                tx = self.transactions.get(tx_hash)
-                if not tx: continue
-                if not tx.has_address(addr):
-                    return False
+    def check_new_history(self, addr, hist, delta=None):
+        if delta is None:
+            delta = self.diff_history(self.history.get(addr, []), hist)
+        added, removed, changed = delta
+
+        # check that new tx in hist are relevant
+        for tx_hash, height in added:
+            tx = self.transactions.get(tx_hash)
+            if not tx: continue
+            if not tx.has_address(addr):
+                return False
 
         # check that we are not "orphaning" a transaction
-        old_hist = self.history.get(addr,[])
-        if old_hist == ['*']: return True
-
-        for tx_hash, height in old_hist:
-            if tx_hash in map(lambda x:x[0], hist): continue
-            found = False
-            for _addr, _hist in self.history.items():
-                if _addr == addr: continue
-                if _hist == ['*']: continue
-                _tx_hist = map(lambda x:x[0], _hist)
-                if tx_hash in _tx_hist:
-                    found = True
-                    break
+        for tx_hash in removed:
+            found = bool(self.tx_addresses.get(tx_hash, set()) - set([addr]))
 
             if not found:
                 tx = self.transactions.get(tx_hash)
@@ -1004,18 +1561,14 @@ class Abstract_Wallet(object):
                 else:
                     print_error("removing orphaned tx from history", tx_hash)
                     self.transactions.pop(tx_hash)
+                    self.update_tx_utxos(tx_hash)
 
         return True
 
     def check_new_tx(self, tx_hash, tx):
         # 1 check that tx is referenced in addr_history.
-        addresses = []
-        for addr, hist in self.history.items():
-            if hist == ['*']:continue
-            for txh, height in hist:
-                if txh == tx_hash:
-                    addresses.append(addr)
-
+        with self.lock:
+            addresses = list(self.tx_addresses.get(tx_hash, ()))
         if not addresses:
             return False
 
@@ -1033,16 +1586,23 @@ class Abstract_Wallet(object):
             self.verifier = TxVerifier(self.network, self.storage)
             self.verifier.start()
             self.set_verifier(self.verifier)
+            self.network.register_callback('reorg', self.on_reorg)
             self.synchronizer = WalletSynchronizer(self, network)
             self.synchronizer.start()
         else:
             self.verifier = None
             self.synchronizer =None
 
+    def on_reorg(self):
+        height = self.network.get_reorg_height()
+        if self.verifier and height is not None:
+            self.verifier.undo_verifications(height)
+
     def stop_threads(self):
         if self.network:
             self.verifier.stop()
             self.synchronizer.stop()
+        self.storage.flush()
 
     def restore(self, cb):
         pass
@@ -1051,7 +1611,7 @@ class Abstract_Wallet(object):
         return self.accounts
 
     def add_account(self, account_id, account):
-        self.accounts[account_id] = account
+        self.set_account(account_id, account)
         self.save_accounts()
 
     def save_accounts(self):
@@ -1153,7 +1713,7 @@ class Imported_Wallet(Abstract_Wallet):
         Abstract_Wallet.__init__(self, storage)
         a = self.accounts.get(IMPORTED_ACCOUNT)
         if not a:
-            self.accounts[IMPORTED_ACCOUNT] = ImportedAccount({'imported':{}})
+            self.set_account(IMPORTED_ACCOUNT, ImportedAccount({'imported':{}}))
 
     def is_watching_only(self):
         acc = self.accounts[IMPORTED_ACCOUNT]
@@ -1271,10 +1831,17 @@ class Deterministic_Wallet(Abstract_Wallet):
         return address
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
-        if self.synchronizer:
-            self.synchronizer.add(address)
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
+        if not addresses:
+            return
+        self.index_new_addresses(addresses)
+        for address in addresses:
+            if address not in self.history:
+                self.history[address] = []
+            if self.synchronizer:
+                self.synchronizer.add(address)
         self.save_accounts()
 
     def synchronize(self):
@@ -1346,8 +1913,8 @@ class BIP32_Wallet(Deterministic_Wallet):
 
     def __init__(self, storage):
         Deterministic_Wallet.__init__(self, storage)
-        self.master_public_keys  = storage.get('master_public_keys', {})
-        self.master_private_keys = storage.get('master_private_keys', {})
+        self.master_public_keys  = copy.deepcopy(storage.get('master_public_keys', {}))
+        self.master_private_keys = copy.deepcopy(storage.get('master_private_keys', {}))
 
     def is_watching_only(self):
         return not bool(self.master_private_keys)
@@ -1499,13 +2066,13 @@ class BIP32_HD_Wallet(BIP32_Wallet):
 
     def delete_pending_account(self, k):
         assert type(self.accounts.get(k)) == PendingAccount
-        self.accounts.pop(k)
+        self.remove_account(k)
         self.save_accounts()
 
     def create_pending_account(self, name, password):
         next_id, next_xpub, next_address = self.next_account if self.next_account else self.get_next_account(password)
         self.set_label(next_id, name)
-        self.accounts[next_id] = PendingAccount({'pending':next_address})
+        self.set_account(next_id, PendingAccount({'pending':next_address}))
         self.save_accounts()
 
     def synchronize(self):
@@ -1531,7 +2098,7 @@ class BIP32_HD_Wallet(BIP32_Wallet):
             elif self.history.get(next_address, []):
                 if next_id not in self.accounts:
                     print_error("create pending account", next_id)
-                    self.accounts[next_id] = PendingAccount({'pending':next_address})
+                    self.set_account(next_id, PendingAccount({'pending':next_address}))
                     self.save_accounts()
 
 
@@ -1588,8 +2155,8 @@ class Multisig_Wallet(BIP32_Wallet, Mnemonic):
         chain_index = chainparams.get_chain_index(chain_code)
         self.root_derivation = "m/1491'/0'"
 
-        self.master_public_keys  = storage.get_above_chain('master_public_keys', {})
-        self.master_private_keys = storage.get_above_chain('master_private_keys', {})
+        self.master_public_keys  = copy.deepcopy(storage.get_above_chain('master_public_keys', {}))
+        self.master_private_keys = copy.deepcopy(storage.get_above_chain('master_private_keys', {}))
 
     def can_import(self):
         return False
@@ -1660,7 +2227,7 @@ class Multisig_Wallet(BIP32_Wallet, Mnemonic):
             if sec:
                 keypairs[ x ] = sec
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, self.storage.config.get('sign_workers') or 1)
         run_hook('sign_transaction', tx, password)
 
 class Wallet_2of2(Multisig_Wallet):
@@ -1778,7 +2345,7 @@ class OldWallet(Deterministic_Wallet):
         self.create_account(mpk)
 
     def create_account(self, mpk):
-        self.accounts['0'] = OldAccount({'mpk':mpk, 0:[], 1:[]})
+        self.set_account('0', OldAccount({'mpk':mpk, 0:[], 1:[]}))
         self.save_accounts()
 
     def create_watching_only_wallet(self, mpk):
@@ -100,6 +100,7 @@ setup(
         'chainkey.chainparams',
         'chainkey.commands',
         'chainkey.daemon',
+        'chainkey.ecc',
         'chainkey.i18n',
         'chainkey.interface',
         'chainkey.mnemonic',
@@ -112,6 +113,8 @@ setup(
         'chainkey.plugins',
         'chainkey.qrscanner',
         'chainkey.simple_config',
+        'chainkey.snapshot',
+        'chainkey.sqlite_storage',
         'chainkey.synchronizer',
         'chainkey.transaction',
         'chainkey.util',
@@ -122,6 +125,9 @@ setup(
         'chainkey.chains.__init__',
         'chainkey.chains.bitcoin',
         'chainkey.chains.cryptocur',
+        'chainkey.chains.headerstore',
+        'chainkey.chains.headertree',
+        'chainkey.chains.powpool',
         'chainkey.chains.mazacoin',
         'chainkey.chains.scrypt',
         'chainkey.chains.litecoin',